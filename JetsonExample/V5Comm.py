@@ -6,7 +6,33 @@ import json
 from json import JSONEncoder
 import serial
 import time
+import zlib
+import numpy as np
 from V5Position import Position
+
+# The brain checks packets with an MSB-first CRC32 (polynomial 0x04C11DB7, no final xor, see jetson::crc32).
+# zlib computes the same polynomial LSB-first in C, so the bits of every byte, and of the CRC itself, are reversed
+# around the zlib call instead of running a table lookup per byte in Python.
+_BYTE_REVERSE = bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256))
+
+def _reverse32(value):
+    # Reverse the order of the 32 bits of value
+    return int('{:032b}'.format(value)[::-1], 2)
+
+def crc32(data, accumulator=0):
+    # CRC32 of data as computed by the brain, the accumulator should be 0 or the result of a previous calculation
+    reflected = zlib.crc32(bytes(data).translate(_BYTE_REVERSE), _reverse32(accumulator) ^ 0xFFFFFFFF)
+    return _reverse32(reflected ^ 0xFFFFFFFF)
+
+MAX_DETECTIONS = 50  # Largest number of detections the brain accepts in an AI_RECORD
+
+# Packet header: sync bytes, payload length, packet type and CRC32 of the payload
+PACKET_SYNC = b'\xAA\x55\xCC\x33'
+PACKET_HEADER = struct.Struct('<4sHHI')
+
+# Pushed packets start their payload with a sequence number and a timestamp in milliseconds, covered by the CRC32.
+# They have their own packet type, so a brain that does not know them ignores them.
+PUSH_HEADER = struct.Struct('<II')
     
 class ImageDetection:
     def __init__(self, x: int, y: int, width: int, height: int):
@@ -16,9 +42,11 @@ class ImageDetection:
         self.width = width
         self.height = height
 
+    SERIAL_FORMAT = struct.Struct('<iiii')
+
     def to_Serial(self):
         # Convert ImageDetection properties to serialized binary format
-        return struct.pack('<iiii', self.x, self.y, self.width, self.height)
+        return self.SERIAL_FORMAT.pack(self.x, self.y, self.width, self.height)
     
     def to_JSON(self):
         # Convert ImageDetection properties to JSON format
@@ -31,29 +59,44 @@ class MapDetection:
         self.y = y
         self.z = z
 
+    SERIAL_FORMAT = struct.Struct('<fff')
+
     def to_Serial(self):
         # Convert MapDetection properties to serialized binary format
-        return struct.pack('<fff', self.x, self.y, self.z)
+        return self.SERIAL_FORMAT.pack(self.x, self.y, self.z)
     
     def to_JSON(self):
         # Convert MapDetection properties to JSON format
         return self.__dict__
     
 class Detection:
-    def __init__(self, classID: int, probability: float, depth: float, screenLocation: ImageDetection, mapLocation: MapDetection):
+    def __init__(self, classID: int, probability: float, depth: float, screenLocation: ImageDetection, mapLocation: MapDetection, trackID: int = 0, velocity: MapDetection = None):
         # Initialize properties of Detection class, including class ID, probability, depth, and locations on screen and on the field
+        # The track ID and the velocity on the field are set by the tracker, a track ID of 0 means the detection is not tracked
         self.classID = classID
         self.probability = probability
         self.depth = depth
         self.screenLocation = screenLocation
         self.mapLocattion = mapLocation
+        self.trackID = trackID
+        self.velocity = velocity if velocity is not None else MapDetection(0.0, 0.0, 0.0)
+
+    # Binary layout of a DETECTION_OBJECT: class, probability, depth, screen location and map location
+    SERIAL_FORMAT = struct.Struct('<iff' + 'iiii' + 'fff')
 
     def to_Serial(self):
         # Convert Detection properties to serialized binary format
-        data = struct.pack('<iff', self.classID, self.probability, self.depth)
-        data += self.screenLocation.to_Serial()
-        data += self.mapLocattion.to_Serial()
-        return data
+        data = bytearray(self.SERIAL_FORMAT.size)
+        self.pack_into(data, 0)
+        return bytes(data)
+
+    def pack_into(self, buffer, offset):
+        # Write Detection properties in serialized binary format into buffer at offset, returns the number of bytes written
+        screen = self.screenLocation
+        location = self.mapLocattion
+        self.SERIAL_FORMAT.pack_into(buffer, offset, self.classID, self.probability, self.depth,
+                                     screen.x, screen.y, screen.width, screen.height, location.x, location.y, location.z)
+        return self.SERIAL_FORMAT.size
     
     def to_JSON(self):
         # Convert Detection properties to JSON format
@@ -62,95 +105,408 @@ class Detection:
         outData['prob'] = self.probability
         outData['depth'] = self.depth
         outData['screenLocation'] = self.screenLocation.to_JSON()
-        outData['mapLocation'] = self.mapLocattion.to_JSON()
+        # The web dashboard reads each map coordinate as a one element list
+        outData['mapLocation'] = {axis: np.atleast_1d(value).tolist() for axis, value in self.mapLocattion.to_JSON().items()}
+        outData['trackID'] = self.trackID
+        outData['velocity'] = self.velocity.to_JSON()
         return outData
 
 
+# Columns of a DetectionBatch, the first fields have the binary layout of the brain's DETECTION_OBJECT
+DETECTION_DTYPE = np.dtype([
+    ("classID", "<i4"),
+    ("probability", "<f4"),
+    ("depth", "<f4"),
+    ("x", "<i4"),
+    ("y", "<i4"),
+    ("width", "<i4"),
+    ("height", "<i4"),
+    ("mapX", "<f4"),
+    ("mapY", "<f4"),
+    ("mapZ", "<f4"),
+    ("centerX", "<f8"),  # Image position the map location is computed from, as rawDetection.Center
+    ("centerY", "<f8"),
+    ("trackID", "<i4"),
+    ("velocityX", "<f4"),
+    ("velocityY", "<f4"),
+])
+
+# Fields of a DetectionBatch that have no value for a detection without depth, these hold NaN until serialization
+DEPTH_FIELDS = ("depth", "mapX", "mapY", "mapZ")
+
+class DetectionBatch:
+    # The detections of one frame, stored column by column in a NumPy structured array (see DETECTION_DTYPE) so
+    # depth, map position, tracking and serialization fill and read whole columns instead of one object per detection.
+    # For code that works on single detections, indexing and iterating give Detection objects. These are copies,
+    # changing them does not change the batch.
+    # A detection without valid depth has NaN depth and map location, it is sent to the brain with zeros instead.
+    def __init__(self, data=None):
+        self.data = data if data is not None else np.zeros(0, dtype=DETECTION_DTYPE)
+
+    @classmethod
+    def from_boxes(cls, boxes, scores, classes):
+        # Create a batch from the boxes (left, top, width, height in pixels), scores and classes of the model
+        boxes = np.asarray(boxes).reshape(-1, 4)
+        data = np.zeros(len(boxes), dtype=DETECTION_DTYPE)
+        data["classID"] = classes
+        data["probability"] = scores
+        data["x"] = np.maximum(0, np.floor(boxes[:, 0] + 0.5))
+        data["y"] = np.maximum(0, np.floor(boxes[:, 1] + 0.5))
+        data["width"] = boxes[:, 2]
+        data["height"] = boxes[:, 3]
+        data["centerX"] = boxes[:, 0]
+        data["centerY"] = boxes[:, 1]
+        return cls(data)
+
+    @classmethod
+    def from_raw_detections(cls, detections):
+        # Create a batch from a list of rawDetection objects of the model
+        data = np.zeros(len(detections), dtype=DETECTION_DTYPE)
+        data["classID"] = [det.ClassID for det in detections]
+        data["probability"] = [det.Prob for det in detections]
+        data["x"] = [det.x for det in detections]
+        data["y"] = [det.y for det in detections]
+        data["width"] = [det.Width for det in detections]
+        data["height"] = [det.Height for det in detections]
+        data["centerX"] = [det.Center[0] for det in detections]
+        data["centerY"] = [det.Center[1] for det in detections]
+        return cls(data)
+
+    @classmethod
+    def from_detections(cls, detections: "list[Detection]"):
+        # Create a batch from a list of Detection objects
+        data = np.zeros(len(detections), dtype=DETECTION_DTYPE)
+        screens = [det.screenLocation for det in detections]
+        locations = [det.mapLocattion for det in detections]
+        data["classID"] = [det.classID for det in detections]
+        data["probability"] = [det.probability for det in detections]
+        data["depth"] = [det.depth for det in detections]
+        data["x"] = data["centerX"] = [screen.x for screen in screens]
+        data["y"] = data["centerY"] = [screen.y for screen in screens]
+        data["width"] = [screen.width for screen in screens]
+        data["height"] = [screen.height for screen in screens]
+        # The map location of a Detection may hold one element arrays
+        data["mapX"] = np.reshape([location.x for location in locations], -1)
+        data["mapY"] = np.reshape([location.y for location in locations], -1)
+        data["mapZ"] = np.reshape([location.z for location in locations], -1)
+        data["trackID"] = [det.trackID for det in detections]
+        data["velocityX"] = [det.velocity.x for det in detections]
+        data["velocityY"] = [det.velocity.y for det in detections]
+        return cls(data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        # A slice gives a DetectionBatch sharing the data, an index gives a Detection
+        if isinstance(index, slice):
+            return DetectionBatch(self.data[index])
+        return self.__to_detection(self.data[index].tolist())
+
+    def __iter__(self):
+        for row in self.data.tolist():
+            yield self.__to_detection(row)
+
+    @staticmethod
+    def __to_detection(row):
+        classID, probability, depth, x, y, width, height, mapX, mapY, mapZ, _, _, trackID, velocityX, velocityY = row
+        return Detection(classID, probability, depth, ImageDetection(x, y, width, height), MapDetection(mapX, mapY, mapZ),
+                         trackID, MapDetection(velocityX, velocityY, 0.0))
+
+    def pack_into(self, buffer, offset):
+        # Write the detections in serialized binary format into buffer at offset, returns the number of bytes written.
+        # The serial fields are the first bytes of every row, so they are copied in one go.
+        size = Detection.SERIAL_FORMAT.size
+        count = len(self.data)
+        rows = np.ascontiguousarray(self.data).view(np.uint8).reshape(count, DETECTION_DTYPE.itemsize)
+        out = np.frombuffer(buffer, dtype=np.uint8, count=count * size, offset=offset).reshape(count, size)
+        out[:] = rows[:, :size]
+
+        # The brain has no invalid marker, detections without depth are sent with a depth and map location of 0
+        invalid = np.isnan(self.data["depth"])
+        if invalid.any():
+            fields = out.view(np.float32)
+            for name in DEPTH_FIELDS:
+                column = DETECTION_DTYPE.fields[name][1] // 4
+                fields[invalid, column] = 0.0
+        return count * size
+
+    def has_depth(self):
+        # Boolean mask of the detections with a valid depth and map location
+        return ~np.isnan(self.data["depth"])
+
+    def to_JSON(self):
+        # Convert the detections to JSON format, the same as Detection.to_JSON for each detection
+        outList = []
+        for classID, probability, depth, x, y, width, height, mapX, mapY, mapZ, _, _, trackID, velocityX, velocityY in self.data.tolist():
+            outList.append({
+                'class': classID,
+                'prob': probability,
+                'depth': depth,
+                'screenLocation': {'x': x, 'y': y, 'width': width, 'height': height},
+                'mapLocation': {'x': [mapX], 'y': [mapY], 'z': [mapZ]},
+                'trackID': trackID,
+                'velocity': {'x': velocityX, 'y': velocityY, 'z': 0.0},
+            })
+        return outList
+
+
 class AIRecord:
     # The AIRecord is what is communicated from the Jetson to the V5 Brain as a detection
-    def __init__(self, position: Position, detections: "list[Detection]"):
-        # Initialize properties of AIRecord class, including position and detections list
+    def __init__(self, position: Position, detections: "DetectionBatch | list[Detection]"):
+        # Initialize properties of AIRecord class, including position and detections
+        # The detections are kept as a DetectionBatch, a list of Detection objects is converted
         self.position = position
-        self.detections = detections
+        self.detections = detections if isinstance(detections, DetectionBatch) else DetectionBatch.from_detections(detections)
+
+    COUNT_FORMAT = struct.Struct('<i')
+
+    def serial_size(self, maxDetections=None):
+        # Number of bytes of the serialized record with at most maxDetections detections (all if None)
+        count = len(self.detections) if maxDetections is None else min(len(self.detections), maxDetections)
+        return self.COUNT_FORMAT.size + Position.SERIAL_FORMAT.size + count * Detection.SERIAL_FORMAT.size
 
     def to_Serial(self):
         # Convert AIRecord properties to serialized binary format
-        data = struct.pack('<i', len(self.detections))
-        data += self.position.to_Serial()
-        for det in self.detections:
-            data += det.to_Serial()
-        return data
+        data = bytearray(self.serial_size())
+        self.pack_into(data, 0)
+        return bytes(data)
+
+    def pack_into(self, buffer, offset, maxDetections=None):
+        # Write AIRecord properties in serialized binary format into buffer at offset, with at most maxDetections
+        # detections (all if None). Returns the number of bytes written.
+        detections = self.detections if maxDetections is None else self.detections[:maxDetections]
+        start = offset
+        self.COUNT_FORMAT.pack_into(buffer, offset, len(detections))
+        offset += self.COUNT_FORMAT.size
+        offset += self.position.pack_into(buffer, offset)
+        offset += detections.pack_into(buffer, offset)
+        return offset - start
     
     def to_JSON(self):
         # Convert AIRecord properties to JSON format
         outData = {}
         outData['position'] = self.position.to_JSON()
-        outData['detections'] = [det.to_JSON() for det in self.detections]
+        outData['detections'] = self.detections.to_JSON()
         return outData
 
     POLYNOMIAL_CRC32 = 0x04C11DB7
 
-    __crc32_table = [0] * 256
-    __table32Generated = 0
-
-    def __Crc32GenerateTable(self):
-        for i in range(256):
-            crc_accum = i << 24
-            for j in range(8):
-                if crc_accum & 0x80000000:
-                    crc_accum = (crc_accum << 1) ^ AIRecord.POLYNOMIAL_CRC32
-                else:
-                    crc_accum = crc_accum << 1
-            AIRecord.__crc32_table[i] = crc_accum
-        AIRecord.__table32Generated = 1
-
-    def __Crc32Generate(self, data, accumulator):
-        i, j = 0, 0
-        if not AIRecord.__table32Generated:
-            self.__Crc32GenerateTable()
-        for j in range(len(data)):
-            i = ((accumulator >> 24) ^ data[j]) & 0xFF
-            accumulator = (accumulator << 8) ^ AIRecord.__crc32_table[i]
-        return accumulator
-
     def getCRC32(self):
-        data = self.to_Serial()
-        crc = self.__Crc32Generate(data, 0) & 0xFFFFFFFF
-        return crc
+        return crc32(self.to_Serial())
     
 
 class V5SerialPacket:
     def __init__(self, type: int, detections: AIRecord):
         # Initialize properties of V5SerialPacket class, including type and detections
-        self.__length = len(detections.to_Serial())
+        # The record is serialized once here, the length and the CRC32 are taken from that payload
         self.__type = type        # 2 bytes
         self.__detections = detections
+        self.__payload = detections.to_Serial()
+        self.__length = len(self.__payload)
+        self.__crc32 = crc32(self.__payload)
 
     def to_Serial(self):
         # Convert V5SerialPacket properties to serialized binary format
-        data = bytearray([0xAA, 0x55, 0xCC, 0x33])
-        data += struct.pack('<HHI', self.__length, self.__type, self.__detections.getCRC32())
-        data += self.__detections.to_Serial()
+        data = bytearray(PACKET_HEADER.pack(PACKET_SYNC, self.__length, self.__type, self.__crc32))
+        data += self.__payload
         return data
 
+class V5PacketEncoder:
+    # Encodes AIRecords into serial packets inside one buffer that is allocated once, sized for maxDetections
+    # detections, so encoding a packet allocates no new buffers. Records with more detections than the brain
+    # accepts are cut to the first maxDetections. The returned memoryview points into the buffer and is only valid
+    # until the next call to encode.
+    def __init__(self, maxDetections=MAX_DETECTIONS):
+        self.maxDetections = maxDetections
+        size = PACKET_HEADER.size + PUSH_HEADER.size + AIRecord.COUNT_FORMAT.size + Position.SERIAL_FORMAT.size + maxDetections * Detection.SERIAL_FORMAT.size
+        self.__buffer = bytearray(size)
+        self.__view = memoryview(self.__buffer)
+
+    def encode(self, type: int, detections: AIRecord, sequence: int = None, timestamp: int = None):
+        # Encode the packet and return a memoryview of its bytes
+        # With a sequence number, the payload starts with the sequence number and timestamp of a pushed packet
+        length = 0
+        if sequence is not None:
+            PUSH_HEADER.pack_into(self.__buffer, PACKET_HEADER.size, sequence & 0xFFFFFFFF, timestamp & 0xFFFFFFFF)
+            length = PUSH_HEADER.size
+        length += detections.pack_into(self.__buffer, PACKET_HEADER.size + length, self.maxDetections)
+        end = PACKET_HEADER.size + length
+        PACKET_HEADER.pack_into(self.__buffer, 0, PACKET_SYNC, length, type, crc32(self.__view[PACKET_HEADER.size:end]))
+        return self.__view[:end]
+
+class PollParser:
+    # Finds the requests of the brain in the raw bytes read from the serial port, byte by byte as they arrive,
+    # so a request split over several reads or surrounded by other bytes is still found.
+    # A request is the prefix followed by one digit, the request code.
+    REQUEST_POLL = 1        # "AA55CC3301": send the latest packet
+    REQUEST_PUSH_START = 2  # "AA55CC3302": push a packet whenever new detections are set
+    REQUEST_PUSH_STOP = 3   # "AA55CC3303": stop pushing, only answer polls
+
+    def __init__(self, prefix=b"AA55CC330"):
+        self.prefix = prefix
+        self.__matched = 0  # Number of bytes of the prefix matched so far
+        # For every matched length, the length that is still matched when the next byte does not fit
+        self.__fallback = [0] * (len(prefix) + 1)
+        matched = 0
+        for i in range(1, len(prefix)):
+            while matched > 0 and prefix[i] != prefix[matched]:
+                matched = self.__fallback[matched]
+            if prefix[i] == prefix[matched]:
+                matched += 1
+            self.__fallback[i + 1] = matched
+
+    def feed(self, data):
+        # Parse the received bytes and return the codes of the complete requests in them, in order
+        prefix = self.prefix
+        matched = self.__matched
+        requests = []
+        for byte in data:
+            if matched == len(prefix):
+                # The byte after the prefix is the request code
+                if self.REQUEST_POLL <= byte - 0x30 <= self.REQUEST_PUSH_STOP:
+                    requests.append(byte - 0x30)
+                    matched = 0
+                    continue
+                matched = self.__fallback[matched]
+            while matched > 0 and byte != prefix[matched]:
+                matched = self.__fallback[matched]
+            if byte == prefix[matched]:
+                matched += 1
+        self.__matched = matched
+        return requests
+
+
+class LatencyHistogram:
+    # Counts latencies in buckets that roughly double in width, from 0.1 ms up to 50 ms and above
+    BUCKETS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, latency):
+        # Add a latency in seconds
+        bucket = 0
+        while bucket < len(self.BUCKETS) and latency > self.BUCKETS[bucket]:
+            bucket += 1
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def percentile(self, percent):
+        # Upper bound of the bucket the given percentile of the latencies falls into, in seconds
+        if self.count == 0:
+            return 0.0
+        target = self.count * percent / 100
+        seen = 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return self.max
+
+    def to_JSON(self):
+        # Convert the histogram to JSON format, bucket bounds in milliseconds
+        outData = {}
+        outData['buckets'] = [bound * 1000 for bound in self.BUCKETS]
+        outData['counts'] = list(self.counts)
+        outData['count'] = self.count
+        outData['average'] = self.total / self.count * 1000 if self.count else 0.0
+        outData['max'] = self.max * 1000
+        return outData
+
+
 class V5SerialComms:
+    # Sends the detections to the V5 Brain. By default the brain polls and every poll is answered with the latest
+    # packet. When the brain requests push mode, the latest detections are also pushed as soon as they are set,
+    # at most pushRate times per second, in packets with a sequence number and timestamp. A brain that never
+    # requests push mode only ever gets answers to its polls, as before.
 
     __MAP_PACKET_TYPE = 0x0001
+    __MAP_PUSH_PACKET_TYPE = 0x0002
 
-    def __init__(self, port = None):
+    def __init__(self, port = None, pushRate = 30.0):
         # Initialize properties of V5SerialComms class, including port, started status, and lock
         self.__dev = port
         self.__started = False
         self.__ser = None
         self.__detections = AIRecord(Position(0, 0, 0, 0, 0, 0, 0, 0), [])
         self.__detectionLock = Lock()
+        self.__encoder = V5PacketEncoder()
+        # The packet for the latest detections is encoded when they are set, so a poll is answered with one write.
+        # It is replaced as a whole, the reader thread only ever sees a complete packet.
+        self.__packet = bytes(self.__encoder.encode(self.__MAP_PACKET_TYPE, self.__detections))
+        self.pollLatency = LatencyHistogram()  # Time from receiving a poll to having written the packet
+
+        # Push mode, the push thread waits on the condition for new detections
+        self.pushRate = pushRate  # Largest number of packets pushed per second
+        self.pushed = 0
+        self.__pushing = False
+        self.__pushPending = False
+        self.__pushPacket = None
+        self.__sequence = 0  # Counts the detections set, so the brain can tell missed and repeated packets
+        self.__startTime = time.monotonic()
+        self.__pushCondition = threading.Condition(self.__detectionLock)
+        self.__writeLock = Lock()  # Polls are answered and packets pushed from different threads
 
     def start(self):
-        # Start serial communication thread
+        # Start serial communication and push threads
         self.__started = True
         self.__thread = threading.Thread(target=self.__run, args=())
         self.__thread.daemon = True
         self.__thread.start()
+        self.__pushThread = threading.Thread(target=self.__push, args=())
+        self.__pushThread.daemon = True
+        self.__pushThread.start()
+
+    def __encodePush(self):
+        # Encode the push packet for the current detections, called with the detection lock held
+        timestamp = int((time.monotonic() - self.__startTime) * 1000)
+        self.__pushPacket = bytes(self.__encoder.encode(self.__MAP_PUSH_PACKET_TYPE, self.__detections,
+                                                        self.__sequence, timestamp))
+        self.__pushPending = True
+        self.__pushCondition.notify()
+
+    def __setPushing(self, pushing):
+        # Switch push mode on or off, on switching it on the current detections are pushed right away
+        with self.__pushCondition:
+            self.__pushing = pushing
+            self.__pushPending = False
+            if pushing:
+                self.__encodePush()
+
+    def __write(self, packet):
+        # Write a whole packet to the serial port, so a poll answer and a pushed packet never interleave
+        with self.__writeLock:
+            self.__ser.write(packet)
+
+    def __push(self):
+        # Push the latest packet whenever new detections are set in push mode, no more often than pushRate
+        lastPush = 0.0
+        while self.__started:
+            with self.__pushCondition:
+                self.__pushCondition.wait_for(lambda: (self.__pushing and self.__pushPending) or not self.__started, 0.5)
+                if not (self.__pushing and self.__pushPending):
+                    continue
+            # Detections set while waiting for the rate limit replace the pending packet
+            delay = lastPush + 1.0 / self.pushRate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            with self.__pushCondition:
+                if not (self.__pushing and self.__pushPending):
+                    continue
+                packet = self.__pushPacket
+                self.__pushPending = False
+            lastPush = time.monotonic()
+            try:
+                self.__write(packet)
+                self.pushed += 1
+            except serial.SerialException:
+                pass  # The serial thread reconnects
 
     def __run(self):
         count = 1
@@ -181,17 +537,19 @@ class V5SerialComms:
                 self.__ser.flushInput()
                 self.__ser.flushOutput()
 
+                parser = PollParser()
+                self.__setPushing(False)  # A newly connected brain starts in poll mode
                 while self.__started:  # Continue reading while thread is started
-                    # Read data from the serial port
-                    data = self.__ser.readline().decode("utf-8").rstrip()
-                    # print(data)
-                    if(data == "AA55CC3301"):
-                        #send data
-                        self.__detectionLock.acquire()
-                        myPacket = V5SerialPacket(self.__MAP_PACKET_TYPE, self.__detections)
-                        self.__detectionLock.release()
-                        data = myPacket.to_Serial()
-                        self.__ser.write(data)  # Write serialized data to the serial port
+                    # Read whatever bytes arrived, waiting for at least one
+                    data = self.__ser.read(self.__ser.in_waiting or 1)
+                    pollTime = time.perf_counter()
+                    for request in parser.feed(data):
+                        if request == PollParser.REQUEST_POLL:
+                            #send data
+                            self.__write(self.__packet)  # Write the ready packet to the serial port
+                            self.pollLatency.add(time.perf_counter() - pollTime)
+                        else:
+                            self.__setPushing(request == PollParser.REQUEST_PUSH_START)
 
 
             # To close the serial port gracefully, use Ctrl+C to break the loop
@@ -205,15 +563,27 @@ class V5SerialComms:
         print("V5SerialComms thread stopped.")
 
     def setDetectionData(self, data: AIRecord):
-        # Aquire lock and set detection data
+        # Aquire lock, set detection data and encode the packet the next poll is answered with
+        # In push mode, the packet to push is encoded as well and the push thread woken up
         self.__detectionLock.acquire()
         self.__detections = data
+        self.__sequence += 1
+        self.__packet = bytes(self.__encoder.encode(self.__MAP_PACKET_TYPE, data))
+        if self.__pushing:
+            self.__encodePush()
         self.__detectionLock.release()
 
+    def isPushing(self):
+        # Returns True if the brain requested push mode
+        return self.__pushing
+
     def stop(self):
-        # Stop the thread by setting started flag to False and join the thread
+        # Stop the threads by setting started flag to False and join the threads
         self.__started = False
+        with self.__pushCondition:
+            self.__pushCondition.notify()
         self.__thread.join()
+        self.__pushThread.join()
 
     def __del__(self):
         # Destructor to call the stop method when the object is deleted
@@ -1,16 +1,105 @@
 import numpy as np
 import math
+import json
+import os
+from collections import OrderedDict
+from threading import Lock
 from V5Position import Position
 import V5Comm
 import pyrealsense2 as rs
 
+class CameraIntrinsics:
+    # Intrinsics of the color camera, which the depth image is aligned to: image size, principal point and focal
+    # length in pixels, and the distortion model and coefficients as reported by the RealSense.
+    # The defaults are the 640x480 values the detections used to be mapped with.
+    def __init__(self, width=640, height=480, ppx=320.0, ppy=240.0, fx=610.98, fy=610.98, model="none", coeffs=None):
+        self.width = width
+        self.height = height
+        self.ppx = ppx
+        self.ppy = ppy
+        self.fx = fx
+        self.fy = fy
+        self.model = model
+        self.coeffs = list(coeffs) if coeffs is not None else [0.0] * 5
+
+    @classmethod
+    def from_realsense(cls, intrinsics):
+        # Creates CameraIntrinsics from pyrealsense2 intrinsics, e.g. from a video stream profile
+        return cls(intrinsics.width, intrinsics.height, intrinsics.ppx, intrinsics.ppy, intrinsics.fx, intrinsics.fy,
+                   str(intrinsics.model).split(".")[-1], intrinsics.coeffs)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['width'], data['height'], data['ppx'], data['ppy'], data['fx'], data['fy'], data['model'],
+                   data['coeffs'])
+
+    def to_dict(self):
+        return {'width': self.width, 'height': self.height, 'ppx': self.ppx, 'ppy': self.ppy, 'fx': self.fx,
+                'fy': self.fy, 'model': self.model, 'coeffs': self.coeffs}
+
+    @classmethod
+    def from_JSON(cls, file_name):
+        # Loads in the CameraIntrinsics data from a JSON file, creates one with default values if it does not yet exist in the current directory
+        script_dir = os.path.dirname(os.path.realpath(__file__))
+        file_path = os.path.join(script_dir, file_name)
+        try:
+            with open(file_path, 'r') as f:
+                return cls.from_dict(json.load(f))
+        except (FileNotFoundError, KeyError, ValueError):
+            new_instance = cls()
+            new_instance.to_JSON(file_name)
+            return new_instance
+
+    def to_JSON(self, file_name):
+        # Writes the current CameraIntrinsics data to a JSON file next to the offsets
+        script_dir = os.path.dirname(os.path.realpath(__file__))
+        file_path = os.path.join(script_dir, file_name)
+        with open(file_path, 'w') as f:
+            json.dump(self.to_dict(), f)
+
+    def scaled(self, width, height):
+        # Return the intrinsics of the same camera for an image resized to width x height
+        scaleX = width / self.width
+        scaleY = height / self.height
+        return CameraIntrinsics(width, height, self.ppx * scaleX, self.ppy * scaleY, self.fx * scaleX, self.fy * scaleY,
+                                self.model, self.coeffs)
+
+    def getNormalizedCoordinates(self, u, v):
+        # Convert pixel coordinates to undistorted normalized image coordinates, like rs2_deproject_pixel_to_point
+        x = (u - self.ppx) / self.fx
+        y = (v - self.ppy) / self.fy
+        k1, k2, p1, p2, k3 = self.coeffs
+        if self.model == "inverse_brown_conrady":
+            r2 = x * x + y * y
+            f = 1 + k1 * r2 + k2 * r2 * r2 + k3 * r2 * r2 * r2
+            x, y = (x * f + 2 * p1 * x * y + p2 * (r2 + 2 * x * x),
+                    y * f + 2 * p2 * x * y + p1 * (r2 + 2 * y * y))
+        elif self.model == "brown_conrady":
+            # Undistort iteratively
+            x0 = x
+            y0 = y
+            for _ in range(10):
+                r2 = x * x + y * y
+                icdist = 1 / (1 + ((k3 * r2 + k2) * r2 + k1) * r2)
+                xq = x / icdist
+                yq = y / icdist
+                deltaX = 2 * p1 * xq * yq + p2 * (r2 + 2 * xq * xq)
+                deltaY = 2 * p2 * xq * yq + p1 * (r2 + 2 * yq * yq)
+                x = (x0 - deltaX) * icdist
+                y = (y0 - deltaY) * icdist
+        elif self.model not in ("none", "distortion.none"):
+            raise Exception("Invalid argument: Distortion model not accepted")
+        return x, y
+
+
 class MapPosition:
 
-    def __init__(self):
-        # Constants for camera configuration
-        self.MAXSCREENX = 320  # Half of the x framesize
-        self.MAXSCREENY = 240  # Half of the y framesize
-        self.REALDIST = 610.98  # Screen distance of the camera (focal length in pixels)
+    CACHE_SIZE = 8  # Number of poses whose rotation matrix and rotated camera offset are kept
+    FIELDSIZE = 3.6576  # Width of the 12ft field in meters, the GPS origin is the center of the field
+
+    def __init__(self, intrinsics=None):
+        # Camera intrinsics the pixel rays are computed from
+        self.intrinsics = intrinsics if intrinsics is not None else CameraIntrinsics()
         self.UNITS = "meters"
         # When x and y offsets are updated, offsets are automatically converted to meters
         self.CAMERAOFFSETX = 0 # Camera offset in default units (meters) (X-axis)
@@ -18,6 +107,18 @@ class MapPosition:
         self.CAMERAOFFSETZ = 0 # Camera offset in default units (meters) (Z-axis)
         self.CAMERAHEADINGOFFSET = 0 # Offset for camera heading in degrees (difference between GPS and front of camera)
         self.CAMERAELEVATIONOFFSET = 0 # Tilt offset of the camera
+        # Rotation matrix and rotated camera offset for recent poses, keyed by azimuth, elevation and rotation.
+        # The GPS updates less often than the camera, so consecutive frames usually share a pose.
+        # The lock guards the cache and the offsets, which the web server can change at any time.
+        self.__cache = OrderedDict()
+        self.__cacheLock = Lock()
+        self.cacheHits = 0
+        self.cacheMisses = 0
+        # Camera space rays of every pixel, keyed by image size and pixel step
+        self.__rays = {}
+        self.__raysLock = Lock()
+        # Grid of points on the field floor and above it for getFieldRegion
+        self.__fieldPoints = None
 
     def updateOffset(self, newOffset):
         # Method to update the camera offsets based on the given units
@@ -30,14 +131,24 @@ class MapPosition:
             unitDivisor = 39.3701
         elif newOffset.unit not in ("m", "meters", "M"):
             raise Exception("Invalid argument: Unit not accepted")
-        # Update the offset values
-        self.CAMERAOFFSETX = newOffset.x / unitDivisor
-        self.CAMERAOFFSETY = newOffset.y / unitDivisor
-        self.CAMERAOFFSETZ = newOffset.z / unitDivisor
-        # Heading and elevation offsets are always in degrees
-        self.CAMERAHEADINGOFFSET = newOffset.heading_offset
-        self.CAMERAELEVATIONOFFSET = newOffset.elevation_offset
-        self.__OFFSETUNITS = "meters"  # Units will always be saved as meters and converted from input units
+        # Update the offset values, cached transforms were computed with the old offsets
+        with self.__cacheLock:
+            self.CAMERAOFFSETX = newOffset.x / unitDivisor
+            self.CAMERAOFFSETY = newOffset.y / unitDivisor
+            self.CAMERAOFFSETZ = newOffset.z / unitDivisor
+            # Heading and elevation offsets are always in degrees
+            self.CAMERAHEADINGOFFSET = newOffset.heading_offset
+            self.CAMERAELEVATIONOFFSET = newOffset.elevation_offset
+            self.__OFFSETUNITS = "meters"  # Units will always be saved as meters and converted from input units
+            self.__cache.clear()
+
+    def getCacheStats(self):
+        # Return the hit and miss counters of the pose cache
+        outData = {}
+        outData['hits'] = self.cacheHits
+        outData['misses'] = self.cacheMisses
+        outData['size'] = len(self.__cache)
+        return outData
 
     def azel2rot(az, el, tw):
         # Convert azimuth, elevation, and twist to rotation matrix
@@ -61,45 +172,171 @@ class MapPosition:
         rot = np.array([[aa,ab,ac],[ba,bb,bc],[ca,cb,cc]])
         return rot
 
-    def computeMapLocation(self, detection, depth, position):
-        # Constants for calculation
-        MAXSCREENX = self.MAXSCREENX
-        MAXSCREENY = self.MAXSCREENY
-        REALDIST = self.REALDIST
-
-        CAMERAOFFSETX = self.CAMERAOFFSETX
-        CAMERAOFFSETY = self.CAMERAOFFSETY
-        CAMERAOFFSETZ = self.CAMERAOFFSETZ
-        CAMERAHEADINGOFFSET = self.CAMERAHEADINGOFFSET
-        CAMERAELEVATIONOFFSET = self.CAMERAHEADINGOFFSET
-
-        # Create a rotation matrix using azimuth, elevation, and rotation
-        rot = MapPosition.azel2rot(math.radians(position.azimuth - CAMERAHEADINGOFFSET), math.radians(position.elevation - CAMERAELEVATIONOFFSET), math.radians(position.rotation))
-        
-        # Compute the object location vector in camera space
-        vector = np.zeros(shape=(3, 1))
-        vector[0] = depth * (detection.Center[0] - MAXSCREENX) / REALDIST
-        vector[1] = depth
-        vector[2] = depth * (MAXSCREENY - detection.Center[1]) / REALDIST
-
-        # Rotate the vector to world space
+    def getRotation(self, position):
+        # Return the rotation matrix for the robot and camera pose and the camera offset rotated with it,
+        # from the cache if the pose was seen since the offsets were last updated
+        key = (position.azimuth, position.elevation, position.rotation)
+        with self.__cacheLock:
+            cached = self.__cache.get(key)
+            if cached is not None:
+                self.__cache.move_to_end(key)
+                self.cacheHits += 1
+                return cached
+            self.cacheMisses += 1
+
+            CAMERAOFFSETX = self.CAMERAOFFSETX
+            CAMERAOFFSETY = self.CAMERAOFFSETY
+            CAMERAOFFSETZ = self.CAMERAOFFSETZ
+            CAMERAHEADINGOFFSET = self.CAMERAHEADINGOFFSET
+            CAMERAELEVATIONOFFSET = self.CAMERAHEADINGOFFSET
+
+            # Create a rotation matrix using azimuth, elevation, and rotation
+            rot = MapPosition.azel2rot(math.radians(position.azimuth - CAMERAHEADINGOFFSET), math.radians(position.elevation - CAMERAELEVATIONOFFSET), math.radians(position.rotation))
+
+            # Compute and rotate the camera offset to modify the offsets to be aligned with the global coordinate system based on position and heading of robot
+            cameraOffset = np.array([CAMERAOFFSETX, CAMERAOFFSETY, CAMERAOFFSETZ])
+            rotatedCameraOffset = np.matmul(rot, cameraOffset)
+
+            # The cached arrays are shared between callers, so they must not be modified
+            rot.flags.writeable = False
+            rotatedCameraOffset.flags.writeable = False
+            self.__cache[key] = (rot, rotatedCameraOffset)
+            if len(self.__cache) > MapPosition.CACHE_SIZE:
+                self.__cache.popitem(last=False)
+            return rot, rotatedCameraOffset
+
+    def getTransform(self, position):
+        # Return the rotation matrix for the robot and camera pose, and the translation from camera space to
+        # field coordinates, which is the robot position plus the rotated camera offset.
+        # Both are the same for every detection in a frame.
+        rot, rotatedCameraOffset = self.getRotation(position)
+
+        # Translate to world coordinates, by adding current robot position on the field and the adjusted camera offset
+        # Subtract Z offset since the camera is higher than the center of the robot
+        translation = np.array([
+            position.x + rotatedCameraOffset[0],
+            position.y + rotatedCameraOffset[1],
+            position.z - rotatedCameraOffset[2],
+        ])
+        return rot, translation
+
+    def computeMapLocations(self, centers, depths, position):
+        # Compute the field coordinates of all detections of a frame at once
+        # centers is an (N, 2) array of screen coordinates in the color image, depths an (N,) array,
+        # returns an (N, 3) array
+        centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+        depths = np.asarray(depths, dtype=np.float64)
+        rot, translation = self.getTransform(position)
+
+        # Look up the ray of the nearest pixel and scale it by the depth to get the location vectors in camera space
+        width = self.intrinsics.width
+        height = self.intrinsics.height
+        column = np.clip(np.rint(centers[:, 0]).astype(np.int64), 0, width - 1)
+        row = np.clip(np.rint(centers[:, 1]).astype(np.int64), 0, height - 1)
+        vectors = self.getRays(width, height)[row * width + column] * depths[:, np.newaxis]
+
+        # Rotate the vectors to world space
         # By multiplying the relative position of the object in the screen with the information about the the perspective of the robot
         # the matrix multuplication results in the relative physical position of the object to the robot in 3D space
-        mapLocation = np.matmul(rot, vector)
+        mapLocations = np.matmul(vectors, rot.T)
+        mapLocations += translation
+        return mapLocations
+
+    def computeMapLocation(self, detection, depth, position):
+        # Compute the field coordinates of a single detection as a (3, 1) array
+        mapLocations = self.computeMapLocations([detection.Center], [depth], position)
+        return mapLocations.reshape(3, 1)
+
+    def setIntrinsics(self, intrinsics):
+        # Use new camera intrinsics, the rays are recomputed when they are next needed
+        with self.__raysLock:
+            self.intrinsics = intrinsics
+            self.__rays = {}
+
+    def getRays(self, width, height, step=1):
+        # Return the camera space rays of every step-th pixel of a width x height image as an (N, 3) array, in row order.
+        # A ray times the depth of its pixel is the position of that pixel in camera space.
+        # Images of another size than the intrinsics are treated as resized camera images.
+        # The table is stored axis by axis, so each column of the returned array is contiguous.
+        key = (width, height, step)
+        with self.__raysLock:
+            rays = self.__rays.get(key)
+            if rays is None:
+                intrinsics = self.intrinsics
+                if (width, height) != (intrinsics.width, intrinsics.height):
+                    intrinsics = intrinsics.scaled(width, height)
+                u, v = np.meshgrid(np.arange(0, width, step, dtype=np.float64), np.arange(0, height, step, dtype=np.float64))
+                x, y = intrinsics.getNormalizedCoordinates(u, v)
+                # Camera space has x to the right, y forward along the optical axis and z up
+                rays = np.empty((3, u.size))
+                rays[0] = x.ravel()
+                rays[1] = 1.0
+                rays[2] = -y.ravel()
+                rays = rays.T
+                rays.flags.writeable = False
+                self.__rays[key] = rays
+            return rays
+
+    def projectDepthImage(self, depth_image, depth_scale, position, step=1):
+        # Project every step-th pixel of an aligned depth image to field coordinates, returns an (N, 3) array.
+        # Pixels without depth (0) are left out.
+        height, width = depth_image.shape
+        rays = self.getRays(width, height, step)
+        depths = depth_image[::step, ::step].ravel()
+        valid = depths != 0
+        rot, translation = self.getTransform(position)
+
+        # Scale the rays by the depth axis by axis, on the contiguous columns of the ray table, then rotate and move
+        # them onto the field. The y axis of every ray is 1, so it is the depth itself.
+        depths = depths[valid] * depth_scale
+        vectors = np.empty((3, len(depths)))
+        np.multiply(rays[:, 0][valid], depths, out=vectors[0])
+        vectors[1] = depths
+        np.multiply(rays[:, 2][valid], depths, out=vectors[2])
+        points = np.matmul(rot, vectors)
+        points += translation[:, np.newaxis]
+        # The points are returned as a transposed view, one contiguous array per field axis
+        return points.T
 
-        # Translate to world coordinates, by adding current robot position on the field
-        mapLocation[0] += position.x
-        mapLocation[1] += position.y
-        mapLocation[2] += position.z
+    def projectFieldPoints(self, points, position):
+        # Project an (N, 3) array of field coordinates into the color image, the inverse of computeMapLocations.
+        # Returns the (N, 2) pixel coordinates and a mask of the points in front of the camera.
+        # Lens distortion is ignored.
+        rot, translation = self.getTransform(position)
+        # The rotation matrix is orthonormal, so its transpose undoes it
+        vectors = np.matmul(points - translation, rot)
+        inFront = vectors[:, 1] > 0.05
+        forward = np.where(inFront, vectors[:, 1], 1.0)
+        pixels = np.empty((len(points), 2))
+        pixels[:, 0] = self.intrinsics.ppx + self.intrinsics.fx * vectors[:, 0] / forward
+        pixels[:, 1] = self.intrinsics.ppy - self.intrinsics.fy * vectors[:, 2] / forward
+        return pixels, inFront
 
-        # Compute and rotate the camera offset to modify the offsets to be aligned with the global coordinate system based on position and heading of robot
-        cameraOffset = np.array([[CAMERAOFFSETX], [CAMERAOFFSETY], [CAMERAOFFSETZ]])
-        rotatedCameraOffset = np.matmul(rot, cameraOffset)
+    def getFieldRegion(self, position, objectHeight=0.2, margin=16, spacing=0.15):
+        # Return the part of the color image where the field floor, and objects up to objectHeight meters tall on
+        # it, can appear, as (left, top, right, bottom) pixel coordinates. Returns None if the field is not in view.
+        # The region always reaches the bottom of the image, where the floor closest to the robot is.
+        points = self.__fieldPoints
+        if points is None or points[1] != (objectHeight, spacing):
+            count = int(np.ceil(MapPosition.FIELDSIZE / spacing)) + 1
+            x, y = np.meshgrid(np.linspace(-MapPosition.FIELDSIZE / 2, MapPosition.FIELDSIZE / 2, count),
+                               np.linspace(-MapPosition.FIELDSIZE / 2, MapPosition.FIELDSIZE / 2, count))
+            floor = np.stack((x.ravel(), y.ravel(), np.zeros(x.size)), axis=1)
+            top = floor + [0.0, 0.0, objectHeight]
+            points = (np.concatenate((floor, top)), (objectHeight, spacing))
+            self.__fieldPoints = points
 
-        # Add the adjusted camera offset
-        mapLocation[0] += rotatedCameraOffset[0]
-        mapLocation[1] += rotatedCameraOffset[1]
-        mapLocation[2] -= rotatedCameraOffset[2]  # Subtract Z offset since the camera is higher than the center of the robot
-        
-        return mapLocation
+        width = self.intrinsics.width
+        height = self.intrinsics.height
+        pixels, inFront = self.projectFieldPoints(points[0], position)
+        pixels = pixels[inFront]
+        if len(pixels) == 0:
+            return None
 
+        # Points outside the image are moved onto its border, the floor between them and the points inside is in view
+        left = max(0, int(np.floor(min(pixels[:, 0].min(), width))) - margin)
+        right = min(width, int(np.ceil(max(pixels[:, 0].max(), 0))) + margin)
+        top = max(0, int(np.floor(min(pixels[:, 1].min(), height))) - margin)
+        if right - left <= 2 * margin or height - top <= 2 * margin or pixels[:, 1].max() < 0:
+            return None
+        return left, top, right, height
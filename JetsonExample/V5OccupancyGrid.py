@@ -0,0 +1,47 @@
+import numpy as np
+from threading import Lock
+
+
+class OccupancyGrid:
+    # Occupancy grid of the field built from the depth image, for obstacle avoidance.
+    # The depth image is projected to field coordinates with MapPosition, then the points are binned into square
+    # cells of the field. Only points in a height band above the floor count, so the floor itself is ignored,
+    # and a cell is occupied when it holds at least minPoints points.
+    FIELDSIZE = 3.6576  # Width of the 12ft field in meters, the GPS origin is the center of the field
+
+    def __init__(self, mapPosition, cellSize=0.1524, minHeight=0.05, maxHeight=0.6, minPoints=3, step=4):
+        self.mapPosition = mapPosition
+        self.cellSize = cellSize  # Size of a cell in meters, 6 inches by default
+        self.minHeight = minHeight  # Points lower than this in meters are treated as floor
+        self.maxHeight = maxHeight  # Points higher than this in meters are ignored
+        self.minPoints = minPoints
+        self.step = step  # Only every step-th pixel in both directions is projected
+        self.cells = int(np.ceil(OccupancyGrid.FIELDSIZE / cellSize))
+        self.counts = np.zeros((self.cells, self.cells), dtype=np.int64)
+        self.grid = np.zeros((self.cells, self.cells), dtype=np.uint8)
+        self.__lock = Lock()
+
+    def update(self, depth_image, depth_scale, position):
+        # Rebuild the grid from a depth image and the robot position it was taken at, returns the new grid.
+        # Rows of the grid follow the field y axis and columns the x axis, both starting at the field corner.
+        points = self.mapPosition.projectDepthImage(depth_image, depth_scale, position, self.step)
+
+        # Keep the points in the height band, then find the cell of each one
+        inBand = (points[:, 2] >= self.minHeight) & (points[:, 2] <= self.maxHeight)
+        points = points[inBand]
+        column = np.floor((points[:, 0] + OccupancyGrid.FIELDSIZE / 2) / self.cellSize).astype(np.int64)
+        row = np.floor((points[:, 1] + OccupancyGrid.FIELDSIZE / 2) / self.cellSize).astype(np.int64)
+        onField = (column >= 0) & (column < self.cells) & (row >= 0) & (row < self.cells)
+
+        counts = np.bincount(row[onField] * self.cells + column[onField], minlength=self.cells * self.cells)
+        counts = counts.reshape(self.cells, self.cells)
+        grid = (counts >= self.minPoints).astype(np.uint8)
+        with self.__lock:
+            self.counts = counts
+            self.grid = grid
+        return grid
+
+    def getGrid(self):
+        # Return the last grid, 1 for occupied cells and 0 for free or unseen cells
+        with self.__lock:
+            return self.grid
@@ -22,6 +22,9 @@ class Position:
     STATUS_NOSOLUTION   = 0x00000200
     STATUS_KALMAN_EST   = 0x00100000
 
+    # Binary layout of the position in the POS_RECORD of the V5 Brain
+    SERIAL_FORMAT = struct.Struct('<iiffffff')
+
     def __init__(self, frameCount: int, status: int, x: float, y: float, z: float, azimuth: float, elevation: float, rotation: float):
         # Initialization of position attributes
         self.frameCount = frameCount
@@ -35,7 +38,12 @@ class Position:
 
     def to_Serial(self):
         # Converts the position attributes to serial (binary) format
-        return struct.pack('<iiffffff', self.frameCount, self.status, self.x, self.y, self.z, self.azimuth, self.elevation, self.rotation)
+        return self.SERIAL_FORMAT.pack(self.frameCount, self.status, self.x, self.y, self.z, self.azimuth, self.elevation, self.rotation)
+
+    def pack_into(self, buffer, offset):
+        # Writes the position in serial format into buffer at offset and returns the number of bytes written
+        self.SERIAL_FORMAT.pack_into(buffer, offset, self.frameCount, self.status, self.x, self.y, self.z, self.azimuth, self.elevation, self.rotation)
+        return self.SERIAL_FORMAT.size
     
     def to_JSON(self):
         # Converts the position attributes to JSON format
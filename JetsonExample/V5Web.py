@@ -5,6 +5,7 @@ import base64
 import numpy as np
 from V5Comm import AIRecord
 from V5Position import Position
+from data_processing import CATEGORY_NUM
 from websocket_server import WebsocketServer
 import json
 import logging
@@ -13,8 +14,9 @@ import os
 # Statistics object to report info the the websocket
 class Statistics:
     # A class to contain statistics data
-    def __init__(self, fps: float, invokeTime: float, cpuTemp: float, videoWidth: int, videoHeight: int, runTime: int, gpsConnected: bool):
+    def __init__(self, fps: float, invokeTime: float, cpuTemp: float, videoWidth: int, videoHeight: int, runTime: int, gpsConnected: bool, latency: float = 0, stageTimes: dict = None):
         # Initialize statistics attributes such as FPS, CPU temperature, video dimensions, runtime, and GPS connection status
+        # Latency is the time from camera capture to publishing the detections, stageTimes the timing counters of each pipeline stage
         self.fps = fps
         self.invokeTime = invokeTime
         self.cpuTemp = cpuTemp
@@ -22,6 +24,8 @@ class Statistics:
         self.videoHeight = videoHeight
         self.runTime = runTime
         self.gpsConnected = gpsConnected
+        self.latency = latency
+        self.stageTimes = stageTimes if stageTimes is not None else {}
 
 class V5WebData:
 
@@ -44,6 +48,8 @@ class V5WebData:
             v5Pos.updateOffset(self.__gpsOffset)
         self.__v5Map = v5Map
         self.__v5Pos = v5Pos
+        # Model whose detection thresholds can be tuned from the dashboard, see setModel
+        self.__model = None
         # We host at 0.0.0.0 to broadcast to all IP addresses, so to connect from an external connection, it would be port 3030 at the IP address of the device running V5Web.py
         self.__server = WebsocketServer(host = '0.0.0.0', port = self.__serverPort, loglevel = logging.INFO) 
         self.__server.set_fn_new_client(self.__new_client)
@@ -56,6 +62,7 @@ class V5WebData:
         self.__colorImage = None 
         self.__depthImage = None 
         self.__stats = Statistics(0, 0, 0, 0, 0, 0, False)
+        self.__occupancyGrid = None
         self.__dataLock = Lock()
 
         self.__server.run_forever(True)
@@ -91,6 +98,10 @@ class V5WebData:
         outData['RunTime'] = nowStats.runTime
         outData['GPSConnected'] = nowStats.gpsConnected
         outData['CPUTempurature'] = nowStats.cpuTemp
+        outData['Latency'] = nowStats.latency
+        outData['StageTimes'] = nowStats.stageTimes
+        if(self.__model is not None):
+            outData['Thresholds'] = self.__model.get_thresholds()
 
         return outData
     
@@ -118,13 +129,27 @@ class V5WebData:
         nowObjects = self.__detections
         self.__dataLock.release()
 
-        outList = []
+        return nowObjects.detections.to_JSON()
+    
+    def __getOccupancyElement(self):
+        # Returns the occupancy grid of the field, rows follow the field y axis starting at the field corner
+        outData = {}
 
-        for detect in nowObjects.detections:
-            outList.append(detect.to_JSON())
+        self.__dataLock.acquire()
+        occupancyGrid = self.__occupancyGrid
+        self.__dataLock.release()
+
+        if(occupancyGrid is not None):
+            outData['Valid'] = True
+            outData['CellSize'] = occupancyGrid.cellSize
+            outData['Cells'] = occupancyGrid.cells
+            outData['Data'] = occupancyGrid.getGrid()
+        else:
+            outData['Valid'] = False
+            outData['Error'] = "Occupancy Grid Unavailable"
+
+        return outData
 
-        return outList
-    
     def __getColorElement(self):
         # Returns the color image data encoded in base64
         outData = {}
@@ -184,6 +209,19 @@ class V5WebData:
             # parse the new values and create a new CameraOffset instance to update the Camera Offset
             new_camera_offset = CameraOffset(*new_values)
             self.setCameraOffset(new_camera_offset)
+        elif (message.startswith("set_thresholds")):
+            # set_thresholds,<object threshold of each class>,<nms threshold>,<max detections per class>
+            outData = {}
+            outData['Command'] = "set_thresholds"
+            try:
+                obj_threshold, nms_threshold, max_detections = self.__parseThresholds(message.split(',')[1:])
+                self.setThresholds(obj_threshold, nms_threshold, max_detections)
+                outData['Valid'] = True
+                outData['Thresholds'] = self.__model.get_thresholds()
+            except ValueError as e:
+                outData['Valid'] = False
+                outData['Error'] = str(e)
+            server.send_message(client, json.dumps(outData))
         else:
             if len(message) > 200:
                 message = message[:200]+'..'
@@ -207,6 +245,8 @@ class V5WebData:
                     outData['Depth'] = self.__getDepthElement()
                 elif(cmd == "g_color"):
                     outData['Color'] = self.__getColorElement()
+                elif(cmd == "g_occupancy"):
+                    outData['Occupancy'] = self.__getOccupancyElement()
                 elif(cmd == "get_camera_offset"):
                     outData['CameraOffset'] = self.__getCameraOffset().__dict__
                 elif(cmd == "get_gps_offset"):
@@ -218,6 +258,22 @@ class V5WebData:
             # print(outData)
             server.send_message(client, json.dumps(outData))
 
+    @staticmethod
+    def __parseThresholds(values):
+        # Parse and check the values of a set_thresholds message, raises ValueError if they are not accepted
+        if len(values) != CATEGORY_NUM + 2:
+            raise ValueError("Expected %d object thresholds, an nms threshold and max detections" % CATEGORY_NUM)
+        obj_threshold = [float(value) for value in values[:CATEGORY_NUM]]
+        nms_threshold = float(values[CATEGORY_NUM])
+        max_detections = int(values[CATEGORY_NUM + 1])
+        if not all(0.0 <= value <= 1.0 for value in obj_threshold):
+            raise ValueError("Object thresholds must be between 0 and 1")
+        if not 0.0 < nms_threshold <= 1.0:
+            raise ValueError("The nms threshold must be above 0 and at most 1")
+        if max_detections < 1:
+            raise ValueError("Max detections must be at least 1")
+        return obj_threshold, nms_threshold, max_detections
+
     def convert_numpy_to_list(self, obj):
         # Helper function to convert numpy arrays to lists, recursively applied to the entire object
         if isinstance(obj, np.ndarray):
@@ -247,6 +303,12 @@ class V5WebData:
         self.__depthImage = image
         self.__dataLock.release()
 
+    def setOccupancyGrid(self, occupancyGrid):
+        # Updates the occupancy grid
+        self.__dataLock.acquire()
+        self.__occupancyGrid = occupancyGrid
+        self.__dataLock.release()
+
     def setStatistics(self, stats: Statistics):
         # Updates the statistics data
         self.__dataLock.acquire()
@@ -271,6 +333,16 @@ class V5WebData:
         self.__cameraOffset.to_JSON("camera_offsets.json")
         self.__dataLock.release()
 
+    def setModel(self, model):
+        # Sets the model whose detection thresholds are reported in the statistics and changed with set_thresholds
+        self.__model = model
+
+    def setThresholds(self, obj_threshold, nms_threshold, max_detections):
+        # Updates the detection thresholds of the model while it is running
+        if(self.__model is None):
+            raise ValueError("No model to set the thresholds of")
+        self.__model.set_thresholds(obj_threshold, nms_threshold, max_detections)
+
     def isConnected(self):
         # Checks if there are any connected clients
         return len(self.__server.clients) > 0
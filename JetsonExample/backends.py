@@ -0,0 +1,280 @@
+import abc
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+class InferenceBackend(abc.ABC):
+    # Base class for the engines that run the network on a preprocessed image.
+    # A backend owns a fixed number of slots, each with its own input and output buffers, so a new frame
+    # can be submitted to one slot while the results of another slot are still being post-processed.
+    # A backend that does not implement every abstract method cannot be created.
+    def __init__(self, slots=2):
+        self.slots = slots
+
+    @abc.abstractmethod
+    def load(self):
+        # Load the network and allocate the buffers of every slot.
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_input(self, slot):
+        # Return the host array the preprocessed image of the given slot has to be written into.
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def submit(self, slot):
+        # Start inference on the input of the given slot without waiting for the result.
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def is_done(self, slot):
+        # Return True once the outputs of the given slot are ready.
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_outputs(self, slot):
+        # Wait for the given slot to finish and return its outputs as a list of flat arrays.
+        raise NotImplementedError
+
+    def set_frame(self, slot, frame_index):
+        # Tell the backend which camera frame the input of the given slot comes from, before it is submitted.
+        # Only the replay backend uses it, to return the outputs recorded for that frame.
+        pass
+
+    def infer(self, image, slot=0):
+        # Run the network on a preprocessed NCHW image and wait for its outputs.
+        host_input = self.get_input(slot)
+        if image is not host_input:
+            np.copyto(host_input, np.ravel(image))
+        self.submit(slot)
+        return [np.copy(output) for output in self.get_outputs(slot)]
+
+    def infer_batch(self, images):
+        # Run the network on a list of preprocessed NCHW images and return the outputs of each, in order.
+        # Up to one image per slot is in flight at a time.
+        results = []
+        for start in range(0, len(images), self.slots):
+            batch = images[start:start + self.slots]
+            for slot, image in enumerate(batch):
+                np.copyto(self.get_input(slot), np.ravel(image))
+                self.submit(slot)
+            for slot in range(len(batch)):
+                results.append([np.copy(output) for output in self.get_outputs(slot)])
+        return results
+
+
+class TensorRTBackend(InferenceBackend):
+    # Runs the network with TensorRT on the GPU, every slot has its own execution context, CUDA stream
+    # and page-locked host/device buffers.
+    def __init__(self, onnx_file_path, engine_file_path, slots=2):
+        super().__init__(slots)
+        self.onnx_file_path = onnx_file_path
+        self.engine_file_path = engine_file_path
+
+    @staticmethod
+    def get_engine(onnx_file_path, engine_file_path=""):
+        # Attempts to load a pre-existing TensorRT engine, otherwise builds and returns a new one.
+        import tensorrt as trt
+        import common
+
+        # Create a logger instance for TensorRT
+        TRT_LOGGER = trt.Logger()
+
+        def build_engine():
+            print("Building engine file from onnx, this could take a while")
+            # Builds and returns a TensorRT engine from an ONNX file.
+            with trt.Builder(TRT_LOGGER) as builder, \
+                    builder.create_network(common.EXPLICIT_BATCH) as network, \
+                    builder.create_builder_config() as config, \
+                    trt.OnnxParser(network, TRT_LOGGER) as parser, \
+                    trt.Runtime(TRT_LOGGER) as runtime:
+
+                config.max_workspace_size = 1 << 28  # Set maximum workspace size to 256MiB
+                builder.max_batch_size = 1
+
+                # Check if ONNX file exists, the error lets the model fall back to another backend
+                if not os.path.exists(onnx_file_path):
+                    raise FileNotFoundError("ONNX file {} not found.".format(onnx_file_path))
+
+                # Load and parse the ONNX file
+                with open(onnx_file_path, "rb") as model:
+                    if not parser.parse(model.read()):
+                        print("ERROR: Failed to parse the ONNX file.")
+                        for error in range(parser.num_errors):
+                            print(parser.get_error(error))
+                        return None
+
+                # Set input shape for the network
+                network.get_input(0).shape = [1, 3, 320, 320]
+
+                # Build and serialize the network, then create and return the engine
+                plan = builder.build_serialized_network(network, config)
+                engine = runtime.deserialize_cuda_engine(plan)
+                with open(engine_file_path, "wb") as f:
+                    f.write(plan)
+                return engine
+
+        # Check if a serialized engine file exists and load it if so, otherwise build a new one
+        if os.path.exists(engine_file_path):
+            with open(engine_file_path, "rb") as f, trt.Runtime(TRT_LOGGER) as runtime:
+                return runtime.deserialize_cuda_engine(f.read())
+        else:
+            return build_engine()
+
+    def load(self):
+        import common
+
+        # Get the TensorRT engine
+        self.engine = TensorRTBackend.get_engine(self.onnx_file_path, self.engine_file_path)
+        if self.engine is None:
+            raise RuntimeError("Could not load the TensorRT engine")
+
+        # An execution context can only run on one stream at a time, so every slot gets its own
+        self.contexts = [self.engine.create_execution_context() for _ in range(self.slots)]
+
+        # Allocate input and output buffers and a stream for every slot
+        self.buffers = [common.allocate_buffers(self.engine) for _ in range(self.slots)]
+
+    def get_input(self, slot):
+        inputs, _, _, _ = self.buffers[slot]
+        return inputs[0].host
+
+    def submit(self, slot):
+        import common
+
+        inputs, outputs, bindings, stream = self.buffers[slot]
+        common.enqueue_inference_v2(self.contexts[slot], bindings=bindings, inputs=inputs, outputs=outputs,
+                                    stream=stream)
+
+    def is_done(self, slot):
+        _, _, _, stream = self.buffers[slot]
+        return stream.is_done()
+
+    def get_outputs(self, slot):
+        import common
+
+        _, outputs, _, stream = self.buffers[slot]
+        return common.wait_for_inference(outputs, stream)
+
+
+class OnnxRuntimeBackend(InferenceBackend):
+    # Runs the network with ONNX Runtime on the CPU, for machines without a GPU or if the TensorRT engine
+    # cannot be loaded. Inference runs on a worker thread, so submit() does not block either.
+    def __init__(self, onnx_file_path, slots=2):
+        super().__init__(slots)
+        self.onnx_file_path = onnx_file_path
+
+    def load(self):
+        import onnxruntime
+
+        self.session = onnxruntime.InferenceSession(self.onnx_file_path, providers=["CPUExecutionProvider"])
+        session_input = self.session.get_inputs()[0]
+        self.input_name = session_input.name
+        # Dynamic dimensions are fixed to the input used on the robot
+        input_shape = [dim if isinstance(dim, int) else default
+                       for dim, default in zip(session_input.shape, (1, 3, 320, 320))]
+        self.input_shape = tuple(input_shape)
+        self.inputs = [np.zeros(int(np.prod(input_shape)), dtype=np.float32) for _ in range(self.slots)]
+        self.futures = [None] * self.slots
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def get_input(self, slot):
+        return self.inputs[slot]
+
+    def submit(self, slot):
+        feed = {self.input_name: self.inputs[slot].reshape(self.input_shape)}
+        self.futures[slot] = self.executor.submit(self.session.run, None, feed)
+
+    def is_done(self, slot):
+        return self.futures[slot].done()
+
+    def get_outputs(self, slot):
+        return [np.ravel(output) for output in self.futures[slot].result()]
+
+
+class ReplayBackend(InferenceBackend):
+    # CPU stand-in for the network that returns previously recorded outputs in order, looping at the end.
+    # Outputs recorded with the index of their camera frame are paired with the frames by that index instead, see
+    # set_frame. A frame the network did not run on when recording gets the outputs of the last frame it ran on.
+    # An optional latency makes the results become ready only after that many seconds, like a GPU would.
+    def __init__(self, recorded_outputs, input_shape=(1, 3, 320, 320), slots=2, latency=0.0, recorded_frames=None):
+        super().__init__(slots)
+        self.recorded_outputs = recorded_outputs
+        self.recorded_frames = None  # Sorted camera frame index of each recorded output, if they were recorded
+        if recorded_frames is not None:
+            order = np.argsort(recorded_frames, kind="stable")
+            self.recorded_outputs = [recorded_outputs[i] for i in order]
+            self.recorded_frames = np.asarray(recorded_frames)[order]
+        self.input_shape = input_shape
+        self.latency = latency
+
+    @classmethod
+    def from_file(cls, file_path, **kwargs):
+        # Load recorded outputs saved with ReplayBackend.save.
+        return cls.from_files([file_path], **kwargs)
+
+    @classmethod
+    def from_files(cls, file_paths, **kwargs):
+        # Load recorded outputs from several files saved with ReplayBackend.save, replayed one file after the other.
+        # The frame indexes are only used if every file has them.
+        recorded_outputs = []
+        recorded_frames = []
+        for file_path in file_paths:
+            with np.load(file_path) as data:
+                names = sorted((name for name in data.files if name.startswith("output")), key=lambda n: int(n[6:]))
+                heads = [data[name] for name in names]
+                frames = data["frames"] if "frames" in data.files else None
+            recorded_outputs += [[head[frame] for head in heads] for frame in range(len(heads[0]))]
+            if recorded_frames is not None and frames is not None:
+                recorded_frames += frames.tolist()
+            else:
+                recorded_frames = None
+        if len(recorded_outputs) == 0:
+            raise Exception("Invalid argument: No recorded outputs to replay")
+        return cls(recorded_outputs, recorded_frames=recorded_frames, **kwargs)
+
+    @staticmethod
+    def save(file_path, recorded_outputs, recorded_frames=None):
+        # Save a list of frames, each a list of output arrays, so they can be replayed later.
+        # recorded_frames optionally holds the camera frame index of each of them.
+        heads = zip(*recorded_outputs)
+        arrays = {"output%d" % i: np.stack(head) for i, head in enumerate(heads)}
+        if recorded_frames is not None:
+            arrays["frames"] = np.asarray(recorded_frames, dtype=np.int64)
+        np.savez(file_path, **arrays)
+
+    def load(self):
+        size = int(np.prod(self.input_shape))
+        self.inputs = [np.zeros(size, dtype=np.float32) for _ in range(self.slots)]
+        self.results = [None] * self.slots
+        self.ready_times = [0.0] * self.slots
+        self.frame_indexes = [None] * self.slots
+        self.frame = 0
+
+    def get_input(self, slot):
+        return self.inputs[slot]
+
+    def set_frame(self, slot, frame_index):
+        self.frame_indexes[slot] = frame_index
+
+    def submit(self, slot):
+        frame_index = self.frame_indexes[slot]
+        self.frame_indexes[slot] = None
+        if self.recorded_frames is None or frame_index is None:
+            recorded = self.frame % len(self.recorded_outputs)
+        else:
+            recorded = max(0, int(np.searchsorted(self.recorded_frames, frame_index, side="right")) - 1)
+        self.results[slot] = self.recorded_outputs[recorded]
+        self.ready_times[slot] = time.monotonic() + self.latency
+        self.frame += 1
+
+    def is_done(self, slot):
+        return time.monotonic() >= self.ready_times[slot]
+
+    def get_outputs(self, slot):
+        delay = self.ready_times[slot] - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        return [np.ravel(output) for output in self.results[slot]]
@@ -0,0 +1,105 @@
+# Times a frame of 50 detections through depth, field projection, serial packet and web JSON, with the
+# original object per detection and with DetectionBatch. Measures the memory each allocates on the way, and the
+# number of memory blocks the detections of a frame take.
+# Both must give the same packet.
+# Run from the JetsonExample folder: python benchmarks/bench_batch.py
+import gc
+import struct
+import sys
+import warnings
+import numpy as np
+from bench_common import measure, report, random_detections, peak_memory
+import reference
+from bench_depth import create_processing, depth_image, DEPTH_SCALE
+from V5Comm import AIRecord, DetectionBatch, V5PacketEncoder, crc32, MAX_DETECTIONS
+from V5MapPosition import MapPosition
+from V5Position import Position
+
+POSITION = Position(1, 0, 0.5, -0.5, 0.3, 30.0, 0.0, 0.0)
+
+
+class Robot:
+    # What Processing.compute_detections needs of V5SerialComms
+    def __init__(self, mapPosition):
+        self.v5Map = mapPosition
+
+    def get_v5Pos(self):
+        return POSITION
+
+
+def old_detections(boxes, scores, classes, image, mapPosition):
+    # The detections of a frame with depth and field position, a Detection object each
+    detections = reference.draw_bboxes(boxes, scores, classes)
+    return reference.compute_detections(detections, image, DEPTH_SCALE, mapPosition, POSITION)
+
+
+def new_detections(boxes, scores, classes, image, processing, robot):
+    # The detections of a frame with depth and field position, in a DetectionBatch
+    return processing.compute_detections(robot, DetectionBatch.from_boxes(boxes, scores, classes), image)
+
+
+def old_frame(boxes, scores, classes, image, mapPosition):
+    # The original path, returns the packet payload and the web JSON
+    detections = old_detections(boxes, scores, classes, image, mapPosition)
+    payload = reference.record_to_Serial(POSITION, detections)
+    crc32(payload)
+    return payload, [detection.to_JSON() for detection in detections]
+
+
+def new_frame(boxes, scores, classes, image, processing, robot, encoder):
+    # The DetectionBatch path, returns the packet and the web JSON
+    record = new_detections(boxes, scores, classes, image, processing, robot)
+    return encoder.encode(1, record), record.detections.to_JSON()
+
+
+def retained_blocks(function):
+    # Number of memory blocks held by the result of a call
+    function()
+    gc.collect()
+    start = sys.getallocatedblocks()
+    result = function()
+    gc.collect()
+    blocks = sys.getallocatedblocks() - start
+    del result
+    return blocks
+
+
+def main():
+    warnings.simplefilter("ignore", RuntimeWarning)  # The original warns about boxes without depth
+    rng = np.random.default_rng(0)
+    image = depth_image(rng)
+    mapPosition = MapPosition()
+    processing = create_processing("mean")
+    robot = Robot(mapPosition)
+    encoder = V5PacketEncoder()
+
+    batch = random_detections(MAX_DETECTIONS, rng)
+    boxes = np.stack([batch.data[name] for name in ("centerX", "centerY", "width", "height")], axis=1).astype(np.float64)
+    scores = batch.data["probability"].astype(np.float64)
+    classes = batch.data["classID"]
+
+    # The same packet both ways, up to the float32 rounding of the depth
+    payload, _ = old_frame(boxes, scores, classes, image, mapPosition)
+    packet, _ = new_frame(boxes, scores, classes, image, processing, robot, encoder)
+    assert bytes(packet[12:48]) == payload[:36], "Count or position differ"
+    detection = struct.Struct('<iffiiiifff')
+    for old, new in zip(detection.iter_unpack(payload[36:]), detection.iter_unpack(bytes(packet[48:]))):
+        assert old[0] == new[0] and old[3:7] == new[3:7], "Class or box differ"
+        # Both are NaN without depth, which the packet carries as 0
+        np.testing.assert_allclose(np.nan_to_num(old[1:3] + old[7:]), new[1:3] + new[7:], rtol=1e-5, atol=1e-6)
+    print("Packets of {} detections match".format(MAX_DETECTIONS))
+
+    reference_time = measure(lambda: old_frame(boxes, scores, classes, image, mapPosition))
+    report("objects per detection", *reference_time)
+    report("DetectionBatch", *measure(lambda: new_frame(boxes, scores, classes, image, processing, robot, encoder)),
+           reference_time[0])
+    print("Peak memory allocated per frame: objects {:.1f} KiB, DetectionBatch {:.1f} KiB".format(
+        peak_memory(lambda: old_frame(boxes, scores, classes, image, mapPosition)),
+        peak_memory(lambda: new_frame(boxes, scores, classes, image, processing, robot, encoder))))
+    print("Memory blocks held by the detections of a frame: objects {}, DetectionBatch {}".format(
+        retained_blocks(lambda: old_detections(boxes, scores, classes, image, mapPosition)),
+        retained_blocks(lambda: new_detections(boxes, scores, classes, image, processing, robot))))
+
+
+if __name__ == "__main__":
+    main()
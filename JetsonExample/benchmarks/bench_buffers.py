@@ -0,0 +1,85 @@
+# Runs Model on 10k frames with a fake backend that owns fixed input and output buffers, like the page-locked
+# buffers of the TensorRT backend, and checks that they are never replaced or reallocated: the preprocessed
+# images are written into the input buffers and the outputs are post-processed in place.
+# Run from the JetsonExample folder: python benchmarks/bench_buffers.py [frames]
+import sys
+import time
+import numpy as np
+from bench_common import load_outputs
+from backends import InferenceBackend
+from model import Model, YOLO_CONFIG
+
+
+def address(array):
+    # Address of the first element of an array
+    return array.__array_interface__["data"][0]
+
+
+class FakeBackend(InferenceBackend):
+    # Backend that "infers" by copying random outputs into its output buffers, which are allocated once in load
+    def __init__(self, slots=4):
+        super().__init__(slots)
+        self.recorded_outputs = load_outputs(None, YOLO_CONFIG["output_shapes"], frames=16)
+        self.frame = 0
+
+    def load(self):
+        shape = (3,) + YOLO_CONFIG["yolo_input_resolution"]
+        self.inputs = [np.zeros(int(np.prod(shape)), dtype=np.float32) for _ in range(self.slots)]
+        self.outputs = [[np.zeros(int(np.prod(shape)), dtype=np.float32) for shape in YOLO_CONFIG["output_shapes"]]
+                        for _ in range(self.slots)]
+        self.addresses = [address(buffer) for buffer in self.inputs]
+        self.output_addresses = [[address(output) for output in outputs] for outputs in self.outputs]
+
+    def get_input(self, slot):
+        return self.inputs[slot]
+
+    def submit(self, slot):
+        assert address(self.inputs[slot]) == self.addresses[slot], "Input buffer was reallocated"
+        for output, recorded in zip(self.outputs[slot], self.recorded_outputs[self.frame % len(self.recorded_outputs)]):
+            np.copyto(output, np.ravel(recorded))
+        self.frame += 1
+
+    def is_done(self, slot):
+        return True
+
+    def get_outputs(self, slot):
+        return self.outputs[slot]
+
+
+def main():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    backend = FakeBackend()
+    model = Model(backend=backend)
+    inputs = list(backend.inputs)
+    outputs = [list(slot) for slot in backend.outputs]
+
+    # The outputs are only reshaped into views for post-processing
+    def check_outputs(raw_outputs, frame_index):
+        for output, shape in zip(raw_outputs, model.output_shapes):
+            assert np.shares_memory(model.postprocessor._reshape_output(output.reshape(shape)), output), "Output was copied"
+    model.on_outputs = check_outputs
+
+    rng = np.random.default_rng(0)
+    images = [rng.integers(0, 256, (480, 640, 3), dtype=np.uint8) for _ in range(4)]
+    start = time.perf_counter()
+    for frame in range(frames):
+        image = images[frame % len(images)]
+        # Mix single frames, frames in flight in all slots and frames with a region of interest
+        if frame % 3 == 0:
+            model.inference(image, roi=(160, 120, 480, 360) if frame % 2 else None)
+        elif not model.submit(image):
+            model.poll(block=True)
+            model.submit(image)
+        for slot in range(backend.slots):
+            assert backend.inputs[slot] is inputs[slot] and address(inputs[slot]) == backend.addresses[slot]
+            assert all(a is b for a, b in zip(backend.outputs[slot], outputs[slot]))
+            assert [address(output) for output in outputs[slot]] == backend.output_addresses[slot]
+    while model.poll(block=True) is not None:
+        pass
+    elapsed = time.perf_counter() - start
+    print("{} frames through {} slots without reallocating a buffer, {:.2f} ms per frame".format(
+        frames, backend.slots, elapsed / frames * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# Helpers shared by the benchmark scripts in this folder.
+# The scripts are run directly from the JetsonExample folder, e.g. python benchmarks/bench_crc32.py
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+# Make the modules of the JetsonExample folder importable
+JETSON_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if JETSON_FOLDER not in sys.path:
+    sys.path.insert(0, JETSON_FOLDER)
+
+from V5Comm import DetectionBatch
+from backends import ReplayBackend
+from recording import SessionReader
+
+
+def measure(function, repeat=200, warmup=5):
+    # Call function repeat times after a few warmup calls, returns the average and the 99th percentile time of one
+    # call in milliseconds
+    for _ in range(warmup):
+        function()
+    times = np.empty(repeat)
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        times[i] = time.perf_counter() - start
+    return times.mean() * 1000, np.percentile(times, 99) * 1000
+
+
+def report(name, average, p99, reference=None):
+    # Print the timing of one case, with the speedup over the reference average if there is one
+    line = "{:<40} average: {:8.3f} ms, p99: {:8.3f} ms".format(name, average, p99)
+    if reference is not None:
+        line += ", speedup: {:6.1f}x".format(reference / average)
+    print(line)
+
+
+def peak_memory(function, repeat=20):
+    # Largest amount of memory in KiB allocated at once during a call, after a warmup call
+    function()
+    tracemalloc.start()
+    peak = 0
+    for _ in range(repeat):
+        tracemalloc.reset_peak()
+        start, _ = tracemalloc.get_traced_memory()
+        function()
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - start)
+    tracemalloc.stop()
+    return peak / 1024
+
+
+def random_detections(count, rng, width=640, height=480):
+    # A DetectionBatch of count random detections inside an image of the given size, with depth and map location
+    boxWidth = rng.integers(10, 120, count)
+    boxHeight = rng.integers(10, 120, count)
+    x = rng.integers(0, width - boxWidth)
+    y = rng.integers(0, height - boxHeight)
+    boxes = np.stack((x, y, boxWidth, boxHeight), axis=1).astype(np.float64)
+    batch = DetectionBatch.from_boxes(boxes, rng.random(count), rng.integers(0, 3, count))
+    data = batch.data
+    data["depth"] = rng.uniform(0.3, 4.0, count)
+    data["mapX"] = rng.uniform(-1.8, 1.8, count)
+    data["mapY"] = rng.uniform(-1.8, 1.8, count)
+    data["mapZ"] = rng.uniform(0.0, 0.2, count)
+    return batch
+
+
+def load_outputs(path, output_shapes, frames=100, seed=0):
+    # Network outputs to post-process, as a list of frames that each hold one NCHW array per head.
+    # path is a file saved with ReplayBackend.save or a session recorded with --record; without a path, random
+    # outputs are made in which a few anchors of every frame pass the detection thresholds.
+    if path is not None:
+        if os.path.isdir(path):
+            backend = ReplayBackend.from_files(SessionReader(path).output_files())
+        else:
+            backend = ReplayBackend.from_file(path)
+        return [[np.reshape(output, shape) for output, shape in zip(outputs, output_shapes)]
+                for outputs in backend.recorded_outputs]
+    rng = np.random.default_rng(seed)
+    return [[rng.normal(-3.0, 2.5, shape).astype(np.float32) for shape in output_shapes] for _ in range(frames)]
@@ -0,0 +1,85 @@
+# Checks the zlib based crc32 of V5Comm.py against the table based implementation it replaced, which computes the
+# MSB-first CRC32 the brain expects, on random buffers of varying lengths and accumulators.
+# Then times encoding a packet with 0, 10 and 50 detections, the old way and with V5PacketEncoder.
+# Run from the JetsonExample folder: python benchmarks/bench_crc32.py
+import struct
+import numpy as np
+from bench_common import measure, report, random_detections
+from V5Comm import crc32, AIRecord, V5PacketEncoder
+from V5Position import Position
+
+POLYNOMIAL_CRC32 = 0x04C11DB7
+
+
+def build_table():
+    # CRC32 table of the original AIRecord, one entry per byte value
+    table = []
+    for i in range(256):
+        crc_accum = i << 24
+        for _ in range(8):
+            if crc_accum & 0x80000000:
+                crc_accum = (crc_accum << 1) ^ POLYNOMIAL_CRC32
+            else:
+                crc_accum = crc_accum << 1
+        table.append(crc_accum)
+    return table
+
+CRC32_TABLE = build_table()
+
+
+def table_crc32(data, accumulator=0):
+    # The original byte by byte CRC32 calculation
+    for byte in data:
+        i = ((accumulator >> 24) ^ byte) & 0xFF
+        accumulator = (accumulator << 8) ^ CRC32_TABLE[i]
+    return accumulator & 0xFFFFFFFF
+
+
+def table_packet(type, record):
+    # The original packet encoding: the record is packed field by field, twice, and checked byte by byte
+    def to_Serial():
+        data = struct.pack('<i', len(record.detections))
+        data += record.position.to_Serial()
+        for det in record.detections:
+            screen = det.screenLocation
+            location = det.mapLocattion
+            data += struct.pack('<iff', det.classID, det.probability, det.depth)
+            data += struct.pack('<iiii', screen.x, screen.y, screen.width, screen.height)
+            data += struct.pack('<fff', location.x, location.y, location.z)
+        return data
+    data = bytearray([0xAA, 0x55, 0xCC, 0x33])
+    data += struct.pack('<HHI', len(to_Serial()), type, table_crc32(to_Serial()))
+    data += to_Serial()
+    return data
+
+
+def check_crc32(rng, count=2000, maxLength=512):
+    # Compare both implementations on random buffers, half of them continuing from a random accumulator
+    for _ in range(count):
+        data = rng.integers(0, 256, rng.integers(0, maxLength + 1), dtype=np.uint8).tobytes()
+        accumulator = int(rng.integers(0, 1 << 32)) if rng.random() < 0.5 else 0
+        expected = table_crc32(data, accumulator)
+        assert crc32(data, accumulator) == expected, (data.hex(), accumulator)
+        assert crc32(memoryview(bytearray(data)), accumulator) == expected
+        # Splitting a buffer and passing the first CRC as the accumulator gives the CRC of the whole buffer
+        split = len(data) // 2
+        assert crc32(data[split:], crc32(data[:split], accumulator)) == expected
+    print("crc32 matches the table implementation on {} random buffers of 0 to {} bytes".format(count, maxLength))
+
+
+def main():
+    rng = np.random.default_rng(0)
+    check_crc32(rng)
+
+    position = Position(1, 0, 0.5, -0.5, 0.1, 90.0, 0.0, 0.0)
+    encoder = V5PacketEncoder()
+    for count in (0, 10, 50):
+        record = AIRecord(position, random_detections(count, rng))
+        assert bytes(encoder.encode(1, record)) == bytes(table_packet(1, record)), count
+        old = measure(lambda: table_packet(1, record), repeat=100)
+        report("table packet, {} detections".format(count), *old)
+        report("V5PacketEncoder, {} detections".format(count), *measure(lambda: encoder.encode(1, record)), old[0])
+
+
+if __name__ == "__main__":
+    main()
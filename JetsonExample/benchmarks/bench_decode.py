@@ -0,0 +1,67 @@
+# Checks the NumPy decode of the YOLO outputs in PostprocessYOLO against the original np.vectorize decode and times
+# both, on recorded network outputs or on random ones.
+# Run from the JetsonExample folder: python benchmarks/bench_decode.py [outputs.npz or recorded session]
+import itertools
+import sys
+import numpy as np
+from bench_common import measure, report, load_outputs
+import reference
+from data_processing import PostprocessYOLO
+from model import YOLO_CONFIG
+
+
+def create(cls, **kwargs):
+    # A post-processor with the settings of the default model
+    return cls(yolo_masks=YOLO_CONFIG["yolo_masks"], yolo_anchors=YOLO_CONFIG["yolo_anchors"],
+               obj_threshold=YOLO_CONFIG["obj_threshold"], nms_threshold=YOLO_CONFIG["nms_threshold"],
+               yolo_input_resolution=YOLO_CONFIG["yolo_input_resolution"], **kwargs)
+
+
+def decode(postprocessor, outputs, sparse=False):
+    # Decode and filter the boxes of all heads of a frame, without NMS
+    results = []
+    for output, mask in zip(outputs, postprocessor.masks):
+        output = postprocessor._reshape_output(output)
+        if sparse:
+            results.append(postprocessor._process_feats_sparse(output, mask))
+        else:
+            results.append(postprocessor._filter_boxes(*postprocessor._process_feats(output, mask)))
+    return results
+
+
+def check(old, new, frames):
+    # The dense decode must match the original one, and both the dense and sparse paths must keep the same boxes
+    kept = 0
+    for outputs in frames:
+        for output, mask in zip(outputs, new.masks):
+            expected = old._process_feats(old._reshape_output(output), mask)
+            result = new._process_feats(new._reshape_output(output), mask)
+            for a, b in zip(expected, result):
+                np.testing.assert_allclose(b, a, rtol=1e-5, atol=1e-6)
+        expected = decode(old, outputs)
+        for sparse in (False, True):
+            for (boxes, classes, scores), (old_boxes, old_classes, old_scores) in zip(decode(new, outputs, sparse), expected):
+                np.testing.assert_array_equal(classes, old_classes)
+                np.testing.assert_allclose(boxes, old_boxes, rtol=1e-5, atol=1e-6)
+                np.testing.assert_allclose(scores, old_scores, rtol=1e-5, atol=1e-6)
+        kept += sum(len(classes) for _, classes, _ in expected)
+    print("Decode matches the original on {} frames, {} boxes passed the thresholds".format(len(frames), kept))
+
+
+def main():
+    frames = load_outputs(sys.argv[1] if len(sys.argv) > 1 else None, YOLO_CONFIG["output_shapes"])
+    old = create(reference.PostprocessYOLO)
+    new = create(PostprocessYOLO)
+    check(old, new, frames)
+
+    def run(postprocessor, sparse=False):
+        # Decode the next frame on every call
+        frame = itertools.cycle(frames)
+        return lambda: decode(postprocessor, next(frame), sparse)
+    reference_time = measure(run(old), repeat=len(frames))
+    report("np.vectorize decode", *reference_time)
+    report("NumPy decode", *measure(run(new), repeat=10 * len(frames)), reference_time[0])
+    report("NumPy sparse decode", *measure(run(new, True), repeat=10 * len(frames)), reference_time[0])
+
+if __name__ == "__main__":
+    main()
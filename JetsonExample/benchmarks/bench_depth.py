@@ -0,0 +1,101 @@
+# Checks the depth of all detections of a frame computed in one pass by Processing.get_depths against the
+# original per-detection get_depth, and times both at 1, 10 and 50 detections.
+# Fewer than Processing.SMALL_BATCH detections take the per-region path, both paths are checked.
+# Run from the JetsonExample folder: python benchmarks/bench_depth.py
+import warnings
+import numpy as np
+from bench_common import measure, report, random_detections
+import reference
+from model import rawDetection
+from overunder import Processing
+
+DEPTH_SCALE = 0.001
+
+
+def create_processing(depth_method):
+    # Processing for the depth only, without starting the RealSense alignment or loading the network
+    processing = Processing.__new__(Processing)
+    processing.depth_scale = DEPTH_SCALE
+    processing.depth_method = depth_method
+    processing.trim_fraction = 0.1
+    return processing
+
+
+def depth_image(rng, width=640, height=480):
+    # Depth in millimeters with about 10% of the pixels missing, and a region without any depth
+    image = rng.integers(300, 4000, (height, width)).astype(np.uint16)
+    image[rng.random((height, width)) < 0.1] = 0
+    image[:100, :100] = 0
+    return image
+
+
+def raw_detections(batch):
+    # The rawDetection objects the original code took
+    data = batch.data
+    return [rawDetection(int(row["x"]), int(row["y"]), [row["centerX"], row["centerY"]], int(row["width"]),
+                         int(row["height"]), float(row["probability"]), int(row["classID"])) for row in data]
+
+
+def expected_depths(batch, image, method, trim_fraction=0.1):
+    # Depth of each detection computed on its own, NaN without valid pixels
+    depths = []
+    for row in batch.data:
+        x, y, width, height = (int(row[name]) for name in ("x", "y", "width", "height"))
+        values = image[y + height * 45 // 100:y + height * 55 // 100, x + width * 45 // 100:x + width * 55 // 100]
+        values = np.sort(values[values != 0]).astype(np.float64)
+        if len(values) == 0:
+            depths.append(np.nan)
+        elif method == "mean":
+            depths.append(values.mean())
+        elif method == "median":
+            depths.append(np.median(values))
+        else:
+            trim = int(len(values) * trim_fraction)
+            depths.append(values[trim:len(values) - trim].mean())
+    return np.array(depths) * DEPTH_SCALE
+
+
+def check(rng):
+    # All methods must match the depth computed per detection, and the mean must match the original get_depth.
+    # Boxes too small to have a middle 10%, or in the region without depth, get NaN.
+    for i in range(60):
+        image = depth_image(rng)
+        batch = random_detections((3, Processing.SMALL_BATCH - 1, 50)[i % 3], rng)
+        batch.data["x"][:3] = 20
+        batch.data["y"][:3] = 20
+        batch.data["width"][0] = 5
+        for method in Processing.DEPTH_METHODS:
+            depths = create_processing(method).get_depths(batch, image)
+            np.testing.assert_allclose(depths, expected_depths(batch, image, method), rtol=1e-9)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)  # The original warns about empty regions
+            original = [reference.get_depth(detection, image, DEPTH_SCALE) for detection in raw_detections(batch)]
+        np.testing.assert_allclose(create_processing("mean").get_depths(batch, image), original, rtol=1e-9)
+    for trim_fraction in (-0.1, 0.5):
+        try:
+            Processing(DEPTH_SCALE, depth_method="trimmed_mean", trim_fraction=trim_fraction)
+        except ValueError:
+            continue
+        raise AssertionError("trim_fraction {} accepted".format(trim_fraction))
+    print("Depths match the per-detection depths for all methods, and the original get_depth for the mean")
+
+
+def main():
+    rng = np.random.default_rng(0)
+    check(rng)
+    warnings.simplefilter("ignore", RuntimeWarning)
+
+    image = depth_image(rng)
+    for count in (1, 10, 50):
+        batch = random_detections(count, rng)
+        detections = raw_detections(batch)
+        print("{} detections".format(count))
+        reference_time = measure(lambda: [reference.get_depth(detection, image, DEPTH_SCALE) for detection in detections])
+        report("  original get_depth", *reference_time)
+        for method in Processing.DEPTH_METHODS:
+            processing = create_processing(method)
+            report("  get_depths, " + method, *measure(lambda: processing.get_depths(batch, image)), reference_time[0])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# Checks the NMS of PostprocessYOLO, with its per-class thresholds and detection limits, against the original
+# per-class NMS loop and times both on synthetic dense scenes: clusters of overlapping candidate boxes around each
+# object, like a pile of triballs.
+# Run from the JetsonExample folder: python benchmarks/bench_nms.py
+import numpy as np
+from bench_common import measure, report
+import reference
+from data_processing import PostprocessYOLO, CATEGORY_NUM
+from bench_decode import create
+
+
+def dense_scene(candidates, rng, per_object=20, width=640, height=480):
+    # Boxes in pixels as (left, top, width, height), with their classes and confidences.
+    # Every object gets per_object candidates jittered around it, and objects overlap each other as well.
+    objects = max(1, candidates // per_object)
+    centers = rng.uniform((40, 40), (width - 40, height - 40), (objects, 2))
+    sizes = rng.uniform(30, 80, objects)
+    owner = rng.integers(0, objects, candidates)
+    size = sizes[owner, np.newaxis] * rng.uniform(0.8, 1.2, (candidates, 2))
+    center = centers[owner] + rng.normal(0, 0.15, (candidates, 2)) * size
+    boxes = np.concatenate((center - size / 2, size), axis=1)
+    classes = rng.integers(0, CATEGORY_NUM, objects)[owner]
+    confidences = rng.uniform(0.4, 1.0, candidates)
+    return boxes, classes, confidences
+
+
+def old_nms(postprocessor, boxes, categories, confidences):
+    # The per-class loop of the original _process_yolo_output, returning the indexes of the kept boxes
+    keep = []
+    for category in set(categories):
+        idxs = np.where(categories == category)[0]
+        keep.append(idxs[postprocessor._nms_boxes(boxes[idxs], confidences[idxs])])
+    return np.concatenate(keep)
+
+
+def check(old, new, rng):
+    # The NMS must keep the same boxes as the original, ordered by confidence
+    for candidates in (1, 2, 10, 50, 200, 400, 1000):
+        for _ in range(10):
+            boxes, classes, confidences = dense_scene(candidates, rng)
+            expected = np.sort(old_nms(old, boxes, classes, confidences))
+            keep = new._nms_boxes_per_class(boxes, classes, confidences)
+            np.testing.assert_array_equal(np.sort(keep), expected)
+            assert np.all(np.diff(confidences[keep]) <= 0), "Kept boxes are not ordered by confidence"
+
+    # The caps keep the most confident boxes of the uncapped result
+    boxes, classes, confidences = dense_scene(400, rng)
+    keep = new._nms_boxes_per_class(boxes, classes, confidences)
+    capped = create(PostprocessYOLO, max_detections=2, top_k=4)
+    result = capped._nms_boxes_per_class(boxes, classes, confidences)
+    assert len(result) <= 4 and np.all(np.bincount(classes[result], minlength=CATEGORY_NUM) <= 2)
+    assert set(result) <= set(keep)
+    print("NMS matches the original per-class NMS on dense scenes of 1 to 1000 candidates")
+
+
+def main():
+    rng = np.random.default_rng(0)
+    old = create(reference.PostprocessYOLO)
+    new = create(PostprocessYOLO)
+    check(old, new, rng)
+
+    for candidates in (10, 50, 100, 200, 400, 800):
+        boxes, classes, confidences = dense_scene(candidates, rng)
+        kept = len(new._nms_boxes_per_class(boxes, classes, confidences))
+        print("{} candidates, {} kept".format(candidates, kept))
+        reference_time = measure(lambda: old_nms(old, boxes, classes, confidences), repeat=50)
+        report("  original NMS", *reference_time)
+        report("  NMS with limits", *measure(lambda: new._nms_boxes_per_class(boxes, classes, confidences), repeat=50),
+               reference_time[0])
+
+
+if __name__ == "__main__":
+    main()
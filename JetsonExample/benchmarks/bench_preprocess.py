@@ -0,0 +1,130 @@
+# Checks the preprocessing of Model, which resizes the camera image with OpenCV first and then enhances the small
+# image with the HSV lookup tables, against the original chain, which enhanced the full image and resized it with
+# PIL, and times both. Measures the memory each allocates per frame as well.
+# The two chains resize and round differently, so the network inputs are compared within a tolerance.
+# Also checks that the letterbox of --roi zooms in further on smaller regions, such as the field seen from the robot.
+# Run from the JetsonExample folder: python benchmarks/bench_preprocess.py [recorded session]
+import itertools
+import sys
+import numpy as np
+from bench_common import measure, report, peak_memory
+import reference
+from data_processing import PreprocessYOLO
+from model import Model, YOLO_CONFIG
+from recording import SessionReader
+from V5MapPosition import MapPosition, CameraIntrinsics
+from V5Position import Position
+
+MEAN_TOLERANCE = 0.01  # Largest mean absolute difference of a network input, the inputs are in [0, 1]
+PIXEL_TOLERANCE = 0.05  # Largest difference of 99% of the input values, the rest are on sharp edges
+CAMERA = Position(1, 1, -1.0, 0.2, 0.3, 30.0, 0.0, 0.0)  # 30cm above the floor, level
+
+
+def create_preprocessor():
+    # The PreprocessYOLO of Model with its enhancement, without loading the network
+    model = Model.__new__(Model)
+    model.hsv_enhancement = None
+    model.set_enhancement(*YOLO_CONFIG["hsv_enhancement"])
+    model._hsv_image = None
+    model._enhanced_image = None
+    return PreprocessYOLO(YOLO_CONFIG["yolo_input_resolution"], enhance=model.image_processing)
+
+
+def synthetic_images(count, rng, width=640, height=480):
+    # BGR camera images of a field: a smooth floor with noise and colored discs of triball size
+    v, u = np.mgrid[0:height, 0:width]
+    images = []
+    for _ in range(count):
+        image = np.empty((height, width, 3))
+        image[...] = rng.uniform(60, 160, 3) + (v / height * 60)[..., np.newaxis]
+        for _ in range(rng.integers(3, 12)):
+            x, y = rng.uniform(0, width), rng.uniform(height / 3, height)
+            radius = rng.uniform(10, 60)
+            image[(u - x) ** 2 + (v - y) ** 2 < radius ** 2] = rng.uniform(0, 255, 3)
+        image += rng.normal(0, 6, image.shape)
+        images.append(np.clip(image, 0, 255).astype(np.uint8))
+    return images
+
+
+def load_images(path, rng, frames=20):
+    # Color images of a session recorded with --record, or synthetic ones without a path
+    if path is None:
+        return synthetic_images(frames, rng)
+    return [color for _, _, color, _ in itertools.islice(SessionReader(path), frames)]
+
+
+def check(preprocessor, images):
+    # The network input of every image must be close to the original one
+    resolution = YOLO_CONFIG["yolo_input_resolution"]
+    worst_mean = 0.0
+    for image in images:
+        expected = reference.preprocess(image, resolution)
+        _, result = preprocessor.process(image)
+        assert result.shape == expected.shape and result.dtype == expected.dtype
+        difference = np.abs(result - expected)
+        mean = difference.mean()
+        pixel = np.percentile(difference, 99)
+        assert mean <= MEAN_TOLERANCE, "Mean difference {:.4f}".format(mean)
+        assert pixel <= PIXEL_TOLERANCE, "Pixel difference {:.4f}".format(pixel)
+        worst_mean = max(worst_mean, mean)
+    print("Network inputs of {} images match the original preprocessing, largest mean difference {:.4f}".format(
+        len(images), worst_mean))
+
+
+def get_zoom(preprocessor, shape, roi):
+    # Zoom of the letterbox for the region relative to resizing the whole image, and the image rows it keeps
+    height = shape[0]
+    input_height = YOLO_CONFIG["yolo_input_resolution"][0]
+    letterbox = preprocessor.get_letterbox(shape, roi)
+    if letterbox is None:
+        return 1.0, (0, height)
+    scale_y, offset_y = letterbox[1], letterbox[3]
+    return scale_y * height / input_height, (-offset_y / scale_y, (input_height - offset_y) / scale_y)
+
+
+def check_letterbox(preprocessor):
+    # Regions as wide as the image, as getFieldRegion returns them, must be zoomed in further the lower they are
+    # and stay in view from top to bottom, up to the full camera resolution
+    shape = (480, 640, 3)
+    limit = max(shape[1] / YOLO_CONFIG["yolo_input_resolution"][1], shape[0] / YOLO_CONFIG["yolo_input_resolution"][0])
+    last = 0.0
+    for top in (0, 80, 160, 240, 320):
+        zoom, (view_top, view_bottom) = get_zoom(preprocessor, shape, (0, top, shape[1], shape[0]))
+        assert zoom > last or zoom == limit, "Region from row {} is zoomed {:.2f}x".format(top, zoom)
+        assert zoom <= limit + 1e-9
+        assert view_top <= top + 1e-6 and view_bottom >= shape[0] - 1e-6, "Region from row {} is cropped".format(top)
+        last = zoom
+
+    # The field seen by a level camera leaves out the top half of the image
+    mapPosition = MapPosition(CameraIntrinsics())
+    roi = mapPosition.getFieldRegion(CAMERA)
+    zoom, _ = get_zoom(preprocessor, shape, roi)
+    assert zoom > 1.0, "Field region {} is not zoomed in".format(roi)
+    print("Field region {} is zoomed {:.2f}x, the full image 1.00x".format(roi, zoom))
+
+
+def main():
+    rng = np.random.default_rng(0)
+    images = load_images(sys.argv[1] if len(sys.argv) > 1 else None, rng)
+    preprocessor = create_preprocessor()
+    check(preprocessor, images)
+    check_letterbox(preprocessor)
+
+    resolution = YOLO_CONFIG["yolo_input_resolution"]
+    out = np.empty((1, 3) + tuple(resolution), dtype=np.float32)
+
+    def run(function):
+        # Preprocess the next image on every call
+        image = itertools.cycle(images)
+        return lambda: function(next(image))
+    old = run(lambda image: reference.preprocess(image, resolution))
+    new = run(lambda image: preprocessor.process(image, out))
+    reference_time = measure(old)
+    report("PIL preprocessing", *reference_time)
+    report("OpenCV preprocessing", *measure(new), reference_time[0])
+    # PIL allocates outside of the Python allocator, so the original chain's resized image is not counted
+    print("Peak memory allocated per frame: PIL {:.1f} KiB, OpenCV {:.1f} KiB".format(peak_memory(old), peak_memory(new)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+# Tests the projection of whole depth images onto the field and the occupancy grid on synthetic depth images,
+# rendered from a camera looking over a flat floor at a wall, and times both.
+# Run from the JetsonExample folder: python benchmarks/bench_projection.py
+import numpy as np
+from bench_common import measure, report
+from V5MapPosition import MapPosition, CameraIntrinsics
+from V5OccupancyGrid import OccupancyGrid
+from V5Position import Position
+
+DEPTH_SCALE = 0.001
+CAMERA = Position(1, 0, -1.0, 0.2, 0.3, 30.0, 0.0, 0.0)  # 30cm above the floor, level
+WALL_DISTANCE = 1.2  # Distance of the wall in front of the camera
+WALL_WIDTH = 0.6
+WALL_HEIGHT = 0.3
+MAX_DEPTH = 10.0  # Farther pixels have no depth, like on the RealSense
+
+
+def render(mapPosition, width, height, wall=True, rng=None):
+    # Depth image in millimeters of the floor and, in front of the camera, a wall of WALL_WIDTH x WALL_HEIGHT.
+    # Pixels that see neither within MAX_DEPTH have no depth, as do random pixels if rng is given.
+    # Returns the image, the center of the wall's foot on the field and the direction along the wall.
+    rot, translation = mapPosition.getTransform(CAMERA)
+    rays = np.matmul(mapPosition.getRays(width, height), rot.T)  # Field direction of each pixel, per unit depth
+    depth = np.full(len(rays), np.inf)
+
+    # Floor, z = 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        floor = -translation[2] / rays[:, 2]
+    depth = np.where(floor > 0, floor, depth)
+
+    # The wall faces the camera, its normal is the horizontal viewing direction
+    forward = rot[:, 1] * [1.0, 1.0, 0.0]
+    forward /= np.linalg.norm(forward)
+    along = np.array([-forward[1], forward[0], 0.0])
+    foot = translation + forward * WALL_DISTANCE
+    foot[2] = 0.0
+    if wall:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            distance = WALL_DISTANCE / np.matmul(rays, forward)
+        points = translation + rays * distance[:, np.newaxis]
+        onWall = (distance > 0) & (np.abs(np.matmul(points - foot, along)) <= WALL_WIDTH / 2) & \
+                 (points[:, 2] >= 0) & (points[:, 2] <= WALL_HEIGHT)
+        depth = np.where(onWall & (distance < depth), distance, depth)
+
+    image = np.where(depth <= MAX_DEPTH, np.rint(depth / DEPTH_SCALE), 0).astype(np.uint16).reshape(height, width)
+    if rng is not None:
+        image[rng.random(image.shape) < 0.05] = 0
+    return image, foot, along
+
+
+def check(rng):
+    mapPosition = MapPosition(CameraIntrinsics())
+
+    # A floor alone projects onto z = 0, up to the millimeter steps of the depth
+    image, _, _ = render(mapPosition, 640, 480, wall=False, rng=rng)
+    for step in (1, 2, 4):
+        points = mapPosition.projectDepthImage(image, DEPTH_SCALE, CAMERA, step)
+        assert len(points) == np.count_nonzero(image[::step, ::step])
+        assert np.abs(points[:, 2]).max() < 0.005, "Floor points are off the floor"
+
+    # Every projected pixel is where computeMapLocations puts a detection at that pixel and depth
+    image, foot, along = render(mapPosition, 640, 480, rng=rng)
+    rows, cols = np.nonzero(image)
+    expected = mapPosition.computeMapLocations(np.stack((cols, rows), axis=1), image[rows, cols] * DEPTH_SCALE, CAMERA)
+    np.testing.assert_allclose(mapPosition.projectDepthImage(image, DEPTH_SCALE, CAMERA), expected, atol=1e-9)
+
+    # Only the cells along the wall's foot are occupied, the floor is not
+    occupancy = OccupancyGrid(mapPosition)
+    grid = occupancy.update(image, DEPTH_SCALE, CAMERA)
+    rows, cols = np.nonzero(grid)
+    centers = (np.stack((cols, rows), axis=1) + 0.5) * occupancy.cellSize - OccupancyGrid.FIELDSIZE / 2
+    offsets = centers - foot[:2]
+    assert len(rows) > 0, "The wall is not in the grid"
+    assert np.abs(np.matmul(offsets, along[:2])).max() <= WALL_WIDTH / 2 + occupancy.cellSize
+    assert np.abs(np.matmul(offsets, np.array([along[1], -along[0]]))).max() <= occupancy.cellSize
+    wallCells = int(WALL_WIDTH // occupancy.cellSize)
+    assert len(rows) >= wallCells, "Too few wall cells occupied"
+    print("Synthetic floor projects onto the floor, {} cells along the wall are occupied".format(len(rows)))
+
+
+def main():
+    rng = np.random.default_rng(0)
+    check(rng)
+
+    for width, height in ((640, 480), (848, 480)):
+        mapPosition = MapPosition(CameraIntrinsics().scaled(width, height))
+        image, _, _ = render(mapPosition, width, height, rng=rng)
+        print("{}x{} depth image".format(width, height))
+        for step in (1, 2, 4):
+            report("  projectDepthImage, step {}".format(step),
+                   *measure(lambda: mapPosition.projectDepthImage(image, DEPTH_SCALE, CAMERA, step), repeat=50))
+        occupancy = OccupancyGrid(mapPosition)
+        report("  OccupancyGrid.update, step {}".format(occupancy.step),
+               *measure(lambda: occupancy.update(image, DEPTH_SCALE, CAMERA), repeat=50))
+
+
+if __name__ == "__main__":
+    main()
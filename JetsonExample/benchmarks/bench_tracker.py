@@ -0,0 +1,172 @@
+# Tests the accuracy of the Tracker on a scripted match replayed frame by frame, objects with known positions and
+# velocities that are detected with noise and missed at times, and times Tracker.update at 30 objects.
+# With a session recorded with --record (including the network outputs), the recorded frames are replayed through
+# the model, the depth and the field projection as well, and the tracker is timed on those detections.
+# Run from the JetsonExample folder: python benchmarks/bench_tracker.py [recorded session]
+import os
+import sys
+import numpy as np
+from bench_common import measure, report
+from model import Model
+from overunder import Processing
+from recording import SessionReader
+from tracker import Tracker
+from V5Comm import AIRecord, DetectionBatch, DETECTION_DTYPE
+from V5MapPosition import MapPosition, CameraIntrinsics
+from V5Position import Position
+
+FRAME_TIME = 1.0 / 30
+FIELD = 3.6576 / 2  # Half the width of the field, objects bounce off its walls
+POSITION = Position(0, 0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+
+
+class ScriptedMatch:
+    # Objects moving at constant velocity on the field, bouncing off the walls. They start at least 0.4m apart,
+    # but pass through each other when their paths cross.
+    # Every frame each object is detected at its position plus noise, unless it is missed.
+    def __init__(self, count, rng, noise=0.01, missRate=0.05, speed=0.5):
+        self.rng = rng
+        self.noise = noise
+        self.missRate = missRate
+        grid = np.linspace(-FIELD * 0.8, FIELD * 0.8, 8)
+        start = rng.choice(len(grid) ** 2, count, replace=False)
+        self.positions = np.stack((grid[start % len(grid)], grid[start // len(grid)]), axis=1)
+        self.velocities = rng.uniform(-speed, speed, (count, 2))
+        self.classes = rng.integers(0, 3, count)
+
+    def step(self):
+        # Move the objects one frame on, returns the detected objects' indexes and the detections
+        self.positions += self.velocities * FRAME_TIME
+        outside = np.abs(self.positions) > FIELD
+        self.velocities[outside] *= -1
+        self.positions = np.clip(self.positions, -FIELD, FIELD)
+
+        seen = np.flatnonzero(self.rng.random(len(self.positions)) >= self.missRate)
+        seen = self.rng.permutation(seen)  # The network reports the objects in no particular order
+        data = np.zeros(len(seen), dtype=DETECTION_DTYPE)
+        data["classID"] = self.classes[seen]
+        data["depth"] = 1.0
+        data["mapX"] = self.positions[seen, 0] + self.rng.normal(0, self.noise, len(seen))
+        data["mapY"] = self.positions[seen, 1] + self.rng.normal(0, self.noise, len(seen))
+        return seen, DetectionBatch(data)
+
+
+def check(rng, frames=300, count=30, closeDistance=0.2):
+    # Replay the match and count identity switches: an object detected under another track ID than the confirmed
+    # track it had before. New tracks are tentative and dropped on their first miss, which is not a switch.
+    # While another object of its class is within closeDistance, about a triball, the two cannot be told apart
+    # and a switch is allowed; anywhere else the track ID must stay the same.
+    match = ScriptedMatch(count, rng)
+    tracker = Tracker()
+    trackOf = np.zeros(count, dtype=np.int64)
+    switches = 0
+    closeSwitches = 0
+    tracked = 0
+    detected = 0
+    velocityErrors = []
+    for frame in range(frames):
+        seen, batch = match.step()
+        # A detection without depth is never tracked
+        batch.data["depth"][:1] = np.nan
+        batch.data["mapX"][:1] = np.nan
+        batch.data["mapY"][:1] = np.nan
+        tracker.update(AIRecord(POSITION, batch), frame * FRAME_TIME)
+        data = batch.data
+        assert len(data) == 0 or data["trackID"][0] == 0, "A detection without depth was tracked"
+
+        ids = data["trackID"][1:]
+        seen = seen[1:]
+        switched = seen[(trackOf[seen] != 0) & (trackOf[seen] != ids)]
+        for i in switched:
+            distances = np.linalg.norm(match.positions - match.positions[i], axis=1)
+            distances[i] = np.inf
+            if np.min(distances[match.classes == match.classes[i]]) < closeDistance:
+                closeSwitches += 1
+            else:
+                switches += 1
+        confirmed = np.isin(ids, tracker.ids[tracker.hits >= tracker.minHits])
+        trackOf[seen[confirmed]] = ids[confirmed]
+        if frame >= 30:
+            detected += len(seen)
+            tracked += np.count_nonzero(confirmed)
+            velocity = np.stack((data["velocityX"][1:], data["velocityY"][1:]), axis=1)
+            velocityErrors.append(np.linalg.norm(velocity - match.velocities[seen], axis=1))
+    velocityError = np.mean(np.concatenate(velocityErrors))
+    print("{} objects over {} frames: {} identity switches, {} more between objects closer than {}m, "
+          "{:.1%} of the detections in confirmed tracks, velocity error {:.3f} m/s".format(
+              count, frames, switches, closeSwitches, closeDistance, tracked / detected, velocityError))
+    assert switches == 0, "Identity switches between objects that are apart"
+    assert tracked / detected > 0.95, "Too few detections in confirmed tracks"
+    assert velocityError < 0.1, "Velocities are off"
+
+
+def time_updates(rng, count=30, frames=300):
+    # Time every update of a match with count objects, once the tracks are established
+    match = ScriptedMatch(count, rng)
+    tracker = Tracker()
+    records = [AIRecord(POSITION, match.step()[1]) for _ in range(frames)]
+    frame = iter(range(frames))
+
+    def update():
+        index = next(frame)
+        tracker.update(records[index], index * FRAME_TIME)
+    return measure(update, repeat=frames - 30, warmup=30)
+
+
+def replay_session(directory):
+    # Run the detections of a recorded session through the tracker, returns the records of every frame
+    reader = SessionReader(directory)
+    model = Model({"backend": "replay", "replay_file": os.path.abspath(directory), "fallback_backend": None})
+    processing = Processing.__new__(Processing)  # For the depth only, without the RealSense or another network
+    processing.depth_scale = reader.depth_scale
+    processing.depth_method = "mean"
+    processing.trim_fraction = 0.1
+    intrinsics = CameraIntrinsics.from_dict(reader.intrinsics) if reader.intrinsics else None
+    mapPosition = MapPosition(intrinsics)
+
+    # The outputs were recorded for the frames the network ran on, with their frame index. Sessions recorded
+    # without the frame indexes hold the outputs of the first frames in order.
+    recorded_frames = model.backend.recorded_frames
+    if recorded_frames is None:
+        recorded_frames = range(len(model.backend.recorded_outputs))
+    recorded_frames = set(int(index) for index in recorded_frames)
+    records = []
+    for index, (timestamp, depth, color, position) in enumerate(reader):
+        if index not in recorded_frames:
+            continue
+        _, batch = model.inference(np.asarray(color), frame_index=index)
+        data = batch.data
+        data["depth"] = processing.get_depths(batch, depth)
+        valid = batch.has_depth()
+        centers = np.stack((data["centerX"][valid], data["centerY"][valid]), axis=1)
+        locations = mapPosition.computeMapLocations(centers, data["depth"][valid], position)
+        for axis, name in enumerate(("mapX", "mapY", "mapZ")):
+            data[name] = np.nan
+            data[name][valid] = locations[:, axis]
+        records.append((timestamp, AIRecord(position, batch)))
+    return records
+
+
+def main():
+    rng = np.random.default_rng(0)
+    check(rng)
+    for count in (10, 30, 50):
+        average, p99 = time_updates(rng, count)
+        report("Tracker.update, {} objects".format(count), average, p99)
+
+    if len(sys.argv) > 1:
+        records = replay_session(sys.argv[1])
+        tracker = Tracker()
+        frame = iter(records)
+
+        def update():
+            timestamp, record = next(frame)
+            tracker.update(record, timestamp)
+        detections = sum(len(record.detections) for _, record in records)
+        report("Tracker.update, recorded session", *measure(update, repeat=len(records), warmup=0))
+        print("{} frames, {:.1f} detections per frame, {} tracks at the end".format(
+            len(records), detections / max(1, len(records)), len(tracker)))
+
+
+if __name__ == "__main__":
+    main()
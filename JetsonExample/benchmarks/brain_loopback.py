@@ -0,0 +1,162 @@
+# Stand-in for the V5 Brain on a pseudo terminal, to test V5SerialComms without a brain attached.
+# V5SerialComms is connected to one end of the pty, this script polls on the other end like jetson::request_map,
+# with some polls split over several writes and surrounded by other bytes, and parses the replies like
+# jetson::parse. Every reply must be one whole packet with the right length, CRC32 and record.
+# Then push mode is requested like jetson::request_push, and the pushed packets are checked for their rate,
+# sequence numbers and records, and for stopping when push mode is turned off.
+# Linux only. Run from the JetsonExample folder: python benchmarks/brain_loopback.py
+import os
+import pty
+import time
+import tty
+import numpy as np
+from bench_common import random_detections
+from V5Comm import crc32, AIRecord, V5SerialComms, PACKET_SYNC, PACKET_HEADER, PUSH_HEADER, MAX_DETECTIONS
+from V5Position import Position
+
+POLL = b"AA55CC3301\r\n"
+PUSH_START = b"AA55CC3302\r\n"
+PUSH_STOP = b"AA55CC3303\r\n"
+PUSH_RATE = 20.0
+
+
+class BrainStandIn:
+    # The brain's end of the pty
+    def __init__(self):
+        self.master, slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(slave)
+        os.set_blocking(self.master, False)
+        self.port = os.ttyname(slave)
+        self.buffer = b""
+
+    def write(self, data, pieces=1):
+        # Write data in the given number of pieces, with a short pause in between so they arrive in separate reads
+        bounds = np.linspace(0, len(data), pieces + 1).astype(int)
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            os.write(self.master, data[start:end])
+            if end < len(data):
+                time.sleep(0.002)
+
+    def packets(self, timeout, count=None):
+        # Read for timeout seconds, or until count packets arrived, and return the packets as (type, payload) pairs
+        end = time.monotonic() + timeout
+        packets = []
+        while time.monotonic() < end and (count is None or len(packets) < count):
+            try:
+                self.buffer += os.read(self.master, 65536)
+            except BlockingIOError:
+                time.sleep(0.0005)
+            while True:
+                start = self.buffer.find(PACKET_SYNC)
+                if start < 0 or len(self.buffer) < start + PACKET_HEADER.size:
+                    break
+                assert start == 0, "Unexpected bytes before a packet: {}".format(self.buffer[:start])
+                _, length, type, crc = PACKET_HEADER.unpack_from(self.buffer)
+                if len(self.buffer) < PACKET_HEADER.size + length:
+                    break
+                payload = self.buffer[PACKET_HEADER.size:PACKET_HEADER.size + length]
+                assert crc32(payload) == crc, "CRC32 mismatch"
+                packets.append((type, payload))
+                self.buffer = self.buffer[PACKET_HEADER.size + length:]
+        return packets
+
+
+def serialize(record):
+    # The payload the brain should receive for a record
+    data = bytearray(record.serial_size(MAX_DETECTIONS))
+    record.pack_into(data, 0, MAX_DETECTIONS)
+    return data
+
+
+def check_polls(brain, comms, rng, count=200):
+    # Poll with a new record every time and check that exactly its packet comes back
+    latencies = []
+    for i in range(count):
+        record = AIRecord(Position(i, 1, 0.5, -0.5, 0.1, 90.0, 0.0, 0.0), random_detections(rng.choice([0, 10, 50, 60]), rng))
+        comms.setDetectionData(record)
+        start = time.perf_counter()
+        if i % 3 == 0:
+            # Other bytes before the poll, and the poll itself split over three writes
+            brain.write(b"\x00AA55" + POLL, pieces=3)
+        else:
+            brain.write(POLL)
+        packets = brain.packets(2.0, count=1)
+        latencies.append(time.perf_counter() - start)
+
+        assert len(packets) == 1, "No reply to poll {}".format(i)
+        type, payload = packets[0]
+        assert type == 1 and payload == serialize(record), "Wrong packet for poll {}".format(i)
+    assert not brain.packets(0.1), "Unrequested packets"
+    latencies = np.array(latencies) * 1000
+    print("{} polls answered with valid packets, round trip median: {:.2f} ms, p99: {:.2f} ms".format(
+        count, np.median(latencies), np.percentile(latencies, 99)))
+
+
+def check_push(brain, comms, rng, duration=1.0, setRate=100.0):
+    # Request push mode, set new records faster than the push rate and check what arrives
+    brain.write(PUSH_START, pieces=2)
+    packets = brain.packets(0.5, count=1)
+    assert len(packets) == 1 and packets[0][0] == 2, "The current record was not pushed on starting push mode"
+    assert comms.isPushing()
+
+    records = []
+    arrivals = []
+    pushed = []
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        record = AIRecord(Position(0, 1, 0.5, -0.5, 0.1, 90.0, 0.0, 0.0), random_detections(rng.choice([0, 10, 50]), rng))
+        records.append(record)
+        comms.setDetectionData(record)
+        for packet in brain.packets(1.0 / setRate):
+            arrivals.append(time.monotonic())
+            pushed.append(packet)
+    # The last record is pushed once the rate limit allows it
+    for packet in brain.packets(2.0 / PUSH_RATE):
+        arrivals.append(time.monotonic())
+        pushed.append(packet)
+
+    firstSequence, _ = PUSH_HEADER.unpack_from(packets[0][1])
+    sequences = []
+    timestamps = []
+    for type, payload in pushed:
+        sequence, timestamp = PUSH_HEADER.unpack_from(payload)
+        assert type == 2, "Pushed packet of type {}".format(type)
+        assert payload[PUSH_HEADER.size:] == serialize(records[sequence - firstSequence - 1]), "Wrong pushed record"
+        sequences.append(sequence)
+        timestamps.append(timestamp)
+    assert np.all(np.diff(sequences) > 0) and np.all(np.diff(timestamps) >= 0), "Pushed packets out of order"
+    assert sequences[-1] == firstSequence + len(records), "The latest record was not pushed"
+    assert len(pushed) <= duration * PUSH_RATE + 2, "Pushed faster than the push rate"
+    gaps = np.diff(arrivals) * 1000
+    print("{} records set in {:.1f} s, {} pushed at up to {:.0f} per second, smallest gap: {:.1f} ms".format(
+        len(records), duration, len(pushed), PUSH_RATE, gaps.min() if len(gaps) else 0.0))
+
+    # Polls are still answered in push mode
+    brain.write(POLL)
+    packets = brain.packets(0.5, count=1)
+    assert len(packets) == 1 and packets[0][0] == 1, "No reply to a poll in push mode"
+
+    brain.write(PUSH_STOP)
+    time.sleep(0.1)
+    assert not comms.isPushing()
+    brain.packets(2.0 / PUSH_RATE)
+    comms.setDetectionData(AIRecord(Position(0, 1, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0), random_detections(3, rng)))
+    assert not brain.packets(0.3), "Packets pushed after push mode was stopped"
+    print("Push mode started and stopped on request")
+
+
+def main():
+    rng = np.random.default_rng(0)
+    brain = BrainStandIn()
+    comms = V5SerialComms(brain.port, pushRate=PUSH_RATE)
+    comms.start()
+    time.sleep(0.5)  # Let the serial thread open the port
+
+    check_polls(brain, comms, rng)
+    print("Poll latency on the Jetson side:", comms.pollLatency.to_JSON())
+    check_push(brain, comms, rng)
+
+
+if __name__ == "__main__":
+    main()
@@ -89,12 +89,21 @@ def do_inference(context, bindings, inputs, outputs, stream, batch_size=1):
 # This function is generalized for multiple inputs/outputs for full dimension networks.
 # inputs and outputs are expected to be lists of HostDeviceMem objects.
 def do_inference_v2(context, bindings, inputs, outputs, stream):
+    enqueue_inference_v2(context, bindings, inputs, outputs, stream)
+    return wait_for_inference(outputs, stream)
+
+# Queues the copies and the inference on the stream and returns without waiting for them,
+# use wait_for_inference to get the outputs.
+def enqueue_inference_v2(context, bindings, inputs, outputs, stream):
     # Transfer input data to the GPU.
     [cuda.memcpy_htod_async(inp.device, inp.host, stream) for inp in inputs]
     # Run inference.
     context.execute_async_v2(bindings=bindings, stream_handle=stream.handle)
     # Transfer predictions back from the GPU.
     [cuda.memcpy_dtoh_async(out.host, out.device, stream) for out in outputs]
+
+# Waits for the work queued on the stream to finish and returns the host outputs.
+def wait_for_inference(outputs, stream):
     # Synchronize the stream
     stream.synchronize()
     # Return only the host outputs.
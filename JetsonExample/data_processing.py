@@ -14,8 +14,7 @@
 # limitations under the License.
 #
 
-import math
-from PIL import Image
+import cv2
 import numpy as np
 import os
 
@@ -35,69 +34,157 @@ CATEGORY_NUM = len(ALL_CATEGORIES)
 assert CATEGORY_NUM == 3
 
 
+def sigmoid(value, out=None):
+    """Return the element-wise sigmoid of a NumPy array, written into out if it is given."""
+    out = np.negative(value, out=out)
+    np.exp(out, out=out)
+    out += 1.0
+    return np.reciprocal(out, out=out)
+
+
 class PreprocessYOLO(object):
     """
-    A simple class for loading images with PIL and reshaping them to the specified
-    input resolution.
+    A simple class for resizing images with OpenCV to the specified input resolution and
+    writing them in the layout expected by the network.
     """
 
-    def __init__(self, yolo_input_resolution):
+    def __init__(self, yolo_input_resolution, enhance=None):
         """
         Initialize with the input resolution for YOLOv3, which will stay fixed in this sample.
 
         Keyword arguments:
         yolo_input_resolution -- two-dimensional tuple with the target network's (spatial)
         input resolution in HW order
+        enhance -- optional function applied to the resized uint8 image before it is
+        normalized, e.g. for color correction (default: None)
         """
         self.yolo_input_resolution = yolo_input_resolution
+        self.enhance = enhance
+        self._canvas = None
+
+    def get_letterbox(self, image_shape, roi):
+        """Return the transform (scale_x, scale_y, offset_x, offset_y) that maps pixel
+        coordinates of the image to the network input, so that the height of the region of
+        interest is zoomed in as far as it fits, up to the full image resolution, and centered
+        where possible. The region is usually a band as wide as the image, so the zoom follows
+        its height only and the sides of a wide region are cropped. Both axes are zoomed by the
+        same factor, so objects keep the proportions they have when the whole image is resized.
+        Returns None if there is no region of interest.
 
-    def process(self, input_image):
+        Keyword arguments:
+        image_shape -- shape of the image, in HWC format
+        roi -- (left, top, right, bottom) pixel coordinates of the region, or None
         """
-        Load an image from the specified input array,
+        if roi is None:
+            return None
+        height, width = image_shape[:2]
+        input_height, input_width = self.yolo_input_resolution
+        left, top, right, bottom = roi
+        # Zooming in further than one image pixel per input pixel adds no detail
+        zoom = min(height / (bottom - top), max(width / input_width, height / input_height, 1.0))
+        scale_x = input_width / width * zoom
+        scale_y = input_height / height * zoom
+        # Center the view on the region, but keep it inside the image where it fits so less of it is padding
+        view_width = input_width / scale_x
+        view_height = input_height / scale_y
+        view_left = self._place_view((left + right) / 2 - view_width / 2, view_width, width)
+        view_top = self._place_view((top + bottom) / 2 - view_height / 2, view_height, height)
+        return scale_x, scale_y, -view_left * scale_x, -view_top * scale_y
+
+    @staticmethod
+    def _place_view(start, size, image_size):
+        """Move the start of a view of the given size along one image axis so the view stays
+        inside the image, or center it on the image if it is larger than the image."""
+        if size >= image_size:
+            return (image_size - size) / 2
+        return min(max(start, 0.0), image_size - size)
+
+    def process(self, input_image, out=None, letterbox=None):
+        """
+        Resize an image from the specified input array,
         and return it together with a pre-processed version required for feeding it into a
         YOLOv3 network.
 
         Keyword arguments:
         input_image -- numpy array of the image to be processed
+        out -- optional float32 array with room for the NCHW network input, such as the
+        host input buffer of the engine; the pre-processed image is written into it
+        letterbox -- optional transform from get_letterbox; only the part of the image it
+        maps into the network input is used, and the rest of the input is padded with gray
         """
-        image_raw, image_resized = self._load_and_resize(input_image)
-        image_preprocessed = self._shuffle_and_normalize(image_resized)
-        return image_raw, image_preprocessed
-
-    def _load_and_resize(self, input_image):
+        if letterbox is None:
+            image_resized = self._resize(input_image)
+        else:
+            image_resized = self._letterbox(input_image, letterbox)
+        if self.enhance is not None:
+            image_resized = self.enhance(image_resized)
+        image_preprocessed = self._shuffle_and_normalize(image_resized, out)
+        return input_image, image_preprocessed
+
+    def _resize(self, input_image):
         """
-        Load an image from the specified array and resize it to the input resolution.
-        Return the input image before resizing as a PIL Image (required for visualization),
-        and the resized image as a NumPy float array.
+        Resize an image from the specified array to the input resolution, so that every
+        following step works on the small image only.
 
         Keyword arguments:
-        input_image -- numpy array of the image to be loaded
+        input_image -- numpy array of the image to be resized, in HWC format
         """
-
-        image_raw = Image.fromarray(input_image)
-        # Expecting yolo_input_resolution in (height, width) format, adjusting to PIL
-        # convention (width, height) in PIL:
+        # Expecting yolo_input_resolution in (height, width) format, adjusting to OpenCV
+        # convention (width, height):
         new_resolution = (self.yolo_input_resolution[1], self.yolo_input_resolution[0])
-        image_resized = image_raw.resize(new_resolution, resample=Image.BICUBIC)
-        image_resized = np.array(image_resized, dtype=np.float32, order="C")
-        return image_raw, image_resized
+        return cv2.resize(input_image, new_resolution, interpolation=cv2.INTER_AREA)
+
+    def _letterbox(self, input_image, letterbox):
+        """
+        Resize the part of an image that a letterbox transform maps into the network input,
+        and place it on a gray image of the input resolution.
 
-    def _shuffle_and_normalize(self, image):
+        Keyword arguments:
+        input_image -- numpy array of the image to be resized, in HWC format
+        letterbox -- transform (scale_x, scale_y, offset_x, offset_y) from get_letterbox
+        """
+        height, width = input_image.shape[:2]
+        input_height, input_width = self.yolo_input_resolution
+        scale_x, scale_y, offset_x, offset_y = letterbox
+        if self._canvas is None or self._canvas.shape[2:] != input_image.shape[2:]:
+            self._canvas = np.empty((input_height, input_width) + input_image.shape[2:], dtype=np.uint8)
+        canvas = self._canvas
+        canvas.fill(128)
+
+        # Part of the image inside the network input, and where it ends up
+        left = max(0, int(np.floor(-offset_x / scale_x)))
+        right = min(width, int(np.ceil((input_width - offset_x) / scale_x)))
+        top = max(0, int(np.floor(-offset_y / scale_y)))
+        bottom = min(height, int(np.ceil((input_height - offset_y) / scale_y)))
+        target_left = max(0, int(round(left * scale_x + offset_x)))
+        target_right = min(input_width, int(round(right * scale_x + offset_x)))
+        target_top = max(0, int(round(top * scale_y + offset_y)))
+        target_bottom = min(input_height, int(round(bottom * scale_y + offset_y)))
+        if target_right > target_left and target_bottom > target_top:
+            canvas[target_top:target_bottom, target_left:target_right] = cv2.resize(
+                input_image[top:bottom, left:right],
+                (target_right - target_left, target_bottom - target_top),
+                interpolation=cv2.INTER_AREA,
+            )
+        return canvas
+
+    def _shuffle_and_normalize(self, image, out=None):
         """Normalize a NumPy array representing an image to the range [0, 1], and
         convert it from HWC format ("channels last") to NCHW format ("channels first"
-        with leading batch dimension).
+        with leading batch dimension) in a single pass.
 
         Keyword arguments:
-        image -- image as three-dimensional NumPy float array, in HWC format
+        image -- image as three-dimensional NumPy uint8 array, in HWC format
+        out -- optional float32 array with room for the NCHW image, allocated if not given
         """
-        image /= 255.0
-        # HWC to CHW format:
-        image = np.transpose(image, [2, 0, 1])
-        # CHW to NCHW format
-        image = np.expand_dims(image, axis=0)
-        # Convert the image to row-major order, also known as "C order":
-        image = np.array(image, dtype=np.float32, order="C")
-        return image
+        height, width, channels = image.shape
+        if out is None:
+            out = np.empty((1, channels, height, width), dtype=np.float32)
+        # Row-major (C order) NCHW view on the output buffer, no copy is made:
+        image_nchw = out.reshape(1, channels, height, width)
+        # HWC to CHW format while normalizing:
+        np.divide(np.transpose(image, [2, 0, 1]), np.float32(255.0), out=image_nchw[0], dtype=np.float32)
+        return image_nchw
 
 
 class PostprocessYOLO(object):
@@ -110,6 +197,9 @@ class PostprocessYOLO(object):
         obj_threshold,
         nms_threshold,
         yolo_input_resolution,
+        sparse_decode=True,
+        max_detections=None,
+        top_k=None,
     ):
         """Initialize with all values that will be kept when processing several frames.
 
@@ -118,17 +208,72 @@ class PostprocessYOLO(object):
         yolo_anchors -- a list of 9 two-dimensional tuples for the YOLO anchors
         object_threshold -- threshold for object coverage, float value between 0 and 1, given in an array where index is the class of the object
         nms_threshold -- threshold for non-max suppression algorithm,
-        float value between 0 and 1
+        float value between 0 and 1, either a single value or an array where index is the class of the object
         input_resolution_yolo -- two-dimensional tuple with the target network's (spatial)
         input resolution in HW order
+        sparse_decode -- if True, score every anchor first and only decode the box geometry
+        of the anchors that pass their class threshold (default: True)
+        max_detections -- maximum number of boxes kept after non-max suppression, either a single
+        value or an array where index is the class of the object (default: None, no limit)
+        top_k -- maximum number of boxes kept in total after non-max suppression, the ones with
+        the highest confidences are kept (default: None, no limit)
         """
         self.masks = yolo_masks
         self.anchors = yolo_anchors
-        self.object_threshold = obj_threshold
-        self.nms_threshold = nms_threshold
+        # Per-class settings are kept as lookup arrays indexed by class ID
+        self.object_threshold = self._per_class_array(obj_threshold, np.float32)
+        self.nms_threshold = self._per_class_array(nms_threshold, np.float32)
+        if max_detections is None:
+            max_detections = np.iinfo(np.int32).max
+        self.max_detections = self._per_class_array(max_detections, np.int32)
+        self.top_k = top_k
         self.input_resolution_yolo = yolo_input_resolution
+        self.sparse_decode = sparse_decode
+        # Grid offsets and scratch buffers per head shape and anchor tensors per mask,
+        # built on first use
+        self._grid_cache = dict()
+        self._anchors_cache = dict()
+        self._scratch_cache = dict()
+
+    @staticmethod
+    def _per_class_array(value, dtype):
+        """Return a NumPy array with one entry per class, broadcasting a single value to all
+        classes.
+
+        Keyword arguments:
+        value -- a single value or a list with one value per class
+        dtype -- NumPy dtype of the returned array
+        """
+        return np.broadcast_to(np.asarray(value, dtype=dtype), (CATEGORY_NUM,)).copy()
 
-    def process(self, outputs, resolution_raw):
+    def set_thresholds(self, obj_threshold=None, nms_threshold=None, max_detections=None):
+        """Update the per-class thresholds in place, so they can be tuned while frames are
+        being processed. Settings that are None are left unchanged.
+
+        Keyword arguments:
+        obj_threshold -- threshold for object coverage, a single value or one value per class
+        nms_threshold -- threshold for non-max suppression, a single value or one value per class
+        max_detections -- maximum number of boxes kept after non-max suppression, a single value
+        or one value per class
+        """
+        if obj_threshold is not None:
+            self.object_threshold[:] = obj_threshold
+        if nms_threshold is not None:
+            self.nms_threshold[:] = nms_threshold
+        if max_detections is not None:
+            self.max_detections[:] = max_detections
+
+    def get_thresholds(self):
+        """Return the current per-class thresholds as a dictionary of lists with one value per
+        class, with the same keys as the arguments of set_thresholds. The float32 thresholds are
+        rounded so they read as the values that were set."""
+        return {
+            "obj_threshold": self.object_threshold.astype(np.float64).round(6).tolist(),
+            "nms_threshold": self.nms_threshold.astype(np.float64).round(6).tolist(),
+            "max_detections": self.max_detections.tolist(),
+        }
+
+    def process(self, outputs, resolution_raw, letterbox=None):
         """Take the YOLOv3 outputs generated from a TensorRT forward pass, post-process them
         and return a list of bounding boxes for detected object together with their category
         and their confidences in separate lists.
@@ -136,33 +281,36 @@ class PostprocessYOLO(object):
         Keyword arguments:
         outputs -- outputs from a TensorRT engine in NCHW format
         resolution_raw -- the original spatial resolution from the input PIL image in WH order
+        letterbox -- transform the input image was preprocessed with, if any, see
+        PreprocessYOLO.get_letterbox; the boxes are mapped back to the full image with it
         """
         outputs_reshaped = list()
         for output in outputs:
             outputs_reshaped.append(self._reshape_output(output))
 
         boxes, categories, confidences = self._process_yolo_output(
-            outputs_reshaped, resolution_raw
+            outputs_reshaped, resolution_raw, letterbox
         )
 
         return boxes, categories, confidences
 
     def _reshape_output(self, output):
-        """Reshape a TensorRT output from NCHW to NHWC format (with expected C=255),
-        and then return it in (height,width,3,85) dimensionality after further reshaping.
+        """Return a TensorRT output in NCHW format (with expected C=3*8) as a
+        (height,width,3,8) view, without copying the data.
 
         Keyword argument:
         output -- an output from a TensorRT engine after inference
         """
-        output = np.transpose(output, [0, 2, 3, 1])
-        _, height, width, _ = output.shape
-        dim1, dim2 = height, width
+        _, _, height, width = output.shape
         dim3 = 3
         dim4 = 4 + 1 + CATEGORY_NUM
 
-        return np.reshape(output, (dim1, dim2, dim3, dim4))
+        # The channels are grouped per anchor, so splitting them and moving the spatial
+        # dimensions to the front only changes the strides:
+        output = np.reshape(output, (dim3, dim4, height, width))
+        return np.transpose(output, [2, 3, 0, 1])
 
-    def _process_yolo_output(self, outputs_reshaped, resolution_raw):
+    def _process_yolo_output(self, outputs_reshaped, resolution_raw, letterbox=None):
         """Take in a list of three reshaped YOLO outputs in (height,width,3,85) shape and return
         return a list of bounding boxes for detected object together with their category and their
         confidences in separate lists.
@@ -171,6 +319,7 @@ class PostprocessYOLO(object):
         outputs_reshaped -- list of three reshaped YOLO outputs as NumPy arrays
         with shape (height,width,3,85)
         resolution_raw -- the original spatial resolution from the input PIL image in WH order
+        letterbox -- transform the input image was preprocessed with, or None
         """
 
         # There are three output tensors, which we associate with their
@@ -178,8 +327,11 @@ class PostprocessYOLO(object):
         # for bounding boxes, their corresponding category predictions and their confidences:
         boxes, categories, confidences = list(), list(), list()
         for output, mask in zip(outputs_reshaped, self.masks):
-            box, category, confidence = self._process_feats(output, mask)
-            box, category, confidence = self._filter_boxes(box, category, confidence)
+            if self.sparse_decode:
+                box, category, confidence = self._process_feats_sparse(output, mask)
+            else:
+                box, category, confidence = self._process_feats(output, mask)
+                box, category, confidence = self._filter_boxes(box, category, confidence)
             boxes.append(box)
             categories.append(category)
             confidences.append(confidence)
@@ -189,33 +341,25 @@ class PostprocessYOLO(object):
         confidences = np.concatenate(confidences)
 
         # Scale boxes back to original image shape:
-        width, height = resolution_raw
-        image_dims = [width, height, width, height]
-        boxes = boxes * image_dims
+        if letterbox is None:
+            width, height = resolution_raw
+            image_dims = [width, height, width, height]
+            boxes = boxes * image_dims
+        else:
+            # Undo the zoom and offset of the letterbox
+            scale_x, scale_y, offset_x, offset_y = letterbox
+            input_height, input_width = self.input_resolution_yolo
+            boxes = boxes * [input_width / scale_x, input_height / scale_y, input_width / scale_x, input_height / scale_y]
+            boxes -= [offset_x / scale_x, offset_y / scale_y, 0.0, 0.0]
 
         # Using the candidates from the previous (loop) step, we apply the non-max suppression
         # algorithm that clusters adjacent bounding boxes to a single bounding box:
-        nms_boxes, nms_categories, nscores = list(), list(), list()
-        for category in set(categories):
-            idxs = np.where(categories == category)
-            box = boxes[idxs]
-            category = categories[idxs]
-            confidence = confidences[idxs]
-
-            keep = self._nms_boxes(box, confidence)
-
-            nms_boxes.append(box[keep])
-            nms_categories.append(category[keep])
-            nscores.append(confidence[keep])
-
-        if not nms_categories and not nscores:
+        if categories.size == 0:
             return None, None, None
 
-        boxes = np.concatenate(nms_boxes)
-        categories = np.concatenate(nms_categories)
-        confidences = np.concatenate(nscores)
+        keep = self._nms_boxes_per_class(boxes, categories, confidences)
 
-        return boxes, categories, confidences
+        return boxes[keep], categories[keep], confidences[keep]
 
     def _process_feats(self, output_reshaped, mask):
         """Take in a reshaped YOLO output in height,width,3,85 format together with its
@@ -227,49 +371,128 @@ class PostprocessYOLO(object):
         mask -- 2-dimensional tuple with mask specification for this output
         """
 
-        # Two in-line functions required for calculating the bounding box
-        # descriptors:
-        def sigmoid(value):
-            """Return the sigmoid of the input."""
-            return 1.0 / (1.0 + math.exp(-value))
+        grid_h, grid_w, _, _ = output_reshaped.shape
 
-        def exponential(value):
-            """Return the exponential of the input."""
-            return math.exp(value)
+        # Grid offsets and anchor sizes only depend on the head shape and mask,
+        # so they are built once and reused for every frame:
+        grid = self._get_grid(grid_h, grid_w)
+        anchors_tensor = self._get_anchors_tensor(mask)
 
-        # Vectorized calculation of above two functions:
-        sigmoid_v = np.vectorize(sigmoid)
-        exponential_v = np.vectorize(exponential)
+        box_xy = sigmoid(output_reshaped[..., :2])
+        box_wh = np.exp(output_reshaped[..., 2:4]) * anchors_tensor
+        box_confidence = sigmoid(output_reshaped[..., 4:5])
+        box_class_probs = sigmoid(output_reshaped[..., 5:])
 
+        box_xy += grid
+        box_xy /= (grid_w, grid_h)
+        box_wh /= self.input_resolution_yolo
+        box_xy -= box_wh / 2.0
+        boxes = np.concatenate((box_xy, box_wh), axis=-1)
+
+        # boxes: centroids, box_confidence: confidence level, box_class_probs:
+        # class confidence
+        return boxes, box_confidence, box_class_probs
+
+    def _process_feats_sparse(self, output_reshaped, mask):
+        """Take in a reshaped YOLO output in height,width,3,85 format together with its
+        corresponding YOLO mask, score every cell/pixel first and decode the bounding boxes
+        only for the cells whose score passes the object threshold of its class.
+        Return the same filtered boxes, classes and scores as _process_feats followed by
+        _filter_boxes.
+
+        Keyword arguments:
+        output_reshaped -- reshaped YOLO output as NumPy arrays with shape (height,width,3,85)
+        mask -- 2-dimensional tuple with mask specification for this output
+        """
         grid_h, grid_w, _, _ = output_reshaped.shape
 
-        anchors = [self.anchors[i] for i in mask]
+        scratch = self._get_scratch(grid_h, grid_w)
 
-        # Reshape to N, height, width, num_anchors, box_params:
-        anchors_tensor = np.reshape(anchors, [1, 1, len(anchors), 2])
-        box_xy = sigmoid_v(output_reshaped[..., :2])
-        box_wh = exponential_v(output_reshaped[..., 2:4]) * anchors_tensor
-        box_confidence = sigmoid_v(output_reshaped[..., 4])
+        # Score all anchors: objectness times class probability
+        box_scores = sigmoid(output_reshaped[..., 5:], out=scratch["scores"])
+        box_scores *= sigmoid(output_reshaped[..., 4:5], out=scratch["objectness"])
+        box_classes = np.argmax(box_scores, axis=-1, out=scratch["classes"])
+        # Element-wise maximum over the few classes is much cheaper than a reduction on the
+        # last axis:
+        box_class_scores = scratch["class_scores"]
+        np.copyto(box_class_scores, box_scores[..., 0])
+        for category in range(1, CATEGORY_NUM):
+            np.maximum(box_class_scores, box_scores[..., category], out=box_class_scores)
 
-        box_confidence = np.expand_dims(box_confidence, axis=-1)
-        box_class_probs = sigmoid_v(output_reshaped[..., 5:])
+        thresholds = np.take(self.object_threshold, box_classes, out=scratch["thresholds"])
+        passed = np.greater_equal(box_class_scores, thresholds, out=scratch["passed"])
+        rows, cols, anchor_idxs = np.nonzero(passed)
 
-        col = np.tile(np.arange(0, grid_w), grid_w).reshape(-1, grid_w)
-        row = np.tile(np.arange(0, grid_h).reshape(-1, 1), grid_h)
+        # Decode the geometry of the surviving anchors only:
+        feats = output_reshaped[rows, cols, anchor_idxs]
+        anchors_tensor = self._get_anchors_tensor(mask)[0, 0]
 
-        col = col.reshape(grid_h, grid_w, 1, 1).repeat(3, axis=-2)
-        row = row.reshape(grid_h, grid_w, 1, 1).repeat(3, axis=-2)
-        grid = np.concatenate((col, row), axis=-1)
+        box_xy = sigmoid(feats[:, :2])
+        box_wh = np.exp(feats[:, 2:4]) * anchors_tensor[anchor_idxs]
 
-        box_xy += grid
+        box_xy[:, 0] += cols
+        box_xy[:, 1] += rows
         box_xy /= (grid_w, grid_h)
         box_wh /= self.input_resolution_yolo
         box_xy -= box_wh / 2.0
         boxes = np.concatenate((box_xy, box_wh), axis=-1)
 
-        # boxes: centroids, box_confidence: confidence level, box_class_probs:
-        # class confidence
-        return boxes, box_confidence, box_class_probs
+        classes = box_classes[rows, cols, anchor_idxs]
+        scores = box_class_scores[rows, cols, anchor_idxs]
+
+        return boxes, classes, scores
+
+    def _get_grid(self, grid_h, grid_w):
+        """Return the (height,width,3,2) tensor of cell column/row offsets for a head of the
+        given size, building it on first use.
+
+        Keyword arguments:
+        grid_h -- number of grid rows of the YOLO head
+        grid_w -- number of grid columns of the YOLO head
+        """
+        grid = self._grid_cache.get((grid_h, grid_w))
+        if grid is None:
+            col, row = np.meshgrid(np.arange(grid_w), np.arange(grid_h))
+            grid = np.stack((col, row), axis=-1).reshape(grid_h, grid_w, 1, 2)
+            grid = np.repeat(grid, 3, axis=-2).astype(np.float32)
+            self._grid_cache[(grid_h, grid_w)] = grid
+        return grid
+
+    def _get_scratch(self, grid_h, grid_w):
+        """Return the dictionary of scratch buffers used by _process_feats_sparse for a head of
+        the given size, allocating them on first use.
+
+        Keyword arguments:
+        grid_h -- number of grid rows of the YOLO head
+        grid_w -- number of grid columns of the YOLO head
+        """
+        scratch = self._scratch_cache.get((grid_h, grid_w))
+        if scratch is None:
+            shape = (grid_h, grid_w, 3)
+            scratch = {
+                "scores": np.empty(shape + (CATEGORY_NUM,), dtype=np.float32),
+                "objectness": np.empty(shape + (1,), dtype=np.float32),
+                "classes": np.empty(shape, dtype=np.intp),
+                "class_scores": np.empty(shape, dtype=np.float32),
+                "thresholds": np.empty(shape, dtype=np.float32),
+                "passed": np.empty(shape, dtype=bool),
+            }
+            self._scratch_cache[(grid_h, grid_w)] = scratch
+        return scratch
+
+    def _get_anchors_tensor(self, mask):
+        """Return the (1,1,3,2) tensor of anchor sizes selected by a YOLO mask, building it on
+        first use.
+
+        Keyword arguments:
+        mask -- 3-dimensional tuple with mask specification for this output
+        """
+        anchors_tensor = self._anchors_cache.get(tuple(mask))
+        if anchors_tensor is None:
+            anchors = [self.anchors[i] for i in mask]
+            anchors_tensor = np.reshape(np.array(anchors, dtype=np.float32), [1, 1, len(anchors), 2])
+            self._anchors_cache[tuple(mask)] = anchors_tensor
+        return anchors_tensor
 
     def _filter_boxes(self, boxes, box_confidences, box_class_probs):
         """Take in the unfiltered bounding box descriptors and discard each cell
@@ -287,26 +510,50 @@ class PostprocessYOLO(object):
         box_classes = np.argmax(box_scores, axis=-1)
         box_class_scores = np.max(box_scores, axis=-1)
 
-        thresholds = [self.object_threshold[cls] for cls in box_classes.flatten()]
-        thresholds = np.reshape(thresholds, box_class_scores.shape)
+        thresholds = self.object_threshold[box_classes]
         pos = np.where(box_class_scores >= thresholds)
 
-
         boxes = boxes[pos]
         classes = box_classes[pos]
         scores = box_class_scores[pos]
 
         return boxes, classes, scores
 
-    def _nms_boxes(self, boxes, box_confidences):
+    def _nms_boxes_per_class(self, boxes, box_categories, box_confidences):
+        """Apply the Non-Maximum Suppression (NMS) algorithm on the bounding boxes of each class
+        and return an array with the indexes of the bounding boxes we want to keep, ordered by
+        decreasing confidence. The per-class and total detection limits set during class
+        initialization are applied to the result.
+
+        Keyword arguments:
+        boxes -- a NumPy array containing N bounding-box coordinates that survived filtering,
+        with shape (N,4); 4 for x,y,height,width coordinates of the boxes
+        box_categories -- a NumPy array containing the corresponding class IDs with shape N
+        box_confidences -- a Numpy array containing the corresponding confidences with shape N
+        """
+        keep = list()
+        for category in np.unique(box_categories):
+            idxs = np.where(box_categories == category)[0]
+            kept = self._nms_boxes(boxes[idxs], box_confidences[idxs], self.nms_threshold[category])
+            # The kept boxes are ordered by decreasing confidence, so the limit keeps the most confident ones:
+            keep.append(idxs[kept[: self.max_detections[category]]])
+
+        keep = np.concatenate(keep)
+        keep = keep[np.argsort(-box_confidences[keep], kind="stable")]
+        if self.top_k is not None:
+            keep = keep[: self.top_k]
+        return keep
+
+    def _nms_boxes(self, boxes, box_confidences, nms_threshold):
         """Apply the Non-Maximum Suppression (NMS) algorithm on the bounding boxes with their
         confidence scores and return an array with the indexes of the bounding boxes we want to
-        keep (and display later).
+        keep (and display later), ordered by decreasing confidence.
 
         Keyword arguments:
         boxes -- a NumPy array containing N bounding-box coordinates that survived filtering,
         with shape (N,4); 4 for x,y,height,width coordinates of the boxes
         box_confidences -- a Numpy array containing the corresponding confidences with shape N
+        nms_threshold -- the IoU threshold above which a box is suppressed
         """
         x_coord = boxes[:, 0]
         y_coord = boxes[:, 1]
@@ -318,22 +565,19 @@ class PostprocessYOLO(object):
 
         keep = list()
         while ordered.size > 0:
-            # Index of the current element:
+            # Index of the current element and the remaining candidates:
             i = ordered[0]
+            rest = ordered[1:]
             keep.append(i)
-            xx1 = np.maximum(x_coord[i], x_coord[ordered[1:]])
-            yy1 = np.maximum(y_coord[i], y_coord[ordered[1:]])
-            xx2 = np.minimum(
-                x_coord[i] + width[i], x_coord[ordered[1:]] + width[ordered[1:]]
-            )
-            yy2 = np.minimum(
-                y_coord[i] + height[i], y_coord[ordered[1:]] + height[ordered[1:]]
-            )
+            xx1 = np.maximum(x_coord[i], x_coord[rest])
+            yy1 = np.maximum(y_coord[i], y_coord[rest])
+            xx2 = np.minimum(x_coord[i] + width[i], x_coord[rest] + width[rest])
+            yy2 = np.minimum(y_coord[i] + height[i], y_coord[rest] + height[rest])
 
             width1 = np.maximum(0.0, xx2 - xx1 + 1)
             height1 = np.maximum(0.0, yy2 - yy1 + 1)
             intersection = width1 * height1
-            union = areas[i] + areas[ordered[1:]] - intersection
+            union = areas[i] + areas[rest] - intersection
 
             # Compute the Intersection over Union (IoU) score:
             iou = intersection / union
@@ -341,8 +585,7 @@ class PostprocessYOLO(object):
             # The goal of the NMS algorithm is to reduce the number of adjacent bounding-box
             # candidates to a minimum. In this step, we keep only those elements whose overlap
             # with the current bounding box is lower than the threshold:
-            indexes = np.where(iou <= self.nms_threshold)[0]
-            ordered = ordered[indexes + 1]
+            ordered = rest[iou <= nms_threshold]
 
-        keep = np.array(keep)
+        keep = np.array(keep, dtype=np.intp)
         return keep
@@ -1,175 +1,227 @@
 import cv2
 import numpy as np
-import tensorrt as trt
-import pycuda.driver as cuda
 import sys, os
-from PIL import ImageDraw
-from data_processing import PreprocessYOLO, PostprocessYOLO, ALL_CATEGORIES
-import common
+from collections import deque
+from data_processing import PreprocessYOLO, PostprocessYOLO
+from backends import TensorRTBackend, OnnxRuntimeBackend, ReplayBackend
+from V5Comm import DetectionBatch
+from recording import SessionReader
 
 # Set print options for NumPy, allowing the full array to be printed
 np.set_printoptions(threshold=sys.maxsize)
 
-# Define a constant for explicit batch processing
-EXPLICIT_BATCH = 1 << (int)(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH)
-# Create a logger instance for TensorRT
-TRT_LOGGER = trt.Logger()
+# Default configuration of the inference backend and the YOLO pre- and post-processing pipeline
+YOLO_CONFIG = {
+    "backend": "tensorrt",  # Inference backend: "tensorrt", "onnxruntime" (CPU) or "replay" (recorded outputs)
+    "fallback_backend": "onnxruntime",  # Backend used if the main one fails to load, None to disable
+    "onnx_file": "VEXOverUnder.onnx",  # If you change the onnx file to your own model, adjust the file name here
+    "engine_file": "VEXOverUnder.trt",  # This should match the .onnx file name
+    "replay_file": "VEXOverUnder_outputs.npz",  # Recorded network outputs, or a session recorded with them, to replay
+    "backend_slots": 4,  # Number of frames the backend can hold at once (being preprocessed, inferred or post-processed)
+    "yolo_masks": [(3, 4, 5), (0, 1, 2)],
+    "yolo_anchors": [(10, 14), (23, 27), (37, 58), (81, 82), (135, 169), (344, 319)],
+    "obj_threshold": [0.4, 0.90, 0.90],  # Different thresholds for each class label (Green, Red, Blue)
+    "nms_threshold": 0.5,
+    "yolo_input_resolution": (320, 320),  # Network input resolution in HW order
+    "output_shapes": [(1, 24, 10, 10), (1, 24, 20, 20)],  # Shapes of the network outputs in NCHW order
+    "hsv_enhancement": (12, 1.2, 1.1),  # Hue shift, saturation gain and value gain applied before inference
+}
 
 
 class Model:
     @staticmethod
-    def get_engine(onnx_file_path, engine_file_path=""):
-        # Attempts to load a pre-existing TensorRT engine, otherwise builds and returns a new one.
-
-        def build_engine():
-            print("Building engine file from onnx, this could take a while")
-            # Builds and returns a TensorRT engine from an ONNX file.
-            with trt.Builder(TRT_LOGGER) as builder, \
-                    builder.create_network(common.EXPLICIT_BATCH) as network, \
-                    builder.create_builder_config() as config, \
-                    trt.OnnxParser(network, TRT_LOGGER) as parser, \
-                    trt.Runtime(TRT_LOGGER) as runtime:
-
-                config.max_workspace_size = 1 << 28  # Set maximum workspace size to 256MiB
-                builder.max_batch_size = 1
-
-                # Check if ONNX file exists
-                if not os.path.exists(onnx_file_path):
-                    print("ONNX file {} not found.".format(onnx_file_path))
-                    exit(0)
-
-                # Load and parse the ONNX file
-                with open(onnx_file_path, "rb") as model:
-                    if not parser.parse(model.read()):
-                        print("ERROR: Failed to parse the ONNX file.")
-                        for error in range(parser.num_errors):
-                            print(parser.get_error(error))
-                        return None
-
-                # Set input shape for the network
-                network.get_input(0).shape = [1, 3, 320, 320]
-
-                # Build and serialize the network, then create and return the engine
-                plan = builder.build_serialized_network(network, config)
-                engine = runtime.deserialize_cuda_engine(plan)
-                with open(engine_file_path, "wb") as f:
-                    f.write(plan)
-                return engine
-
-        # Check if a serialized engine file exists and load it if so, otherwise build a new one
-        if os.path.exists(engine_file_path):
-            with open(engine_file_path, "rb") as f, trt.Runtime(TRT_LOGGER) as runtime:
-                return runtime.deserialize_cuda_engine(f.read())
-        else:
-            return build_engine()
-
-    @staticmethod
-    def image_processing(image):
+    def build_hsv_lut(hue_shift, saturation_gain, value_gain):
+        # Builds a 256-entry lookup table per HSV channel for the given enhancement parameters.
+        values = np.arange(256)
+
+        # OpenCV stores 8-bit hue in the range 0-179, so the shift wraps around at 180
+        hue = np.where(values < 180, (values + hue_shift) % 180, values)
+        saturation = np.clip(values * saturation_gain, 0, 255)
+        value = np.clip(values * value_gain, 0, 255)
+
+        # Shape (1, 256, 3) so cv2.LUT applies one table per channel
+        return np.dstack((hue, saturation, value)).astype(np.uint8)
+
+    def set_enhancement(self, hue_shift, saturation_gain, value_gain):
+        # Sets the hue shift, saturation gain and value gain of the image enhancement.
+        # The lookup tables are only rebuilt when the parameters change.
+        parameters = (hue_shift, saturation_gain, value_gain)
+        if parameters != self.hsv_enhancement:
+            self.hsv_lut = Model.build_hsv_lut(*parameters)
+            self.hsv_enhancement = parameters
+
+    def image_processing(self, image):
         # Enhances the image by shifting the hue and adjusting saturation and brightness.
 
+        # Reuse the intermediate images between frames of the same size
+        if self._hsv_image is None or self._hsv_image.shape != image.shape:
+            self._hsv_image = np.empty_like(image)
+            self._enhanced_image = np.empty_like(image)
+
         # Convert the image to HSV color space
-        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV, dst=self._hsv_image)
 
-        # Modify the hue, saturation, and value channels
-        hsv[..., 0] = hsv[..., 0] + 12
-        hsv[:, :, 1] = np.clip(hsv[:, :, 1] * 1.2, 0, 255)
-        hsv[:, :, 2] = np.clip(hsv[:, :, 2] * 1.1, 0, 255)
+        # Modify the hue, saturation, and value channels with the lookup tables
+        cv2.LUT(hsv, self.hsv_lut, dst=hsv)
 
         # Convert the image back to BGR color space
-        return cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
-
-    def __init__(self):
-        # Initialize the TensorRT engine and execution context.
+        return cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR, dst=self._enhanced_image)
 
-        # Define file paths for ONNX and engine files
+    @staticmethod
+    def create_backend(name, config):
+        # Create the inference backend with the given name, file names in config are relative to this folder.
         current_folder_path = os.path.dirname(os.path.abspath(__file__))
-        onnx_file_path = os.path.join(current_folder_path, "VEXOverUnder.onnx")  # If you change the onnx file to your own model, adjust the file name here
-        engine_file_path = os.path.join(current_folder_path, "VEXOverUnder.trt")  # This should match the .onnx file name
-
-        # Get the TensorRT engine
-        self.engine = Model.get_engine(onnx_file_path, engine_file_path)
-
-        # Create an execution context
-        self.context = self.engine.create_execution_context()
-
-        # Allocate buffers for input and output
-        self.inputs, self.outputs, self.bindings, self.stream = common.allocate_buffers(self.engine)
+        if name == "tensorrt":
+            return TensorRTBackend(os.path.join(current_folder_path, config["onnx_file"]),
+                                   os.path.join(current_folder_path, config["engine_file"]),
+                                   slots=config["backend_slots"])
+        elif name == "onnxruntime":
+            return OnnxRuntimeBackend(os.path.join(current_folder_path, config["onnx_file"]),
+                                      slots=config["backend_slots"])
+        elif name == "replay":
+            replay_path = os.path.join(current_folder_path, config["replay_file"])
+            if os.path.isdir(replay_path):
+                # A session recorded with --record holds the outputs of the network it was recorded with
+                return ReplayBackend.from_files(SessionReader(replay_path).output_files(), slots=config["backend_slots"])
+            return ReplayBackend.from_file(replay_path, slots=config["backend_slots"])
+        raise Exception("Invalid argument: Backend not accepted")
+
+    def __init__(self, config=None, backend=None):
+        # Initialize the inference backend and the pre/post-processing pipeline.
+        # Entries of config override the defaults in YOLO_CONFIG.
+        # Without a backend, the one selected in the config is created.
+        self.config = dict(YOLO_CONFIG)
+        if config is not None:
+            self.config.update(config)
+
+        # Load the network and allocate the input and output buffers of every slot
+        if backend is None:
+            backend = Model.create_backend(self.config["backend"], self.config)
+        try:
+            backend.load()
+        except Exception as e:
+            # Keep running in a degraded mode, e.g. if the TensorRT engine fails to deserialize
+            if self.config["fallback_backend"] is None:
+                raise
+            print("Could not load the inference backend, falling back to ", self.config["fallback_backend"], ". Exception: ", e)
+            backend = Model.create_backend(self.config["fallback_backend"], self.config)
+            backend.load()
+        self.backend = backend
+
+        # The preprocessed images are written straight into these host input buffers, which must never be replaced
+        self._input_buffers = [self.backend.get_input(slot) for slot in range(self.backend.slots)]
+
+        # Called with the raw outputs and the frame index of every post-processed frame, e.g. to record them
+        self.on_outputs = None
+
+        # Frames submitted to the backend and not yet polled, as (slot, image, letterbox, frame index) in submission order
+        self._pending = deque()
+        self._next_slot = 0
+
+        # Build the pre/post-processing pipeline once, it is reused for every frame
+        self.output_shapes = self.config["output_shapes"]
+        self.hsv_enhancement = None
+        self.set_enhancement(*self.config["hsv_enhancement"])
+        self._hsv_image = None
+        self._enhanced_image = None
+        self.preprocessor = PreprocessYOLO(self.config["yolo_input_resolution"], enhance=self.image_processing)
+        self.postprocessor = PostprocessYOLO(
+            yolo_masks=self.config["yolo_masks"],
+            yolo_anchors=self.config["yolo_anchors"],
+            obj_threshold=self.config["obj_threshold"],
+            nms_threshold=self.config["nms_threshold"],
+            yolo_input_resolution=self.config["yolo_input_resolution"],
+        )
+
+    def set_thresholds(self, obj_threshold=None, nms_threshold=None, max_detections=None):
+        # Update the per-class detection thresholds in place, can be called while inference is running.
+        self.postprocessor.set_thresholds(obj_threshold, nms_threshold, max_detections)
+
+    def get_thresholds(self):
+        # Return the current per-class detection thresholds, see PostprocessYOLO.get_thresholds
+        return self.postprocessor.get_thresholds()
+
+    def submit(self, inputImage, roi=None, frame_index=None):
+        # Preprocess the image into a free backend slot and start inference on it without waiting for the result.
+        # With a region of interest (left, top, right, bottom), the network looks at that part of the image only.
+        # The frame index, if given, is the index of the image in the camera stream, see postprocess().
+        # Returns False if all slots are busy, poll() has to be called first.
+        if len(self._pending) == self.backend.slots:
+            return False
+
+        slot = self._next_slot
+        letterbox = self.get_letterbox(inputImage, roi)
+        image_raw = self.preprocess(inputImage, slot, letterbox, frame_index)
+
+        # Start inference
+        self.backend.submit(slot)
+        self._pending.append((slot, image_raw, letterbox, frame_index))
+        self._next_slot = (slot + 1) % self.backend.slots
+        return True
+
+    def get_letterbox(self, inputImage, roi):
+        # Return the transform that zooms the network input in on a region of interest of the image, or None
+        return self.preprocessor.get_letterbox(inputImage.shape, roi)
+
+    def preprocess(self, inputImage, slot, letterbox=None, frame_index=None):
+        # Resize and color correct the image, writing the network input straight into the host input buffer of the
+        # given backend slot. Returns the image the detections are drawn on.
+        # The letterbox from get_letterbox has to be passed to postprocess() for the same image as well.
+        # The frame index tells the replay backend which recorded outputs belong to the image.
+        self.backend.set_frame(slot, frame_index)
+        host_input = self.backend.get_input(slot)
+        assert host_input is self._input_buffers[slot], "Host input buffer was reallocated"
+        image_raw, image = self.preprocessor.process(inputImage, out=host_input, letterbox=letterbox)
+        assert np.shares_memory(image, host_input), "Preprocessed image was not written into the host input buffer"
+        return image_raw
 
-    def inference(self, inputImage):
+    def infer(self, slot):
+        # Run inference on the preprocessed image in the given backend slot and wait for the outputs.
+        # The outputs stay valid until the slot is used again.
+        self.backend.submit(slot)
+        return self.backend.get_outputs(slot)
+
+    def poll(self, block=False):
+        # Return the output image and detected objects of the oldest submitted frame once it is done.
+        # Returns None if no frame is pending, or if block is False and the oldest frame is not done yet.
+        if not self._pending:
+            return None
+        slot, image_raw, letterbox, frame_index = self._pending[0]
+        if not block and not self.backend.is_done(slot):
+            return None
+        self._pending.popleft()
+        return self.postprocess(image_raw, self.backend.get_outputs(slot), letterbox, frame_index)
+
+    def inference(self, inputImage, roi=None, frame_index=None):
         # Perform inference on the given image and return the bounding boxes, scores, and classes of detected objects.
-
-        # Process the input image
-        input_image = Model.image_processing(inputImage)
-
-        # Define input resolution and create preprocessor
-        input_resolution_yolov3_HW = (320, 320)
-        preprocessor = PreprocessYOLO(input_resolution_yolov3_HW)
-
-        # Process the image and get original shape
-        image_raw, image = preprocessor.process(input_image)
-        shape_orig_WH = image_raw.size
-
-        # Define output shapes for post-processing
-        output_shapes = [(1, 24, 10, 10), (1, 24, 20, 20)]
-
-        # Set the input and perform inference
-        self.inputs[0].host = image
-        trt_outputs = common.do_inference_v2(self.context, bindings=self.bindings, inputs=self.inputs,
-                                             outputs=self.outputs, stream=self.stream)
-
-        # Reshape the outputs for post-processing
-        trt_outputs = [output.reshape(shape) for output, shape in zip(trt_outputs, output_shapes)]
-
-        # Define arguments for post-processing
-        postprocessor_args = {
-            "yolo_masks": [(3, 4, 5), (0, 1, 2)],
-            "yolo_anchors": [(10, 14), (23, 27), (37, 58), (81, 82), (135, 169), (344, 319)],
-            "obj_threshold": [0.4, 0.90, 0.90],  # Different thresholds for each class label (Green, Red, Blue)
-            "nms_threshold": 0.5,
-            "yolo_input_resolution": input_resolution_yolov3_HW,
-        }
+        # Frames still pending from submit() are finished first and their results dropped.
+        while not self.submit(inputImage, roi, frame_index):
+            self.poll(block=True)
+        while len(self._pending) > 1:
+            self.poll(block=True)
+        return self.poll(block=True)
+
+    def postprocess(self, image_raw, outputs, letterbox=None, frame_index=None):
+        # Turn the network outputs for an image into the output image and a DetectionBatch of the detected objects.
+        # The boxes are mapped back to the full image if it was preprocessed with a letterbox.
+        # The outputs are passed to on_outputs with the frame index, so recorded outputs can be paired with their frames.
+        shape_orig_WH = (image_raw.shape[1], image_raw.shape[0])
+        if self.on_outputs is not None:
+            self.on_outputs(outputs, frame_index)
+
+        # Reshape the outputs for post-processing, these are views on the backend's output buffers
+        outputs = [output.reshape(shape) for output, shape in zip(outputs, self.output_shapes)]
 
         # Perform post-processing
-        postprocessor = PostprocessYOLO(**postprocessor_args)
-        boxes, classes, scores = postprocessor.process(trt_outputs, (shape_orig_WH))
-
-        Detections = []
+        boxes, classes, scores = self.postprocessor.process(outputs, (shape_orig_WH), letterbox)
 
         # Handle case with no detections
         if boxes is None or classes is None or scores is None:
             print("No objects were detected.")
-            return input_image, Detections
-
-        # Draw bounding boxes and return detected objects
-        obj_detected_img = Model.draw_bboxes(image_raw, boxes, scores, classes, ALL_CATEGORIES, Detections)
-        obj_detected_img = obj_detected_img.convert("RGB")
-        return np.array(obj_detected_img), Detections
-
-    @staticmethod
-    def draw_bboxes(image_raw, bboxes, confidences, categories, all_categories, Detections, bbox_color="white"):
-        # Draw bounding boxes on the original image and return it.
-
-        # Create drawing context
-        draw = ImageDraw.Draw(image_raw)
-
-        # Draw each bounding box
-        for box, score, category in zip(bboxes, confidences, categories):
-            x_coord, y_coord, width, height = box
-            left = max(0, np.floor(x_coord + 0.5).astype(int))
-            top = max(0, np.floor(y_coord + 0.5).astype(int))
-            right = min(image_raw.width, np.floor(x_coord + width + 0.5).astype(int))
-            bottom = min(image_raw.height, np.floor(y_coord + height + 0.5).astype(int))
+            return image_raw, DetectionBatch()
 
-            # Draw the rectangle and text
-            # draw.rectangle(((left, top), (right, bottom)), outline=bbox_color)
-            # draw.text((left, top - 12), "{0} {1:.2f}".format(all_categories[category], score), fill=bbox_color)
-
-            # Create and store the raw detection object
-            raw_detection = rawDetection(int(left), int(top), [x_coord, y_coord], int(width), int(height), score,
-                                         category)
-            Detections.append(raw_detection)
-
-        return image_raw
+        # Store the detected objects column by column, without an object per detection
+        return image_raw, DetectionBatch.from_boxes(boxes, scores, classes)
 
 
 class rawDetection:
@@ -4,8 +4,11 @@ import numpy as np
 import cv2
 import time
 import os
+import argparse
+import queue
 
-from V5MapPosition import MapPosition
+from V5MapPosition import MapPosition, CameraIntrinsics
+from V5OccupancyGrid import OccupancyGrid
 
 import V5Comm
 from V5Comm import V5SerialComms
@@ -15,23 +18,45 @@ from V5Web import V5WebData
 from V5Web import Statistics
 
 from model import Model
+from pipeline import LatestQueue, PipelineStage
+from recording import SessionRecorder, SessionReader
+from tracker import Tracker
+from scheduler import DetectionScheduler
+
+# Intrinsics of the last used camera are stored next to the camera offsets
+INTRINSICS_FILE = "camera_intrinsics.json"
+# CPU temperature of the Jetson in millidegrees C, other machines do not have this file
+THERMAL_FILE = "/sys/devices/virtual/thermal/thermal_zone1/temp"
+
+
+def read_cpu_temp():
+    # Return the CPU temperature in degrees C, or 0 if it cannot be read, e.g. when not running on a Jetson
+    try:
+        with open(THERMAL_FILE, 'r') as f:
+            return float(f.read()) / 1000
+    except (OSError, ValueError):
+        return 0.0
 
 
 class Camera:
     # Class handles Camera object instantiation and data requests.
-    def __init__(self):
+    def __init__(self, width=640, height=480, fps=30):
         self.pipeline = rs.pipeline()  # Initialize RealSense pipeline
         self.config = rs.config()
-        # Enable depth stream at 640x480 in z16 encoding at 30fps
-        self.config.enable_stream(rs.stream.depth, 640, 480, rs.format.z16, 30)
-        # Enable color stream at 640x480 in bgr8 encoding at 30fps
-        self.config.enable_stream(rs.stream.color, 640, 480, rs.format.bgr8, 30)
+        # Enable depth stream at 640x480 in z16 encoding at 30fps by default
+        self.config.enable_stream(rs.stream.depth, width, height, rs.format.z16, fps)
+        # Enable color stream at 640x480 in bgr8 encoding at 30fps by default
+        self.config.enable_stream(rs.stream.color, width, height, rs.format.bgr8, fps)
 
     def start(self):
         self.profile = self.pipeline.start(self.config)  # Start the pipeline
         # Obtain depth sensor and calculate depth scale
         depth_sensor = self.profile.get_device().first_depth_sensor()
         self.depth_scale = depth_sensor.get_depth_scale()
+        # Depth is aligned to the color stream, so the color intrinsics apply to both images
+        color_profile = self.profile.get_stream(rs.stream.color).as_video_stream_profile()
+        self.intrinsics = CameraIntrinsics.from_realsense(color_profile.get_intrinsics())
+        self.intrinsics.to_JSON(INTRINSICS_FILE)
 
     def get_frames(self):
         return self.pipeline.wait_for_frames()  # Wait and fetch frames from the pipeline
@@ -40,37 +65,268 @@ class Camera:
         self.pipeline.stop()  # Stop the pipeline when finished
 
 
+class SyntheticFrame:
+    # Stand-in for a RealSense frame holding a numpy image.
+    def __init__(self, image):
+        self.image = image
+
+    def __bool__(self):
+        return True
+
+    def get_data(self):
+        return self.image
+
+
+class SyntheticFrames:
+    # Stand-in for a RealSense frameset whose depth frame is already aligned to the color frame.
+    def __init__(self, depth_image, color_image):
+        self.depth_frame = SyntheticFrame(depth_image)
+        self.color_frame = SyntheticFrame(color_image)
+
+    def get_depth_frame(self):
+        return self.depth_frame
+
+    def get_color_frame(self):
+        return self.color_frame
+
+
+class SyntheticCamera:
+    # Camera stand-in that generates aligned color and depth frames, to run the program without a RealSense.
+    # The color image is a gray field with three moving triball colored disks, the depth image a flat plane.
+    def __init__(self, width=640, height=480, fps=30, depth=1.0):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.depth = depth  # Distance of the depth plane in meters
+        self.frameCount = 0
+
+    def start(self):
+        self.depth_scale = 0.001  # Depth units of 1mm, like the D435
+        self.intrinsics = CameraIntrinsics().scaled(self.width, self.height)
+        self.depth_image = np.full((self.height, self.width), int(self.depth / self.depth_scale), dtype=np.uint16)
+        self.last_frame_time = time.time()
+
+    def get_frames(self):
+        # Wait for the next frame time to simulate the camera frame rate
+        delay = self.last_frame_time + 1.0 / self.fps - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        self.last_frame_time = time.time()
+
+        color_image = np.full((self.height, self.width, 3), 128, dtype=np.uint8)
+        for i, color in enumerate([(0, 200, 0), (0, 0, 200), (200, 0, 0)]):  # Green, Red, Blue in BGR
+            x = (self.frameCount * 4 + i * self.width // 3) % self.width
+            cv2.circle(color_image, (x, self.height // 2), 30, color, -1)
+        self.frameCount += 1
+        return SyntheticFrames(self.depth_image, color_image)
+
+    def stop(self):
+        pass
+
+
+class ReplayCamera:
+    # Camera stand-in that plays back a session recorded with --record, either at the recorded frame rate or as fast
+    # as possible. The recorded frames are already aligned. Raises EOFError at the end of the recording.
+    def __init__(self, directory, realtime=True):
+        self.directory = directory
+        self.realtime = realtime
+        self.position = Position(0, 0, 0, 0, 0, 0, 0, 0)  # GPS position recorded with the last frame
+
+    def start(self):
+        self.reader = SessionReader(self.directory)
+        self.depth_scale = self.reader.depth_scale
+        if self.reader.intrinsics is not None:
+            self.intrinsics = CameraIntrinsics.from_dict(self.reader.intrinsics)
+        else:
+            self.intrinsics = CameraIntrinsics.from_JSON(INTRINSICS_FILE)
+        self.frames = iter(self.reader)
+        self.first_timestamp = None
+
+    def get_frames(self):
+        try:
+            timestamp, depth_image, color_image, position = next(self.frames)
+        except StopIteration:
+            raise EOFError("End of the recorded session")
+
+        if self.realtime:
+            # Wait until the frame is due, relative to the first frame of the recording
+            if self.first_timestamp is None:
+                self.first_timestamp = timestamp
+                self.start_time = time.time()
+            delay = (timestamp - self.first_timestamp) - (time.time() - self.start_time)
+            if delay > 0:
+                time.sleep(delay)
+
+        self.position = position
+        return SyntheticFrames(depth_image, color_image)
+
+    def stop(self):
+        pass
+
+
+class ReplayGPS:
+    # V5GPS stand-in that reports the GPS position recorded with the frame last returned by a ReplayCamera.
+    def __init__(self, camera):
+        self.camera = camera
+
+    def start(self):
+        pass
+
+    def getPosition(self):
+        return self.camera.position
+
+    def isConnected(self):
+        return True
+
+    def updateOffset(self, newOffset):
+        # The recorded positions already have the GPS offset applied
+        pass
+
+    def stop(self):
+        pass
+
+
+class FrameData:
+    # Data of one camera frame as it moves through the stages of the pipeline.
+    def __init__(self, depth_image, color_image, depth_map, index=None):
+        self.captureTime = time.time()
+        self.index = index  # Index of the frame in the camera stream, pairs recorded network outputs with their frame
+        self.depth_image = depth_image
+        self.color_image = color_image
+        self.depth_map = depth_map
+        self.slot = None  # Backend slot holding the preprocessed image and network outputs
+        self.letterbox = None  # Transform of the region of interest the network looked at, None for the full image
+        self.image_raw = None
+        self.outputs = None
+        self.output = None
+        self.invokeTime = 0
+        self.aiRecord = None
+        self.gray = None  # Downsampled gray image for the detection scheduler
+        self.skipped = False  # True if the detections are propagated from the previous frame instead of inferred
+
+
 class Processing:
     # Class to handle camera data processing, preparing for inference, and running inference on camera image.
-    def __init__(self, depth_scale):
+    # Ways of combining the depth pixels of a detection into one depth
+    DEPTH_METHODS = ("mean", "median", "trimmed_mean")
+    # Below this many detections, slicing each region is faster than gathering all regions in one pass
+    SMALL_BATCH = 8
+
+    def __init__(self, depth_scale, align=True, model_config=None, depth_method="mean", trim_fraction=0.1):
+        if depth_method not in Processing.DEPTH_METHODS:
+            raise Exception("Invalid argument: Depth method not accepted")
+        if not 0 <= trim_fraction < 0.5:
+            raise ValueError("trim_fraction must be at least 0 and less than 0.5")
         self.depth_scale = depth_scale
+        self.depth_method = depth_method
+        self.trim_fraction = trim_fraction  # Fraction of the depth values dropped at both ends for trimmed_mean
         self.align_to = rs.stream.color
-        self.align = rs.align(self.align_to)  # Align depth frames to color stream
-        self.model = Model()  # Initialize the object detection model
+        # Align depth frames to color stream, unless the camera provides aligned frames
+        self.align = rs.align(self.align_to) if align else None
+        self.model = Model(model_config)  # Initialize the object detection model
 
     def get_depth(self, detection, depth_img):
-        # Compute the bounding box indices for the detection
-        height = detection.Height
-        width = detection.Width
-
-        # Calculate the indices of the middle 10% of the detection.
-        top = int(detection.y) + height * 45 // 100
-        bottom = int(detection.y) + height * 55 // 100
-        left = int(detection.x) + width * 45 // 100
-        right = int(detection.x) + width * 55 // 100
-
-        # Extract depth values and scale them
-        depth_img = depth_img[top:bottom, left:right].astype(float)
-        depth_img = depth_img * self.depth_scale
-        # Filter non-zero depth values
-        depth_img = depth_img[depth_img != 0]
-        # Compute and return mean depth value
-        meanDepth = np.nanmean(depth_img)
-        return meanDepth
+        # Return the depth of a single rawDetection, see get_depths
+        return self.get_depths(V5Comm.DetectionBatch.from_raw_detections([detection]), depth_img)[0]
+
+    def get_depths(self, detections, depth_img):
+        # Compute the depth of every detection of a DetectionBatch in one pass, from the middle 10% of each bounding box.
+        # Pixels without depth (0) are ignored, a detection without any valid pixel gets a depth of NaN.
+        count = len(detections)
+        if count == 0:
+            return np.zeros(0)
+        if count < Processing.SMALL_BATCH:
+            return self._get_depths_per_roi(detections, depth_img)
+        x, y, width, height = (detections.data[name].astype(np.int64) for name in ("x", "y", "width", "height"))
+
+        # Calculate the indices of the middle 10% of the detections, clipped to the image
+        top = np.clip(y + height * 45 // 100, 0, depth_img.shape[0])
+        bottom = np.clip(y + height * 55 // 100, top, depth_img.shape[0])
+        left = np.clip(x + width * 45 // 100, 0, depth_img.shape[1])
+        right = np.clip(x + width * 55 // 100, left, depth_img.shape[1])
+        roi_size = (bottom - top) * (right - left)
+        starts = np.cumsum(roi_size) - roi_size
+        depths = np.full(count, np.nan)
+        found = roi_size > 0
+        if not found.any():
+            return depths
+
+        starts = starts[found]
+        values = self._gather_regions(depth_img, top[found], bottom[found], left[found], right[found], starts)
+
+        # Pixels without depth (0) are left in place and only counted out, each region is a segment of values
+        valid_count = np.add.reduceat(values != 0, starts, dtype=np.intp)
+        zero_count = roi_size[found] - valid_count
+        has_depth = valid_count > 0
+        found[found] = has_depth
+        valid_count = valid_count[has_depth]
+
+        if self.depth_method == "mean":
+            depths[found] = np.add.reduceat(values, starts, dtype=np.float64)[has_depth] / valid_count
+        else:
+            # Sort the values of each detection, the regions are already in order so one sort over a combined key
+            # does it. The zeros end up at the start of each region.
+            keys = np.repeat(np.arange(count, dtype=np.int64) << 16, roi_size)
+            keys |= values
+            keys.sort()
+            keys &= 0xFFFF
+            first = (starts + zero_count)[has_depth]
+            if self.depth_method == "median":
+                depths[found] = (keys[first + (valid_count - 1) // 2] + keys[first + valid_count // 2]) / 2
+            else:
+                # Mean of the values left after dropping trim_fraction of the values at both ends
+                trim = (valid_count * self.trim_fraction).astype(np.int64)
+                sums = np.cumsum(keys, out=keys)
+                low = first + trim
+                high = first + valid_count - trim
+                depths[found] = (sums[high - 1] - np.where(low > 0, sums[low - 1], 0)) / (valid_count - 2 * trim)
+
+        # Scale only the final values to the depth units
+        return depths * self.depth_scale
+
+    @staticmethod
+    def _gather_regions(depth_img, top, bottom, left, right, starts):
+        # The depth values of all regions one after the other, each region row by row. starts holds the position of
+        # the first value of each region. The flat image index of every value is one run of consecutive indices per
+        # row of a region, so only the first index of each row needs computing and a cumulative sum of the steps
+        # fills in the rest.
+        heights = bottom - top
+        widths = right - left
+        row_ids = np.repeat(np.arange(len(heights)), heights)
+        row_offsets = np.arange(len(row_ids)) - np.repeat(np.cumsum(heights) - heights, heights)
+        row_widths = widths[row_ids]
+        row_first = (top[row_ids] + row_offsets) * depth_img.shape[1] + left[row_ids]
+        row_last = row_first + row_widths - 1
+        index = np.ones(int(starts[-1] + heights[-1] * widths[-1]), dtype=np.intp)
+        index[starts[row_ids] + row_offsets * row_widths] = row_first - np.concatenate(([0], row_last[:-1]))
+        return depth_img.reshape(-1)[np.cumsum(index, out=index)]
+
+    def _get_depths_per_roi(self, detections, depth_img):
+        # get_depths for a few detections, one slice of the depth image per detection
+        height_img, width_img = depth_img.shape[:2]
+        depths = np.full(len(detections), np.nan)
+        for i, (x, y, width, height) in enumerate(detections.data[["x", "y", "width", "height"]].tolist()):
+            top = min(max(y + height * 45 // 100, 0), height_img)
+            left = min(max(x + width * 45 // 100, 0), width_img)
+            values = depth_img[top:max(y + height * 55 // 100, top), left:max(x + width * 55 // 100, left)]
+            values = values[values != 0]
+            count = len(values)
+            if count == 0:
+                continue
+            if self.depth_method == "mean":
+                depths[i] = values.mean()
+                continue
+            values = np.sort(values)
+            if self.depth_method == "median":
+                depths[i] = (int(values[(count - 1) // 2]) + int(values[count // 2])) / 2
+            else:
+                trim = int(count * self.trim_fraction)
+                depths[i] = values[trim:count - trim].mean()
+        return depths * self.depth_scale
 
     def align_frames(self, frames):
         # Align depth frames to color frames
-        aligned_frames = self.align.process(frames)
+        aligned_frames = self.align.process(frames) if self.align is not None else frames
         # Get the aligned frames and validate them
         self.depth_frame_aligned = aligned_frames.get_depth_frame()
         self.color_frame_aligned = aligned_frames.get_color_frame()
@@ -90,34 +346,31 @@ class Processing:
 
         return depth_image, color_image, depth_map
 
-    def detect_objects(self, color_image):
+    def detect_objects(self, color_image, roi=None, frame_index=None):
         # Perform object detection and return results using the Model class in model.py
-        output, detections = self.model.inference(color_image)
+        # With a region of interest (left, top, right, bottom), only that part of the image is searched
+        output, detections = self.model.inference(color_image, roi, frame_index)
         return output, detections
 
     def compute_detections(self, v5, detections, depth_image):
         # Create AIRecord and compute detections with depth and image data.
         # Each AIRecord contains the ClassID, Probablity, and depth information for each detection
         # In addition to the detection's camera image and map position information.
-        aiRecord = V5Comm.AIRecord(v5.get_v5Pos(), [])
-        for detection in detections:
-            depth = self.get_depth(detection, depth_image)
-            imageDet = V5Comm.ImageDetection(
-                int(detection.x),
-                int(detection.y),
-                int(detection.Width),
-                int(detection.Height),
-            )
-            mapPos = v5.v5Map.computeMapLocation(detection, depth, aiRecord.position)
-            mapDet = V5Comm.MapDetection(mapPos[0], mapPos[1], mapPos[2])
-            detect = V5Comm.Detection(
-                int(detection.ClassID),
-                float(detection.Prob),
-                float(depth),
-                imageDet,
-                mapDet,
-            )
-            aiRecord.detections.append(detect)
+        # The depth and map position are filled into the columns of the DetectionBatch in place.
+        # Detections without valid depth keep NaN for both and are not projected onto the map.
+        aiRecord = V5Comm.AIRecord(v5.get_v5Pos(), detections)
+        data = detections.data
+        data["depth"] = self.get_depths(detections, depth_image)
+        valid = detections.has_depth()
+        for name in ("mapX", "mapY", "mapZ"):
+            data[name] = np.nan
+        if valid.any():
+            rows = data[valid]
+            centers = np.stack((rows["centerX"], rows["centerY"]), axis=1)
+            mapLocations = v5.v5Map.computeMapLocations(centers, rows["depth"], aiRecord.position)
+            data["mapX"][valid] = mapLocations[:, 0]
+            data["mapY"][valid] = mapLocations[:, 1]
+            data["mapZ"][valid] = mapLocations[:, 2]
         return aiRecord
 
 
@@ -141,9 +394,7 @@ class Rendering:
         stats.gpsConnected = v5Pos.isConnected()
         stats.invokeTime = invoke_time
         stats.runTime = time.time() - run_time
-        temp_str = os.popen("cat /sys/devices/virtual/thermal/thermal_zone1/temp").read().rstrip("\n")
-        temp = float(temp_str) / 1000
-        stats.cpuTemp = temp
+        stats.cpuTemp = read_cpu_temp()
         self.web_data.setStatistics(stats)
 
     def display_output(self, output):
@@ -157,18 +408,53 @@ class Rendering:
 
 
 class MainApp:
-    def __init__(self):
+    def __init__(self, camera=None, model_config=None, record_directory=None, occupancy=False, max_interval=1,
+                 roi=False, push_rate=30.0):
         # Initialize various components including camera, processing, and rendering
+        # Without a camera, the Intel RealSense camera is used
+        # With a record directory, the camera frames and GPS positions are recorded for replay with ReplayCamera
+        # With occupancy, an occupancy grid of the field is built from every depth image for the web dashboard
+        # With a max_interval above 1, the network can skip up to max_interval - 1 frames in a row
+        # With roi, the network only looks at the part of the image where the field floor is
+        # The push rate limits how many packets per second are sent to a V5 Brain that requested push mode
         print("Starting Intialization...")
-        self.camera = Camera()
+        self.camera = camera if camera is not None else Camera()
         self.camera.start()
-        self.v5 = V5SerialComms()
-        self.v5Map = MapPosition()
-        self.v5Pos = V5GPS()
+        self.v5 = V5SerialComms(pushRate=push_rate)
+        self.v5Map = MapPosition(self.camera.intrinsics)
+        # A replayed session also replays the recorded GPS positions
+        self.v5Pos = ReplayGPS(self.camera) if isinstance(self.camera, ReplayCamera) else V5GPS()
         self.v5Web = V5WebData(self.v5Map, self.v5Pos)
-        self.stats = Statistics(0, 0, 0, 640, 480, 0, False)
-
-        self.processing = Processing(self.camera.depth_scale)
+        self.stats = Statistics(0, 0, 0, self.camera.intrinsics.width, self.camera.intrinsics.height, 0, False)
+        self.stages = []
+        self.occupancyGrid = OccupancyGrid(self.v5Map) if occupancy else None
+        self.tracker = Tracker()  # Gives the detections a track ID and velocity that persist across frames
+        self.scheduler = DetectionScheduler(max_interval)
+        self.roi = roi
+        # A recording replayed as fast as possible is a benchmark: instead of dropping frames, every stage waits
+        # for the next one to have room, so each recorded frame is processed exactly once
+        self.backpressure = isinstance(self.camera, ReplayCamera) and not self.camera.realtime
+        self.running = False
+        # Frames captured so far, the index of a frame in the camera stream and in the recorded session
+        self.captured = 0
+        # Frames published since the start of run, for the overall frame rate and latency
+        self.published = 0
+        self.total_latency = 0.0
+        self.run_time = time.time()
+        self.last_publish_time = self.run_time
+
+        self.recorder = None
+        if record_directory is not None:
+            self.recorder = SessionRecorder(record_directory, self.camera.depth_scale,
+                                            intrinsics=self.camera.intrinsics.to_dict())
+
+        self.processing = Processing(self.camera.depth_scale, align=isinstance(self.camera, Camera),
+                                     model_config=model_config)
+        if self.recorder is not None:
+            # Record the network outputs too, so the session can be replayed with the replay backend
+            self.processing.model.on_outputs = self.recorder.write_outputs
+        # The detection thresholds can be tuned from the web dashboard
+        self.v5Web.setModel(self.processing.model)
         self.rendering = Rendering(self.v5Web)
         time.sleep(1)
         print("Initialized")
@@ -184,31 +470,280 @@ class MainApp:
         if self.v5 is not None:
             self.v5.setDetectionData(aiRecord)
 
+    def record_frame(self, depth_image, color_image):
+        # Record the aligned frames with the current GPS position when recording is enabled.
+        # Returns the index of the frame, which is the same in the camera stream and in the recorded session.
+        if self.recorder is not None:
+            self.recorder.write(depth_image, color_image, self.get_v5Pos())
+        self.captured += 1
+        return self.captured - 1
+
+    def get_roi(self):
+        # Return the region of the color image where the field floor is, from the GPS position and camera model.
+        # Returns None for the full image, if cropping is disabled, the GPS has no position or the field is not in view.
+        if not self.roi:
+            return None
+        position = self.get_v5Pos()
+        if not (position.status & Position.STATUS_CONNECTED):
+            return None
+        return self.v5Map.getFieldRegion(position)
+
+    def update_occupancy(self, depth_image, position):
+        # Rebuild the occupancy grid from the depth image when it is enabled
+        if self.occupancyGrid is not None:
+            self.occupancyGrid.update(depth_image, self.camera.depth_scale, position)
+            self.v5Web.setOccupancyGrid(self.occupancyGrid)
+
+    def capture_stage(self):
+        # Wait for the next camera frames, align them and apply a color map to the depth image
+        frames = self.camera.get_frames()
+        depth_image, color_image, depth_map = self.processing.process_frames(frames)
+        index = self.record_frame(depth_image, color_image)
+        return FrameData(depth_image, color_image, depth_map, index)
+
+    def preprocess_stage(self, frame):
+        # Preprocess the color image into a free backend slot, the frame is dropped if none frees up in time
+        # Frames the scheduler skips go straight to post-processing, without waiting for the network
+        # With backpressure, skipped frames pass through the inference stage instead, to keep the frames in order
+        frame.gray = self.scheduler.prepare(frame.color_image)
+        if not self.scheduler.should_detect(frame.gray, self.get_v5Pos(), self.stats.fps, self.stats.cpuTemp):
+            frame.skipped = True
+            if self.backpressure:
+                return frame
+            self.inferred.put(frame)
+            return None
+        while frame.slot is None:
+            try:
+                frame.slot = self.free_slots.get(timeout=0.1)
+            except queue.Empty:
+                if not (self.backpressure and self.running):
+                    return None
+        frame.letterbox = self.processing.model.get_letterbox(frame.color_image, self.get_roi())
+        frame.image_raw = self.processing.model.preprocess(frame.color_image, frame.slot, frame.letterbox, frame.index)
+        return frame
+
+    def inference_stage(self, frame):
+        # Run the network on the preprocessed image
+        if frame.skipped:
+            return frame
+        invoke_time = time.time()
+        frame.outputs = self.processing.model.infer(frame.slot)
+        frame.invokeTime = time.time() - invoke_time
+        return frame
+
+    def postprocess_stage(self, frame):
+        # Turn the network outputs into detections, then compute their depth and map position
+        # For skipped frames, the detections of the previous frame are moved with the optical flow instead
+        # Skipped frames overtake frames in inference, a frame older than the last one is only used to
+        # update the detections the scheduler propagates from
+        stale = frame.captureTime < self.last_capture_time
+        if frame.skipped:
+            if stale:
+                return None
+            frame.output = frame.color_image
+            detections = self.scheduler.propagate(frame.gray)
+        else:
+            frame.output, detections = self.processing.model.postprocess(frame.image_raw, frame.outputs,
+                                                                         frame.letterbox, frame.index)
+            self.release_slot(frame)
+            self.scheduler.set_detections(detections, frame.gray, frame.invokeTime)
+            if stale:
+                return None
+        self.last_capture_time = frame.captureTime
+        frame.aiRecord = self.processing.compute_detections(self, detections, frame.depth_image)
+        self.tracker.update(frame.aiRecord, frame.captureTime)
+        self.update_occupancy(frame.depth_image, frame.aiRecord.position)
+        return frame
+
+    def publish_stage(self, frame):
+        # Send the detections to the V5 Brain and the web dashboard, and update the statistics
+        self.set_v5(frame.aiRecord)
+        self.rendering.set_images(frame.output, frame.depth_map)
+        self.rendering.set_detection_data(frame.aiRecord)
+        self.stats.latency = time.time() - frame.captureTime
+        self.stats.stageTimes = self.get_stage_timings()
+        self.rendering.set_stats(self.stats, self.v5Pos, self.last_publish_time, frame.invokeTime, self.run_time)
+        self.count_published(self.stats.latency)
+
+    def count_published(self, latency):
+        # Count a published frame and its latency in seconds from capture to publishing
+        self.published += 1
+        self.total_latency += latency
+        self.last_publish_time = time.time()
+
+    def release_slot(self, frame):
+        # Return the backend slot of a frame that was post-processed or dropped
+        if frame.slot is not None:
+            self.free_slots.put(frame.slot)
+            frame.slot = None
+
+    def get_stage_timings(self):
+        # Return the timing counters of every pipeline stage
+        return {stage.name: stage.get_timing() for stage in self.stages}
+
+    def print_stage_timings(self):
+        # Print the timing counters of every pipeline stage, together with the overall frame rate and latency
+        # The frame rate is the number of frames published over the time since the start, the latency the average
+        elapsed = self.last_publish_time - self.run_time
+        print("FPS: %.1f, latency: %.1f ms, frames published: %d, detected: %d, skipped: %d" % (
+            self.published / elapsed if elapsed > 0 else 0.0,
+            self.total_latency / self.published * 1000 if self.published > 0 else 0.0,
+            self.published, self.scheduler.detected, self.scheduler.skipped))
+        for name, timing in self.get_stage_timings().items():
+            print("%-12s frames: %6d, average: %7.2f ms, last: %7.2f ms, dropped: %6d" % (
+                name, timing['count'], timing['average'] * 1000, timing['last'] * 1000, timing['dropped']))
+        if self.v5 is not None and self.v5.pollLatency.count > 0:
+            # Time the serial thread took from a poll of the V5 Brain to having written the packet
+            latency = self.v5.pollLatency
+            print("%-12s polls:  %6d, average: %7.2f ms, p99: <%6.2f ms, max: %7.2f ms" % (
+                "serial", latency.count, latency.total / latency.count * 1000, latency.percentile(99) * 1000,
+                latency.max * 1000))
+        if self.v5 is not None and self.v5.pushed > 0:
+            print("%-12s pushed: %6d" % ("serial", self.v5.pushed))
+
+    def stop_recording(self):
+        # Write the remaining recorded frames to disk
+        if self.recorder is not None:
+            self.processing.model.on_outputs = None
+            self.recorder.close()
+            self.recorder = None
+
     def run(self):
+        # Start the pipeline: capture frames, preprocess, detect objects, compute detections, render and publish,
+        # each on its own thread. Stages are connected by queues that keep only the latest frame, so a slow stage
+        # drops frames instead of adding latency. With backpressure, the queues block instead.
+        # Inference runs on this thread, which owns the CUDA context.
+        self.v5.start()
+        self.v5Pos.start()
+        self.v5Web.start()
+        self.run_time = time.time()
+        self.last_publish_time = self.run_time
+        self.published = 0
+        self.total_latency = 0.0
+
+        self.free_slots = queue.Queue()
+        for slot in range(self.processing.model.backend.slots):
+            self.free_slots.put(slot)
+
+        captured = LatestQueue(1, block=self.backpressure)
+        preprocessed = LatestQueue(1, on_drop=self.release_slot, block=self.backpressure)
+        inferred = LatestQueue(1, on_drop=self.release_slot, block=self.backpressure)
+        postprocessed = LatestQueue(1, block=self.backpressure)
+        self.inferred = inferred
+        self.last_capture_time = 0.0
+        self.stages = [
+            PipelineStage("capture", self.capture_stage, None, captured),
+            PipelineStage("preprocess", self.preprocess_stage, captured, preprocessed),
+            PipelineStage("inference", self.inference_stage, preprocessed, inferred),
+            PipelineStage("postprocess", self.postprocess_stage, inferred, postprocessed),
+            PipelineStage("publish", self.publish_stage, postprocessed, None),
+        ]
+        capture = self.stages[0]
+        inference = self.stages[2]
+        publish = self.stages[-1]
+
+        print("\nStarting Loop")
+        self.running = True
+        try:
+            for stage in self.stages:
+                if stage is not inference:
+                    stage.start()
+            while True:
+                inference.run_once()
+                for stage in self.stages:
+                    if stage.error is None:
+                        continue
+                    # At the end of a recording replayed with backpressure, the frames still in the pipeline are
+                    # finished first
+                    if (self.backpressure and stage is capture and isinstance(stage.error, EOFError)
+                            and publish.count < capture.count):
+                        continue
+                    raise stage.error
+        finally:
+            self.running = False
+            for stage in self.stages:
+                stage.stop()
+            self.camera.stop()
+            self.stop_recording()
+
+    def run_serial(self):
         # Start main loop: capture frames, process, detect objects, compute detections, render and display
+        # all on this thread, one frame at a time
         self.v5.start()
         self.v5Pos.start()
         self.v5Web.start()
         run_time = time.time()
+        self.run_time = run_time
+        self.last_publish_time = run_time
+        self.published = 0
+        self.total_latency = 0.0
         print("\nStarting Loop")
         try:
             while True:
                 start_time = time.time()  # start time of the loop
                 frames = self.camera.get_frames()
                 depth_image, color_image, depth_map = self.processing.process_frames(frames)
+                index = self.record_frame(depth_image, color_image)
+                gray = self.scheduler.prepare(color_image)
                 invoke_time = time.time()
-                output, detections = self.processing.detect_objects(color_image)
-                invoke_time = time.time() - invoke_time
+                if self.scheduler.should_detect(gray, self.get_v5Pos(), self.stats.fps, self.stats.cpuTemp):
+                    output, detections = self.processing.detect_objects(color_image, self.get_roi(), index)
+                    invoke_time = time.time() - invoke_time
+                    self.scheduler.set_detections(detections, gray, invoke_time)
+                else:
+                    output, detections = color_image, self.scheduler.propagate(gray)
+                    invoke_time = 0
                 aiRecord = self.processing.compute_detections(self, detections, depth_image)
+                self.tracker.update(aiRecord, start_time)
+                self.update_occupancy(depth_image, aiRecord.position)
                 self.set_v5(aiRecord)
                 self.rendering.set_images(output, depth_map)
                 self.rendering.set_detection_data(aiRecord)
                 self.rendering.set_stats(self.stats, self.v5Pos, start_time, invoke_time, run_time)
+                self.count_published(time.time() - start_time)
                 # self.rendering.display_output(output)
         finally:
             self.camera.stop()
+            self.stop_recording()
 
 
 if __name__ == "__main__":
-    app = MainApp()  # Create the main application
-    app.run()  # Run the application
+    parser = argparse.ArgumentParser(description="VEX AI OverUnder detection")
+    parser.add_argument("--synthetic", action="store_true", help="use generated camera frames instead of the RealSense")
+    parser.add_argument("--serial", action="store_true", help="run all steps on one thread, one frame at a time")
+    parser.add_argument("--resolution", default="640x480", help="camera resolution, e.g. 640x480, 848x480 or 424x240")
+    parser.add_argument("--record", metavar="DIR", help="record the camera frames and GPS positions to a directory")
+    parser.add_argument("--replay", metavar="DIR", help="replay a recorded session instead of using the RealSense and GPS")
+    parser.add_argument("--max-speed", action="store_true", help="replay as fast as possible instead of in real time")
+    parser.add_argument("--backend", help="inference backend to use: tensorrt, onnxruntime or replay")
+    parser.add_argument("--occupancy", action="store_true", help="build an occupancy grid of the field from the depth")
+    parser.add_argument("--roi", action="store_true",
+                        help="only run the network on the part of the image where the field floor is")
+    parser.add_argument("--max-interval", type=int, default=1,
+                        help="run the network at least every this many frames, tracking the detections in between")
+    parser.add_argument("--push-rate", type=float, default=30.0,
+                        help="most packets per second sent to a V5 Brain that requested push mode")
+    args = parser.parse_args()
+
+    width, height = (int(size) for size in args.resolution.split("x"))
+    if args.replay:
+        camera = ReplayCamera(args.replay, realtime=not args.max_speed)
+    elif args.synthetic:
+        camera = SyntheticCamera(width, height)
+    else:
+        camera = Camera(width, height)
+    model_config = {"backend": args.backend} if args.backend else None
+    if args.backend == "replay" and args.replay:
+        # Replay the network outputs recorded with the session
+        model_config["replay_file"] = os.path.abspath(args.replay)
+
+    app = MainApp(camera, model_config, args.record, args.occupancy, args.max_interval, args.roi,
+                  args.push_rate)  # Create the main application
+    try:
+        if args.serial:
+            app.run_serial()
+        else:
+            app.run()  # Run the application
+    except EOFError:
+        # The replayed session ended, report how each stage performed
+        app.print_stage_timings()
@@ -0,0 +1,130 @@
+import threading
+import time
+from collections import deque
+from threading import Condition
+
+
+class LatestQueue:
+    # Bounded queue between two pipeline stages. When it is full, putting a new item drops the oldest one,
+    # so a stalled consumer only ever sees the most recent items and the latency stays bounded.
+    # A blocking queue instead makes the producer wait for room, so every item is processed, e.g. for benchmarks.
+    def __init__(self, maxsize=1, on_drop=None, block=False):
+        self.maxsize = maxsize
+        self.on_drop = on_drop  # Called with every dropped item, e.g. to release the buffers it holds
+        self.block = block
+        self.dropped = 0
+        self.__items = deque()
+        self.__condition = Condition()
+
+    def put(self, item, timeout=None):
+        # Add an item, dropping the oldest one if the queue is full.
+        # A blocking queue waits up to timeout seconds for room instead, returns False if there was none.
+        with self.__condition:
+            if self.block:
+                if not self.__condition.wait_for(lambda: len(self.__items) < self.maxsize, timeout):
+                    return False
+            elif len(self.__items) >= self.maxsize:
+                dropped = self.__items.popleft()
+                self.dropped += 1
+                if self.on_drop is not None:
+                    self.on_drop(dropped)
+            self.__items.append(item)
+            self.__condition.notify_all()
+            return True
+
+    def get(self, timeout=None):
+        # Remove and return the oldest item, or None if no item arrived within the timeout
+        with self.__condition:
+            if not self.__condition.wait_for(lambda: len(self.__items) > 0, timeout):
+                return None
+            item = self.__items.popleft()
+            # Wake a producer waiting for room in a blocking queue
+            self.__condition.notify_all()
+            return item
+
+    def clear(self):
+        # Drop all items
+        with self.__condition:
+            while self.__items:
+                dropped = self.__items.popleft()
+                if self.on_drop is not None:
+                    self.on_drop(dropped)
+            self.__condition.notify_all()
+
+    def __len__(self):
+        return len(self.__items)
+
+
+class PipelineStage:
+    # Worker that takes items from an input queue, processes them and puts the results into an output queue.
+    # A stage without input queue is a source and calls its function without arguments.
+    # If the function returns None, nothing is passed on.
+    def __init__(self, name, function, input_queue=None, output_queue=None):
+        self.name = name
+        self.function = function
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self.error = None
+        self.__started = False
+        self.__stopped = False
+        self.__thread = None
+        # Timing counters
+        self.count = 0
+        self.lastTime = 0.0
+        self.totalTime = 0.0
+
+    def start(self):
+        # Start the stage on its own thread
+        self.__started = True
+        self.__thread = threading.Thread(target=self.run, args=(), name=self.name)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def run(self):
+        # Process items until the stage is stopped, on the calling thread.
+        # An exception stops the stage and is kept in error for the owner of the pipeline to handle.
+        self.__started = True
+        while self.__started:
+            try:
+                self.run_once()
+            except Exception as e:
+                self.error = e
+                self.__started = False
+
+    def run_once(self, timeout=0.1):
+        # Process a single item, waiting up to timeout seconds for one to arrive
+        if self.input_queue is None:
+            start_time = time.time()
+            result = self.function()
+        else:
+            item = self.input_queue.get(timeout)
+            if item is None:
+                return
+            start_time = time.time()
+            result = self.function(item)
+
+        self.lastTime = time.time() - start_time
+        self.totalTime += self.lastTime
+        self.count += 1
+
+        if result is not None and self.output_queue is not None:
+            # A blocking output queue is waited on until there is room, or the stage is stopped
+            while not self.output_queue.put(result, timeout):
+                if self.__stopped:
+                    break
+
+    def get_timing(self):
+        # Return the timing counters of this stage, times are in seconds
+        outData = {}
+        outData['count'] = self.count
+        outData['last'] = self.lastTime
+        outData['average'] = self.totalTime / self.count if self.count > 0 else 0.0
+        outData['dropped'] = self.input_queue.dropped if self.input_queue is not None else 0
+        return outData
+
+    def stop(self):
+        # Stop the stage and wait for its thread to finish
+        self.__started = False
+        self.__stopped = True
+        if self.__thread is not None and self.__thread is not threading.current_thread():
+            self.__thread.join()
@@ -0,0 +1,171 @@
+import json
+import os
+import queue
+import threading
+import time
+import numpy as np
+from V5Position import Position
+from backends import ReplayBackend
+
+# Per-frame data stored next to the images: capture time and the GPS position at that time
+FRAME_DTYPE = np.dtype([
+    ("timestamp", "<f8"),
+    ("frameCount", "<i4"),
+    ("status", "<i4"),
+    ("x", "<f4"),
+    ("y", "<f4"),
+    ("z", "<f4"),
+    ("azimuth", "<f4"),
+    ("elevation", "<f4"),
+    ("rotation", "<f4"),
+])
+
+SESSION_FILE = "session.json"
+
+
+class SessionRecorder:
+    # Records aligned color and depth frames together with the GPS position and a timestamp.
+    # Frames are grouped in chunks, each saved as .npy files (color, depth and frame data) that can be memory-mapped
+    # on replay. Full chunks are written on a background thread so recording does not stall the caller.
+    # The raw network outputs of the frames the network ran on can be recorded as well, in chunks saved with
+    # ReplayBackend.save, so the session can be replayed with the replay backend on a machine without a GPU.
+    # Each output is stored with the index of its frame in the session, as the network does not run on every frame.
+    def __init__(self, directory, depth_scale, chunk_size=150, intrinsics=None):
+        self.directory = directory
+        self.depth_scale = depth_scale
+        self.intrinsics = intrinsics  # Camera intrinsics as a dictionary, stored with the session
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.outputChunks = []
+        self.__index = 0
+        self.__written = 0  # Frames written so far, the index of the next frame in the session
+        self.__color = None
+        self.__depth = None
+        self.__frames = None
+        self.__outputs = []
+        self.__outputsLock = threading.Lock()  # Outputs are written from another thread than the frames
+        os.makedirs(directory, exist_ok=True)
+
+        self.__writeQueue = queue.Queue()
+        self.__thread = threading.Thread(target=self.__run, args=())
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def write(self, depth_image, color_image, position, timestamp=None):
+        # Add one frame, the position is copied so later updates by the GPS thread do not change it.
+        # Returns the index of the frame in the session, to record its network outputs with.
+        if self.__color is None:
+            self.__color = np.empty((self.chunk_size,) + color_image.shape, dtype=color_image.dtype)
+            self.__depth = np.empty((self.chunk_size,) + depth_image.shape, dtype=depth_image.dtype)
+            self.__frames = np.empty(self.chunk_size, dtype=FRAME_DTYPE)
+
+        self.__color[self.__index] = color_image
+        self.__depth[self.__index] = depth_image
+        self.__frames[self.__index] = (
+            timestamp if timestamp is not None else time.time(),
+            position.frameCount, position.status,
+            position.x, position.y, position.z,
+            position.azimuth, position.elevation, position.rotation,
+        )
+        self.__index += 1
+        self.__written += 1
+        if self.__index == self.chunk_size:
+            self.__flush()
+        return self.__written - 1
+
+    def write_outputs(self, outputs, frameIndex):
+        # Add the network outputs of the frame with the given index in the session, as returned by write.
+        # They are copied as they may be views on the backend's buffers.
+        with self.__outputsLock:
+            self.__outputs.append(([np.array(output) for output in outputs], frameIndex))
+            if len(self.__outputs) == self.chunk_size:
+                self.__flush_outputs()
+
+    def __flush(self):
+        # Hand the current chunk to the writer thread and start a new one
+        if self.__index == 0:
+            return
+        name = "chunk%05d" % len(self.chunks)
+        self.chunks.append({"name": name, "frames": self.__index})
+        self.__writeQueue.put(("frames", name, (self.__color[:self.__index], self.__depth[:self.__index],
+                                                self.__frames[:self.__index])))
+        self.__index = 0
+        self.__color = None
+        self.__depth = None
+        self.__frames = None
+
+    def __flush_outputs(self):
+        # Hand the recorded outputs to the writer thread, called with the outputs lock held
+        if len(self.__outputs) == 0:
+            return
+        name = "outputs%05d" % len(self.outputChunks)
+        self.outputChunks.append(name)
+        self.__writeQueue.put(("outputs", name, self.__outputs))
+        self.__outputs = []
+
+    def __run(self):
+        # The session file lists what is written so far, so a recording cut short can still be replayed
+        session = {"depth_scale": self.depth_scale, "intrinsics": self.intrinsics, "chunks": [], "outputs": []}
+        while True:
+            item = self.__writeQueue.get()
+            if item is None:
+                break
+            kind, name, data = item
+            if kind == "frames":
+                color, depth, frames = data
+                np.save(os.path.join(self.directory, name + "_color.npy"), color)
+                np.save(os.path.join(self.directory, name + "_depth.npy"), depth)
+                np.save(os.path.join(self.directory, name + "_frames.npy"), frames)
+                session["chunks"].append({"name": name, "frames": len(frames)})
+            else:
+                outputs, frameIndexes = zip(*data)
+                ReplayBackend.save(os.path.join(self.directory, name + ".npz"), outputs, frameIndexes)
+                session["outputs"].append(name)
+            with open(os.path.join(self.directory, SESSION_FILE), 'w') as f:
+                json.dump(session, f)
+
+    def close(self):
+        # Write the remaining frames and outputs and wait for the writer thread to finish
+        self.__flush()
+        with self.__outputsLock:
+            self.__flush_outputs()
+        self.__writeQueue.put(None)
+        self.__thread.join()
+
+
+class SessionReader:
+    # Reads a session written by SessionRecorder, the chunks are memory-mapped rather than loaded into memory.
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, SESSION_FILE), 'r') as f:
+            session = json.load(f)
+        self.depth_scale = session["depth_scale"]
+        self.intrinsics = session.get("intrinsics")
+        self.chunks = session["chunks"]
+        self.outputs = session.get("outputs", [])  # Names of the network output chunks, if they were recorded
+
+    def __len__(self):
+        return sum(chunk["frames"] for chunk in self.chunks)
+
+    def output_files(self):
+        # Return the paths of the recorded network output files, in recording order.
+        # ReplayBackend.from_files pairs the outputs in them with the frames by frame index.
+        return [os.path.join(self.directory, name + ".npz") for name in self.outputs]
+
+    def load_chunk(self, name):
+        # Return the memory-mapped color images, depth images and frame data of a chunk
+        color = np.load(os.path.join(self.directory, name + "_color.npy"), mmap_mode='r')
+        depth = np.load(os.path.join(self.directory, name + "_depth.npy"), mmap_mode='r')
+        frames = np.load(os.path.join(self.directory, name + "_frames.npy"))
+        return color, depth, frames
+
+    def __iter__(self):
+        # Yields (timestamp, depth image, color image, Position) for every frame in recording order
+        for chunk in self.chunks:
+            color, depth, frames = self.load_chunk(chunk["name"])
+            for i in range(chunk["frames"]):
+                frame = frames[i]
+                position = Position(int(frame["frameCount"]), int(frame["status"]),
+                                    float(frame["x"]), float(frame["y"]), float(frame["z"]),
+                                    float(frame["azimuth"]), float(frame["elevation"]), float(frame["rotation"]))
+                yield float(frame["timestamp"]), depth[i], color[i], position
@@ -0,0 +1,120 @@
+import math
+import cv2
+import numpy as np
+from V5Comm import DetectionBatch
+
+
+class DetectionScheduler:
+    # Decides for every frame whether to run the network, or to move the last detections with optical flow instead.
+    # The network runs at least every interval frames, and earlier when the image changed or the robot moved or
+    # turned more than a threshold since the last detection. The interval adapts between 1 and maxInterval: it is
+    # at least the number of frames one inference takes at the target frame rate, and is raised further while the
+    # measured frame rate stays too low or the Jetson runs hot.
+    # With a maxInterval of 1 the network runs on every frame.
+    def __init__(self, maxInterval=1, targetFps=30.0, hotTemperature=70.0, motionThreshold=6.0, moveThreshold=0.05,
+                 turnThreshold=5.0, adaptFrames=15, scale=4):
+        self.maxInterval = maxInterval
+        self.targetFps = targetFps
+        self.hotTemperature = hotTemperature  # CPU temperature in degrees C from which the interval is raised
+        self.motionThreshold = motionThreshold  # Mean gray level change that counts as motion in the image
+        self.moveThreshold = moveThreshold  # Distance in meters the robot can move before detecting again
+        self.turnThreshold = turnThreshold  # Angle in degrees the robot can turn before detecting again
+        self.adaptFrames = adaptFrames  # Number of frames between interval changes
+        self.scale = scale  # Downsampling factor of the gray images used for motion and optical flow
+        self.interval = 1
+        self.extraInterval = 0  # Frames added to the interval for the frame rate and the temperature
+        self.fps = targetFps  # Smoothed frame rate
+        self.inferenceTime = 0.0  # Smoothed inference time in seconds
+        self.detected = 0
+        self.skipped = 0
+        self.__framesSinceDetection = 0
+        self.__framesSinceAdapt = 0
+        self.__detectionGray = None
+        self.__detectionPose = None
+        # Detections and gray image of the last frame that was post-processed, to propagate from
+        self.__lastDetections = DetectionBatch()
+        self.__lastGray = None
+
+    def enabled(self):
+        return self.maxInterval > 1
+
+    def prepare(self, color_image):
+        # Return the downsampled gray image used to measure motion, or None if frames are never skipped
+        if not self.enabled():
+            return None
+        height, width = color_image.shape[:2]
+        gray = cv2.cvtColor(color_image, cv2.COLOR_BGR2GRAY)
+        return cv2.resize(gray, (width // self.scale, height // self.scale), interpolation=cv2.INTER_AREA)
+
+    def adapt(self, fps, cpuTemp):
+        # Update the interval from the inference time, the frame rate and the CPU temperature
+        if fps > 0:
+            self.fps = 0.9 * self.fps + 0.1 * fps
+        self.__framesSinceAdapt += 1
+        if self.__framesSinceAdapt < self.adaptFrames:
+            return
+        self.__framesSinceAdapt = 0
+
+        # Skip more frames while the frame rate is too low or the CPU is hot, fewer again once there is headroom
+        if cpuTemp >= self.hotTemperature or self.fps < self.targetFps * 0.8:
+            self.extraInterval = min(self.extraInterval + 1, self.maxInterval - 1)
+        elif self.fps >= self.targetFps * 0.95 and cpuTemp < self.hotTemperature - 5:
+            self.extraInterval = max(self.extraInterval - 1, 0)
+        frames = max(1, math.ceil(self.inferenceTime * self.targetFps))
+        self.interval = min(frames + self.extraInterval, self.maxInterval)
+
+    def should_detect(self, gray, position, fps=0.0, cpuTemp=0.0):
+        # Return True if the network has to run on this frame, gray is the image returned by prepare
+        if not self.enabled():
+            self.detected += 1
+            return True
+        self.adapt(fps, cpuTemp)
+        pose = (position.x, position.y, position.azimuth)
+
+        detect = self.__detectionGray is None or self.__framesSinceDetection + 1 >= self.interval
+        if not detect:
+            # Detect again once the robot moved or turned too far since the last detection
+            moved = np.hypot(pose[0] - self.__detectionPose[0], pose[1] - self.__detectionPose[1])
+            turned = abs((pose[2] - self.__detectionPose[2] + 180) % 360 - 180)
+            detect = moved > self.moveThreshold or turned > self.turnThreshold
+        if not detect:
+            # Or once the image changed
+            detect = cv2.absdiff(gray, self.__detectionGray).mean() > self.motionThreshold
+
+        if detect:
+            self.__framesSinceDetection = 0
+            self.__detectionGray = gray
+            self.__detectionPose = pose
+            self.detected += 1
+        else:
+            self.__framesSinceDetection += 1
+            self.skipped += 1
+        return detect
+
+    def set_detections(self, detections, gray, inferenceTime=0.0):
+        # Store the DetectionBatch of a frame the network ran on, and how long the network took for it in seconds
+        self.inferenceTime = 0.8 * self.inferenceTime + 0.2 * inferenceTime
+        self.__lastDetections = detections
+        self.__lastGray = gray
+
+    def propagate(self, gray):
+        # Move the last detections to this frame with the optical flow at their centers and return them
+        detections = self.__lastDetections.data
+        if len(detections) == 0 or self.__lastGray is None:
+            self.__lastGray = gray
+            return DetectionBatch()
+        centers = np.stack((detections["x"] + detections["width"] / 2, detections["y"] + detections["height"] / 2), axis=1)
+        points = (centers / self.scale).astype(np.float32).reshape(-1, 1, 2)
+        moved, status, _ = cv2.calcOpticalFlowPyrLK(self.__lastGray, gray, points, None, winSize=(15, 15), maxLevel=2)
+        # Detections whose flow was not found stay in place
+        shift = np.where(status.reshape(-1, 1) == 1, (moved - points).reshape(-1, 2) * self.scale, 0)
+
+        propagated = DetectionBatch(detections.copy())
+        data = propagated.data
+        data["x"] = np.maximum(0, np.round(detections["x"] + shift[:, 0]))
+        data["y"] = np.maximum(0, np.round(detections["y"] + shift[:, 1]))
+        data["centerX"] = detections["centerX"] + shift[:, 0]
+        data["centerY"] = detections["centerY"] + shift[:, 1]
+        self.__lastDetections = propagated
+        self.__lastGray = gray
+        return propagated
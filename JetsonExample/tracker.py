@@ -0,0 +1,181 @@
+import time
+import numpy as np
+
+
+class Tracker:
+    # Follows detections across frames on the field, so each object keeps the same track ID and gets a velocity.
+    # Every track is a constant-velocity Kalman filter on the field x and y coordinates, all tracks are stored in
+    # arrays and predicted and updated together. Detections are associated greedily with the nearest predicted
+    # track of the same class. A new track is tentative until it was seen minHits times; a tentative track is
+    # removed as soon as it is missed, a confirmed one after maxMisses frames in a row without a detection.
+    def __init__(self, maxDistance=0.3, maxMisses=5, minHits=2, measurementNoise=0.05, accelerationNoise=2.0,
+                 initialVelocityNoise=1.0):
+        self.maxDistance = maxDistance  # Largest distance in meters between a predicted track and its detection
+        self.maxMisses = maxMisses
+        self.minHits = minHits
+        self.measurementNoise = measurementNoise  # Standard deviation of the detected positions in meters
+        self.accelerationNoise = accelerationNoise  # Standard deviation of the acceleration in meters/s^2
+        self.initialVelocityNoise = initialVelocityNoise  # Standard deviation of the velocity of new tracks in meters/s
+        self.nextID = 1
+        self.lastTime = None
+
+        # State of every track: x, y, velocity x, velocity y and its covariance
+        self.states = np.zeros((0, 4))
+        self.covariances = np.zeros((0, 4, 4))
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.classes = np.zeros(0, dtype=np.int64)
+        self.hits = np.zeros(0, dtype=np.int64)
+        self.misses = np.zeros(0, dtype=np.int64)
+
+        self.__transition = np.eye(4)
+        self.__noise = np.zeros((4, 4))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def predict(self, dt):
+        # Move every track forward by dt seconds
+        if dt <= 0 or len(self.ids) == 0:
+            return
+        transition = self.__transition
+        transition[0, 2] = dt
+        transition[1, 3] = dt
+
+        # Process noise of a random acceleration
+        q = self.accelerationNoise ** 2
+        noise = self.__noise
+        noise[0, 0] = noise[1, 1] = q * dt ** 4 / 4
+        noise[0, 2] = noise[2, 0] = noise[1, 3] = noise[3, 1] = q * dt ** 3 / 2
+        noise[2, 2] = noise[3, 3] = q * dt ** 2
+
+        self.states = np.matmul(self.states, transition.T)
+        self.covariances = np.matmul(np.matmul(transition, self.covariances), transition.T)
+        self.covariances += noise
+
+    def associate(self, positions, classes):
+        # Match detections to the predicted tracks, nearest pairs first.
+        # Returns the track indices and the detection indices of the matched pairs.
+        if len(self.ids) == 0 or len(positions) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        difference = self.states[:, np.newaxis, :2] - positions[np.newaxis, :, :]
+        cost = np.hypot(difference[..., 0], difference[..., 1])
+        # Tracks only match detections of their own class, within the gating distance
+        cost[(self.classes[:, np.newaxis] != classes[np.newaxis, :]) | (cost > self.maxDistance)] = np.inf
+
+        tracks = []
+        detections = []
+        for _ in range(min(cost.shape)):
+            index = np.argmin(cost)
+            track, detection = divmod(index, cost.shape[1])
+            if cost[track, detection] == np.inf:
+                break
+            tracks.append(track)
+            detections.append(detection)
+            cost[track, :] = np.inf
+            cost[:, detection] = np.inf
+        return np.array(tracks, dtype=np.int64), np.array(detections, dtype=np.int64)
+
+    def correct(self, tracks, positions):
+        # Kalman update of the given tracks with their detected positions
+        if len(tracks) == 0:
+            return
+        states = self.states[tracks]
+        covariances = self.covariances[tracks]
+
+        # Only the position is measured, so the innovation covariance is the top left 2x2 block plus the noise
+        r = self.measurementNoise ** 2
+        a = covariances[:, 0, 0] + r
+        b = covariances[:, 0, 1]
+        c = covariances[:, 1, 0]
+        d = covariances[:, 1, 1] + r
+        determinant = a * d - b * c
+        inverse = np.empty((len(tracks), 2, 2))
+        inverse[:, 0, 0] = d / determinant
+        inverse[:, 0, 1] = -b / determinant
+        inverse[:, 1, 0] = -c / determinant
+        inverse[:, 1, 1] = a / determinant
+
+        gain = np.matmul(covariances[:, :, :2], inverse)
+        innovation = positions - states[:, :2]
+        states += np.matmul(gain, innovation[:, :, np.newaxis])[:, :, 0]
+        covariances -= np.matmul(gain, covariances[:, :2, :])
+
+        self.states[tracks] = states
+        self.covariances[tracks] = covariances
+
+    def add(self, positions, classes):
+        # Start tentative tracks at the given positions, standing still
+        count = len(positions)
+        if count == 0:
+            return
+        states = np.zeros((count, 4))
+        states[:, :2] = positions
+        covariances = np.zeros((count, 4, 4))
+        covariances[:, 0, 0] = covariances[:, 1, 1] = self.measurementNoise ** 2
+        covariances[:, 2, 2] = covariances[:, 3, 3] = self.initialVelocityNoise ** 2
+
+        self.states = np.concatenate((self.states, states))
+        self.covariances = np.concatenate((self.covariances, covariances))
+        self.ids = np.concatenate((self.ids, np.arange(self.nextID, self.nextID + count)))
+        self.classes = np.concatenate((self.classes, classes))
+        self.hits = np.concatenate((self.hits, np.ones(count, dtype=np.int64)))
+        self.misses = np.concatenate((self.misses, np.zeros(count, dtype=np.int64)))
+        self.nextID += count
+
+    def remove(self, keep):
+        # Keep only the tracks where keep is True
+        self.states = self.states[keep]
+        self.covariances = self.covariances[keep]
+        self.ids = self.ids[keep]
+        self.classes = self.classes[keep]
+        self.hits = self.hits[keep]
+        self.misses = self.misses[keep]
+
+    def update(self, aiRecord, timestamp=None):
+        # Track the detections of a new frame taken at timestamp (in seconds) and set the track ID and velocity
+        # columns of the AIRecord's DetectionBatch. Returns the AIRecord.
+        # Detections without depth have no map location, they are not tracked and keep a track ID of 0.
+        if timestamp is None:
+            timestamp = time.time()
+        if self.lastTime is not None:
+            self.predict(timestamp - self.lastTime)
+        self.lastTime = timestamp
+
+        valid = aiRecord.detections.has_depth()
+        detections = aiRecord.detections.data[valid]
+        count = len(detections)
+        positions = np.stack((detections["mapX"], detections["mapY"]), axis=1).astype(np.float64)
+        classes = detections["classID"].astype(np.int64)
+
+        tracks, matched = self.associate(positions, classes)
+        self.correct(tracks, positions[matched])
+
+        # Count hits and misses, then drop lost tracks
+        seen = np.zeros(len(self.ids), dtype=bool)
+        seen[tracks] = True
+        self.hits[seen] += 1
+        self.misses[seen] = 0
+        self.misses[~seen] += 1
+        confirmed = self.hits >= self.minHits
+        lost = (self.misses > self.maxMisses) | (~confirmed & (self.misses > 0))
+
+        # Track index of every detection, unmatched detections start new tracks at the end
+        trackOfDetection = np.full(count, -1, dtype=np.int64)
+        trackOfDetection[matched] = tracks
+        unmatched = np.flatnonzero(trackOfDetection < 0)
+        trackOfDetection[unmatched] = np.arange(len(self.ids), len(self.ids) + len(unmatched))
+        self.add(positions[unmatched], classes[unmatched])
+
+        data = aiRecord.detections.data
+        data["trackID"] = 0
+        data["velocityX"] = 0.0
+        data["velocityY"] = 0.0
+        data["trackID"][valid] = self.ids[trackOfDetection]
+        data["velocityX"][valid] = self.states[trackOfDetection, 2]
+        data["velocityY"][valid] = self.states[trackOfDetection, 3]
+
+        keep = np.ones(len(self.ids), dtype=bool)
+        keep[:len(lost)] = ~lost
+        if not keep.all():
+            self.remove(keep)
+        return aiRecord
@@ -43,4 +43,9 @@ export const commands = {
    * Set GPS Offset
    */
   gSetGpsOffset: "set_gps_offset",
+
+  /**
+   * Set detection thresholds: the object threshold of each class, the NMS threshold and the max detections per class
+   */
+  gSetThresholds: "set_thresholds",
 };
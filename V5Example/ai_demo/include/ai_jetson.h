@@ -102,7 +102,10 @@ namespace ai {
         int32_t    get_timeouts(void);
         int32_t    get_total(void);
         int32_t    get_data( AI_RECORD *map );
+        uint32_t   get_sequence(void);
+        uint32_t   get_timestamp(void);
         void       request_map();
+        void       request_push( bool enable );
 
 
       private:
@@ -114,7 +117,11 @@ namespace ai {
             kSync4 = 0x33
         };
 
-        #define   MAP_PACKET_TYPE     0x0001
+        #define   MAP_PACKET_TYPE       0x0001
+        #define   MAP_PUSH_PACKET_TYPE  0x0002
+
+        // pushed packets start with a sequence number and timestamp before the AI_RECORD
+        #define   PUSH_HEADER_SIZE      (2 * sizeof(uint32_t))
 
         enum class jetson_state {
             kStateSyncWait1   = 0,
@@ -151,6 +158,8 @@ namespace ai {
 
         AI_RECORD    last_map;
         uint32_t      last_payload_length;
+        uint32_t      last_sequence;
+        uint32_t      last_timestamp;
 
         bool          parse( uint8_t data );
 
@@ -27,6 +27,8 @@ using namespace ai;
 //
 jetson::jetson() {
     state = jetson_state::kStateSyncWait1;
+    last_sequence = 0;
+    last_timestamp = 0;
 
     thread t1 = thread( receive_task, static_cast<void *>(this) );
     t1.setPriority(thread::threadPriorityHigh);
@@ -85,6 +87,26 @@ jetson::get_data( AI_RECORD *map ) {
     return length;
 }
 
+/*---------------------------------------------------------------------------*/
+/** @brief  Get the sequence number of the last pushed map record            */
+/*---------------------------------------------------------------------------*/
+//
+// The Jetson increments this for every new set of detections, a jump of
+// more than one means records were missed
+//
+uint32_t
+jetson::get_sequence() {
+    return last_sequence;
+}
+
+/*---------------------------------------------------------------------------*/
+/** @brief  Get the Jetson timestamp in mS of the last pushed map record     */
+/*---------------------------------------------------------------------------*/
+uint32_t
+jetson::get_timestamp() {
+    return last_timestamp;
+}
+
 /*----------------------------------------------------------------------------*/
 /** @brief   Calculate CRC32                                                  */
 /** @param  *pData        A pointer to a uint8_t array.                       */
@@ -248,19 +270,32 @@ jetson::parse( uint8_t data ) {
         break;
 
       case jetson_state::kStateGoodPacket:
-        if( payload_type == MAP_PACKET_TYPE ) {
+        if( payload_type == MAP_PACKET_TYPE || payload_type == MAP_PUSH_PACKET_TYPE ) {
           AI_RECORD newMap;
+          uint32_t  offset = 0;
+          uint32_t  header[2] = {0, 0};
+
+          // pushed packets have a sequence number and timestamp before the AI_RECORD
+          if( payload_type == MAP_PUSH_PACKET_TYPE ) {
+            memcpy(header, &payload.bytes[0], PUSH_HEADER_SIZE);
+            offset = PUSH_HEADER_SIZE;
+          }
+
           // Parse the payload packet into a AI_RECORD
           memset(&newMap, 0, sizeof(newMap));
-          memcpy(&newMap, &payload.bytes[0], MAP_POS_SIZE);
+          memcpy(&newMap, &payload.bytes[offset], MAP_POS_SIZE);
           if(newMap.detectionCount > MAX_DETECTIONS)
             newMap.detectionCount = MAX_DETECTIONS;
-          memcpy(&newMap.detections, &payload.bytes[MAP_POS_SIZE], sizeof(DETECTION_OBJECT) * newMap.detectionCount);
+          memcpy(&newMap.detections, &payload.bytes[offset + MAP_POS_SIZE], sizeof(DETECTION_OBJECT) * newMap.detectionCount);
 
 
           // lock access to last_map and copy data
           maplock.lock();
           memcpy( &last_map, &newMap, sizeof(AI_RECORD));
+          if( payload_type == MAP_PUSH_PACKET_TYPE ) {
+            last_sequence = header[0];
+            last_timestamp = header[1];
+          }
           maplock.unlock();
         }
 
@@ -303,6 +338,8 @@ jetson::request_map() {
       // we use this rather than stdout so linefeed is not expanded
       //
       FILE *fp = fopen("/dev/serial1", "w");
+      if( fp == NULL )
+        return;
 
       // This is arbitary message at the moment
       // just using ASCII for convienience and debug porposes
@@ -317,6 +354,29 @@ jetson::request_map() {
     }
 }
 
+/*---------------------------------------------------------------------------*/
+/** @brief  Ask the Jetson to push packets or to go back to polling          */
+/*---------------------------------------------------------------------------*/
+//
+// In push mode the Jetson sends a packet whenever it has new detections,
+// request_map() is not needed then.  A Jetson that does not support push
+// mode ignores the request and keeps answering request_map()
+//
+void
+jetson::request_push( bool enable ) {
+    FILE *fp = fopen("/dev/serial1", "w");
+    if( fp == NULL )
+      return;
+
+    static char msg_start[] = "AA55CC3302\r\n";
+    static char msg_stop[]  = "AA55CC3303\r\n";
+    char *msg = enable ? msg_start : msg_stop;
+
+    fwrite( msg, 1, strlen(msg), fp );
+
+    fclose(fp);
+}
+
 /*---------------------------------------------------------------------------*/
 /** @brief  Task to receive and process receive data from Jetson             */
 /*---------------------------------------------------------------------------*/